@@ -0,0 +1,120 @@
+"""
+上下文过滤的微基准测试
+
+不依赖麦麦本体，可直接运行：
+    python benchmarks/bench_context_filter.py [--sizes 100k,1m] [--repeat 3]
+
+在不同规模、不同活跃度的画像对象和不同 limit 下对比 filter_messages_with_context、context_indices
+与旧实现（逐个下标加入集合后再排序）的耗时。三者结果一致由 tests/test_context_filter.py 检查。
+context_indices 直接使用合成聊天记录按列存储的发送者列构造标记数组，不创建消息对象
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standins import install, load_plugin_module  # noqa: E402
+from synthetic_chat import SyntheticChat  # noqa: E402
+
+install()
+utils = load_plugin_module("utils")
+records = load_plugin_module("records")
+
+
+def legacy_filter_messages_with_context(messages: List, primary_user_id: str, context_length: int,
+                                        context_length_after: int = 0, limit: int = 1000) -> List:
+    """旧实现：把每个上下文窗口中的每个下标加入集合，最后对下标排序"""
+    if not messages:
+        return []
+    if context_length <= 0 and (context_length_after is None or context_length_after <= 0):
+        filtered = [m for m in messages if m.user_id == primary_user_id]
+        return sorted(filtered, key=lambda x: x.time)[-limit:]
+    ordered = sorted(messages, key=lambda msg: msg.time)
+    include_indices = set()
+    for idx in range(len(ordered) - 1, -1, -1):
+        if len(include_indices) >= limit:
+            break
+        msg = ordered[idx]
+        if msg.user_id == primary_user_id:
+            start = max(0, idx - context_length)
+            end = min(len(ordered) - 1, idx + context_length_after)
+            for i in range(start, end + 1):
+                include_indices.add(i)
+    if not include_indices:
+        return []
+    result_indices = sorted(list(include_indices))
+    if len(result_indices) > limit:
+        result_indices = result_indices[-limit:]
+    return [ordered[i] for i in result_indices]
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    multiplier = 1
+    if text.endswith("k"):
+        multiplier, text = 1000, text[:-1]
+    elif text.endswith("m"):
+        multiplier, text = 1000000, text[:-1]
+    return int(float(text) * multiplier)
+
+
+def _measure(func: Callable, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="上下文过滤的微基准测试")
+    parser.add_argument("--sizes", default="100k,1m", help="合成聊天记录的消息总数，逗号分隔，支持 k/m 后缀")
+    parser.add_argument("--target-ranks", default="1,20,200", help="以最大聊天流中发言数第几多的用户为画像对象")
+    parser.add_argument("--limits", default="1400,100000", help="filter_messages_with_context 的 limit")
+    parser.add_argument("--context-length", type=int, default=3)
+    parser.add_argument("--context-length-after", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="每个场景运行的次数，取最好成绩")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    before, after = args.context_length, args.context_length_after
+    limits = [int(limit) for limit in args.limits.split(",")]
+    for size in (parse_size(size) for size in args.sizes.split(",")):
+        chat = SyntheticChat(size, seed=args.seed)
+        stream_id = chat.largest_stream()
+        columns = chat.streams[stream_id]
+        messages = records.to_records(chat.find_messages({"chat_id": stream_id}))
+        shuffled = messages[:]
+        random.Random(args.seed).shuffle(shuffled)
+        ranked = chat.active_users(stream_id)
+        print()
+        print(f"== {size:,} 条消息，聊天流 {stream_id} 共 {len(messages):,} 条，上文 {before} 条，下文 {after} 条 ==")
+        print(f"{'画像对象':>12}{'limit':>9}{'保留':>9}{'旧实现ms':>12}{'合并区间ms':>12}{'乱序输入ms':>12}"
+              f"{'按列ms':>10}{'加速比':>9}")
+        for rank in (int(rank) for rank in args.target_ranks.split(",")):
+            target = ranked[min(rank, len(ranked)) - 1]
+            target_index = chat.user_ids.index(target)
+            for limit in limits:
+                kept = len(utils.filter_messages_with_context(messages, target, before, after, limit))
+                legacy_time = _measure(
+                    lambda: legacy_filter_messages_with_context(messages, target, before, after, limit), args.repeat)
+                merged_time = _measure(
+                    lambda: utils.filter_messages_with_context(messages, target, before, after, limit), args.repeat)
+                shuffled_time = _measure(
+                    lambda: utils.filter_messages_with_context(shuffled, target, before, after, limit), args.repeat)
+                # 按列版本的耗时包含从发送者列构造标记数组
+                column_time = _measure(
+                    lambda: utils.context_indices(bytearray(user == target_index for user in columns.users),
+                                                  before, after, limit), args.repeat)
+                print(f"{'第' + str(rank) + '多':>12}{limit:>9}{kept:>9}{legacy_time * 1000:>12.1f}"
+                      f"{merged_time * 1000:>12.1f}{shuffled_time * 1000:>12.1f}{column_time * 1000:>10.1f}"
+                      f"{legacy_time / merged_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
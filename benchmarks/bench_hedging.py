@@ -0,0 +1,146 @@
+"""
+LLM请求对冲与故障转移的模拟测试
+
+不依赖麦麦本体和真实模型，可直接运行：
+    python benchmarks/bench_hedging.py [--requests 300] [--hedge-delay 15]
+
+使用可注入延迟和失败的假 llm_api，模拟 model_list 中三个表现不同的模型：
+- flaky：通常最快，但有一定概率失败或卡住很久
+- steady：稍慢但稳定
+- slow：最慢但稳定
+分别以直接请求（由 llm_api 使用 model_list 中的第一个模型）、仅故障转移、故障转移加对冲三种方式发出相同的请求，
+对比成功率、耗时百分位数和平均请求次数，并检查被取代的请求确实被取消。
+模拟中的耗时按 --time-scale 缩短，结果中的耗时已换算回模拟前的秒数
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import random
+import sys
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standins import install, load_plugin_module  # noqa: E402
+
+install()
+hedging = load_plugin_module("hedging")
+portrait_service = load_plugin_module("portrait_service")
+# 模拟中的失败是预期内的，不输出每次失败的日志
+logging.getLogger("character_sketch_plugin").setLevel(logging.ERROR)
+
+# 模型名称: (耗时中位数 秒, 耗时对数标准差, 失败概率, 卡住概率, 卡住时的耗时 秒)
+MODEL_PROFILES: Dict[str, Tuple[float, float, float, float, float]] = {
+    "flaky": (8.0, 0.3, 0.15, 0.10, 120.0),
+    "steady": (12.0, 0.2, 0.02, 0.0, 0.0),
+    "slow": (25.0, 0.2, 0.0, 0.0, 0.0),
+}
+
+
+class FakeLlmApi:
+    """按 MODEL_PROFILES 注入延迟和失败的 llm_api 替身，记录请求和取消次数"""
+
+    def __init__(self, time_scale: float, seed: int):
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.cancelled = 0
+
+    async def generate_with_model(self, prompt: str, model_config: Any = None,
+                                  **kwargs) -> Tuple[bool, str, str, str]:
+        model = model_config.model_list[0]
+        median, sigma, failure_rate, stall_rate, stall_seconds = MODEL_PROFILES[model]
+        self.calls += 1
+        roll = self.rng.random()
+        if roll < stall_rate:
+            seconds = stall_seconds
+        else:
+            seconds = median * math.exp(self.rng.gauss(0, sigma))
+        failed = stall_rate <= roll < stall_rate + failure_rate
+        if failed:
+            # 失败通常比成功返回得早
+            seconds *= 0.3
+        try:
+            await asyncio.sleep(seconds * self.time_scale)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if failed:
+            return False, f"{model} 返回错误", "", model
+        return True, f"{model} 生成的画像", "", model
+
+
+def _percentile(ordered: List[float], p: float) -> float:
+    return ordered[max(1, math.ceil(p / 100 * len(ordered))) - 1]
+
+
+async def run_strategy(runner: Any, fake: FakeLlmApi, requests: int, concurrency: int) -> Dict[str, Any]:
+    model_config, _ = portrait_service.build_model_config(
+        lambda key, default=None: list(MODEL_PROFILES) if key == "llm_config.llm_list" else default
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def one(index: int) -> Tuple[bool, float, str]:
+        async with semaphore:
+            started = loop.time()
+            success, _, _, model_name = await runner.generate_with_model(f"请求 {index}", model_config=model_config)
+            return success, (loop.time() - started) / fake.time_scale, model_name
+
+    outcomes = await asyncio.gather(*(one(index) for index in range(requests)))
+    # 被取代的请求应当已经取消，不会在后台继续运行
+    await asyncio.sleep(0)
+    leftover = asyncio.all_tasks() - {asyncio.current_task()}
+    if leftover:
+        raise AssertionError(f"请求结束后仍有 {len(leftover)} 个请求在后台运行")
+    latencies = sorted(seconds for success, seconds, _ in outcomes if success)
+    winners: Dict[str, int] = {}
+    for success, _, model_name in outcomes:
+        if success:
+            winners[model_name] = winners.get(model_name, 0) + 1
+    return {
+        "success_rate": len(latencies) / requests,
+        "p50": _percentile(latencies, 50) if latencies else float("nan"),
+        "p90": _percentile(latencies, 90) if latencies else float("nan"),
+        "p99": _percentile(latencies, 99) if latencies else float("nan"),
+        "calls": fake.calls / requests,
+        "cancelled": fake.cancelled,
+        "winners": winners,
+    }
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    strategies = [
+        ("直接请求", dict(failover=False, hedge_delay=0)),
+        ("故障转移", dict(failover=True, hedge_delay=0)),
+        (f"故障转移+对冲 {args.hedge_delay:g}s", dict(failover=True, hedge_delay=args.hedge_delay)),
+    ]
+    print(f"{'方式':<20}{'成功率':>8}{'p50 s':>8}{'p90 s':>8}{'p99 s':>8}{'请求次数':>10}{'取消':>6}  胜出的模型")
+    for label, options in strategies:
+        fake = FakeLlmApi(args.time_scale, args.seed)
+        runner = hedging.HedgedRunner(llm=fake, failover=options["failover"],
+                                      hedge_delay=options["hedge_delay"] * args.time_scale)
+        result = await run_strategy(runner, fake, args.requests, args.concurrency)
+        winners = "、".join(f"{model} {count}" for model, count in sorted(result["winners"].items()))
+        print(f"{label:<20}{result['success_rate'] * 100:>7.1f}%{result['p50']:>8.1f}{result['p90']:>8.1f}"
+              f"{result['p99']:>8.1f}{result['calls']:>10.2f}{result['cancelled']:>6}  {winners}")
+        if options["hedge_delay"] == 0 and result["cancelled"]:
+            raise AssertionError("没有对冲时不应取消任何请求")
+        if options["hedge_delay"] > 0:
+            print(f"最终的请求顺序: {' > '.join(runner.stats.order(list(MODEL_PROFILES)))}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="LLM请求对冲与故障转移的模拟测试")
+    parser.add_argument("--requests", type=int, default=300, help="模拟的请求数")
+    parser.add_argument("--concurrency", type=int, default=30, help="同时进行的请求数")
+    parser.add_argument("--hedge-delay", type=float, default=15, help="对冲阈值，单位为模拟前的秒数")
+    parser.add_argument("--time-scale", type=float, default=0.002, help="模拟耗时的缩放比例")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
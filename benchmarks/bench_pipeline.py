@@ -0,0 +1,461 @@
+"""
+画像流程的端到端基准测试
+
+不依赖麦麦本体，使用合成聊天记录和 standins 中的接口替身，可直接运行：
+    python benchmarks/bench_pipeline.py [--sizes 10k,100k,1m] [--repeat 3] [--json 结果.json]
+
+对每种数据规模分别测量以下场景的耗时、各阶段耗时、峰值内存以及读取/保留/输出的消息数：
+- 全量检索：get_messages_paged 分页读取最近 retrieval_message_count 条消息并投影为轻量记录，
+  再经过 filter_messages_with_context 和 prepare_portrayal_messages，即最初的画像流程。
+  会对 --retrieval-counts 中的每个取值各测一次，用于评估 retrieval_message_count 的安全取值
+- 两阶段检索：get_user_messages_with_context 只读取目标用户的消息及其上下文，
+  另测一次合并连续重复消息后的输出行数和token数
+- 按信息量挑选：读取与全量检索相同的消息后用 select_informative_messages 挑选，
+  “天数”一列为选中的目标用户消息分布的天数
+- 流式检索：按时间倒序分页读取并边读边筛选，凑够条数后立即停止
+- 全部 全局检索 / 全部 分流并发：跨聊天流画像的旧流程（不区分聊天流地读取全部消息）与
+  gather_user_messages_across_streams（各聊天流分别检索后归并）的对比
+- generate_portrait：使用两阶段检索的完整画像生成，包括提示词格式化、模型调用（替身）和保存画像
+- 固定范围 / 自适应范围：以两阶段检索保留最近的消息为例，对比总是检索最近 --days 天与从最近一天开始逐步扩大检索范围时
+  读取的消息数（按信息量挑选总是在整个范围内挑选，不使用自适应范围），分别以发言最多的用户、画像对象和
+  最近 --days 天内发言数第 --quiet-rank 多的不活跃用户为例（人数不足时取其中发言最少的用户），“天数”一列为实际检索的天数
+- 逐个画像 / 群画像：为聊天流中最活跃的 --batch-size 位用户分别调用 generate_portrait，
+  与 /群画像 只读取一次最近 retrieval_message_count 条消息、各画像共用的做法对比，各阶段耗时和计数为所有画像之和
+- 内存索引：先把聊天流最近 --buffer-size 条消息按原时间记入内存索引（相当于运行期间由收到消息的事件处理器记录，不计入耗时），
+  再以发言最多的用户和画像对象启用自适应检索调用 generate_portrait，并检查确实从内存索引读取；
+  缓冲区中目标用户的消息不够时标注为“内存索引回退”，并检查确实回退为查询数据库。“读取”一列只统计数据库中读取的消息
+
+耗时取多次运行中的最好成绩；峰值内存使用 tracemalloc 单独运行一次测量，不包含合成数据本身占用的内存。
+结果可以用 --json 保存，之后用 --baseline 指定保存的文件，会在最后列出修改前后各场景的总耗时和峰值内存对比
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from standins import BOT_NICKNAME, BOT_QQ_ACCOUNT, install, load_plugin_module  # noqa: E402
+from synthetic_chat import SyntheticChat  # noqa: E402
+
+stand_ins = install()
+utils = load_plugin_module("utils")
+metrics = load_plugin_module("metrics")
+name_resolver = load_plugin_module("name_resolver")
+portrait_store_module = load_plugin_module("portrait_store")
+portrait_service = load_plugin_module("portrait_service")
+live_index = load_plugin_module("live_index")
+selection = load_plugin_module("selection")
+
+# 基准测试不应写入插件目录下的画像数据库
+portrait_store_module.portrait_store.db_path = ":memory:"
+
+STAGE_COLUMNS = ["retrieval", "filter", "prepare", "llm"]
+COUNT_COLUMNS = ["rows_fetched", "rows_kept", "lines", "tokens", "days"]
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower()
+    multiplier = 1
+    if text.endswith("k"):
+        multiplier, text = 1000, text[:-1]
+    elif text.endswith("m"):
+        multiplier, text = 1000000, text[:-1]
+    return int(float(text) * multiplier)
+
+
+class Scenario:
+    """一次画像流程所需的参数"""
+
+    def __init__(self, chat: SyntheticChat, stream_id: str, target_user_id: str, args: argparse.Namespace):
+        self.chat = chat
+        self.stream_id = stream_id
+        self.target_user_id = target_user_id
+        self.end_time = time.time()
+        self.days = args.days
+        self.start_time = self.end_time - args.days * 86400
+        self.context_length = args.context_length
+        self.context_length_after = args.context_length_after
+        self.max_message_count = args.max_message_count
+        self.max_message_length = args.max_message_length
+        self.chunk_size = args.chunk_size
+        self.compact_similarity = args.compact_similarity
+
+    def person_name_dict(self) -> Dict[str, str]:
+        return {
+            self.target_user_id: self.chat.person_names.get(self.target_user_id) or "目标用户",
+            BOT_QQ_ACCOUNT: BOT_NICKNAME,
+        }
+
+    def config(self, retrieval_mode: str, retrieval_count: int = 50000, adaptive: bool = False,
+               selection_mode: str = "latest") -> Callable[[str, Any], Any]:
+        values = {
+            "character_sketch_plugin.prompt_template": "为 {person_name} 画像，共 {message_count} 条消息：\n{messages}",
+            "character_sketch_plugin.context_length": self.context_length,
+            "character_sketch_plugin.context_length_after": self.context_length_after,
+            "character_sketch_plugin.max_message_count": self.max_message_count,
+            "character_sketch_plugin.max_message_length": self.max_message_length,
+            "character_sketch_plugin.retrieval_mode": retrieval_mode,
+            "character_sketch_plugin.retrieval_chunk_size": self.chunk_size,
+            "character_sketch_plugin.retrieval_message_count": retrieval_count,
+            "character_sketch_plugin.max_retrieval_days": self.days,
+            "character_sketch_plugin.adaptive_retrieval": adaptive,
+            "character_sketch_plugin.selection_mode": selection_mode,
+            "character_sketch_plugin.incremental_update": False,
+        }
+        return lambda key, default=None: values.get(key, default)
+
+
+def bench_model_config() -> Any:
+    model_config, _ = portrait_service.build_model_config(
+        lambda key, default=None: ["bench-model"] if key == "llm_config.llm_list" else default
+    )
+    return model_config
+
+
+async def run_full_retrieval(trace, scenario: Scenario, retrieval_count: int) -> None:
+    with trace.stage("retrieval"):
+        messages = utils.get_messages_paged([], scenario.start_time, scenario.end_time, scenario.stream_id,
+                                            retrieval_count, scenario.chunk_size)
+    trace.set_count("rows_fetched", len(messages))
+    with trace.stage("filter"):
+        messages = utils.filter_messages_with_context(messages, scenario.target_user_id, scenario.context_length,
+                                                      scenario.context_length_after, scenario.max_message_count * 2)
+    trace.set_count("rows_kept", len(messages))
+    trace.set_count("days", count_days(messages, scenario.target_user_id))
+    with trace.stage("prepare"):
+        lines, _, _ = await utils.prepare_portrayal_messages(messages, scenario.max_message_count,
+                                                             scenario.target_user_id, scenario.person_name_dict(),
+                                                             scenario.max_message_length)
+    trace.set_count("lines", len(lines))
+
+
+def count_days(messages: List[Any], user_id: str) -> int:
+    """目标用户被选中的消息分布在多少天中"""
+    return len({time.localtime(msg.time)[:3] for msg in messages if msg.user_id == user_id})
+
+
+async def run_informative(trace, scenario: Scenario, retrieval_count: int) -> None:
+    with trace.stage("retrieval"):
+        messages = utils.get_messages_paged([], scenario.start_time, scenario.end_time, scenario.stream_id,
+                                            retrieval_count, scenario.chunk_size)
+    trace.set_count("rows_fetched", len(messages))
+    with trace.stage("filter"):
+        messages = selection.select_informative_messages(messages, scenario.target_user_id, scenario.context_length,
+                                                         scenario.context_length_after, scenario.max_message_count)
+    trace.set_count("rows_kept", len(messages))
+    trace.set_count("days", count_days(messages, scenario.target_user_id))
+    with trace.stage("prepare"):
+        prepared = await utils.prepare_portrayal_messages_stream(reversed(messages), scenario.max_message_count,
+                                                                 scenario.target_user_id, scenario.person_name_dict(),
+                                                                 scenario.max_message_length)
+    trace.set_count("lines", len(prepared.lines))
+    trace.set_count("tokens", prepared.token_count)
+
+
+async def run_two_phase(trace, scenario: Scenario, compact_similarity: float = 0,
+                        message_format: str = "full") -> None:
+    with trace.stage("retrieval"):
+        messages = utils.get_user_messages_with_context(scenario.target_user_id, scenario.start_time,
+                                                        scenario.end_time, scenario.stream_id,
+                                                        scenario.context_length, scenario.context_length_after,
+                                                        scenario.max_message_count * 2)
+    trace.set_count("rows_fetched", len(messages))
+    with trace.stage("filter"):
+        messages = utils.filter_messages_with_context(messages, scenario.target_user_id, scenario.context_length,
+                                                      scenario.context_length_after, scenario.max_message_count * 2)
+    trace.set_count("rows_kept", len(messages))
+    with trace.stage("prepare"):
+        prepared = await utils.prepare_portrayal_messages_stream(reversed(messages), scenario.max_message_count,
+                                                                 scenario.target_user_id, scenario.person_name_dict(),
+                                                                 scenario.max_message_length,
+                                                                 compact_similarity=compact_similarity,
+                                                                 message_format=message_format)
+    trace.set_count("lines", len(prepared.lines))
+    trace.set_count("tokens", prepared.token_count)
+
+
+async def run_streaming(trace, scenario: Scenario) -> None:
+    candidates = trace.timed_iter("filter", utils.iter_messages_with_context(
+        trace.timed_iter("retrieval", utils.iter_messages_by_user_in_stream(
+            [], scenario.start_time, scenario.end_time, scenario.stream_id, scenario.chunk_size
+        ), counter="rows_fetched"),
+        scenario.target_user_id,
+        scenario.context_length,
+        scenario.context_length_after
+    ), counter="rows_kept")
+    with trace.stage("prepare"):
+        prepared = await utils.prepare_portrayal_messages_stream(candidates, scenario.max_message_count,
+                                                                 scenario.target_user_id, scenario.person_name_dict(),
+                                                                 scenario.max_message_length)
+    trace.set_count("lines", len(prepared.lines))
+
+
+async def run_all_streams_global(trace, scenario: Scenario) -> None:
+    """跨聊天流画像的旧流程：不区分聊天流地按时间倒序读取全部消息，上下文会混入其他聊天流的消息"""
+    candidates = trace.timed_iter("filter", utils.iter_messages_with_context(
+        trace.timed_iter("retrieval", utils.iter_messages_by_user_in_stream(
+            [], scenario.start_time, scenario.end_time, None, scenario.chunk_size
+        ), counter="rows_fetched"),
+        scenario.target_user_id,
+        scenario.context_length,
+        scenario.context_length_after
+    ), counter="rows_kept")
+    with trace.stage("prepare"):
+        prepared = await utils.prepare_portrayal_messages_stream(candidates, scenario.max_message_count,
+                                                                 scenario.target_user_id, scenario.person_name_dict(),
+                                                                 scenario.max_message_length)
+    trace.set_count("lines", len(prepared.lines))
+
+
+async def run_all_streams_scatter(trace, scenario: Scenario) -> None:
+    with trace.stage("retrieval"):
+        messages = await utils.gather_user_messages_across_streams(
+            scenario.target_user_id, scenario.start_time, scenario.end_time, scenario.context_length,
+            scenario.context_length_after, scenario.max_message_count * 2
+        )
+    trace.set_count("rows_kept", len(messages))
+    with trace.stage("prepare"):
+        prepared = await utils.prepare_portrayal_messages_stream(reversed(messages), scenario.max_message_count,
+                                                                 scenario.target_user_id, scenario.person_name_dict(),
+                                                                 scenario.max_message_length)
+    trace.set_count("lines", len(prepared.lines))
+
+
+async def run_generate_portrait(trace, scenario: Scenario, selection_mode: str = "latest", adaptive: bool = False,
+                                target_user_id: str = None, from_index: Optional[bool] = None) -> None:
+    # generate_portrait 内部自带计时，换用一份新的汇总统计来取出本次运行的各阶段耗时和计数
+    run_metrics = metrics.PortraitMetrics()
+    metrics.portrait_metrics = run_metrics
+    target_user_id = target_user_id or scenario.target_user_id
+    content, notice = await portrait_service.generate_portrait(
+        scenario.config("two_phase", adaptive=adaptive, selection_mode=selection_mode),
+        target_user_id,
+        scenario.chat.person_names.get(target_user_id) or "目标用户",
+        "目标用户",
+        scenario.stream_id,
+        bench_model_config()
+    )
+    if not content:
+        raise RuntimeError(f"画像生成失败: {notice}")
+    for name, stats in run_metrics.stages.items():
+        if name != "total":
+            trace.durations[name] = stats.samples[-1]
+    for name, stats in run_metrics.counters.items():
+        trace.set_count(name, stats.samples[-1])
+    # 内存索引场景检查实际是否从内存索引读取，避免把回退到数据库的耗时当作内存索引的耗时
+    if from_index is not None and bool(trace.counts.get("rows_from_index")) != from_index:
+        raise AssertionError(f"预期{'' if from_index else '不'}从内存索引读取，实际读取方式与预期不符")
+    trace.set_count("days", trace.counts.pop("window_days", 0))
+    # 确定检索范围时读取的消息也计入读取数
+    trace.set_count("rows_fetched", trace.counts.get("rows_fetched", 0) + trace.counts.pop("rows_probed", 0))
+
+
+async def run_group_portraits(trace, scenario: Scenario, user_ids: List[str], retrieval_mode: str,
+                              retrieval_count: int, shared: bool) -> None:
+    run_metrics = metrics.PortraitMetrics()
+    metrics.portrait_metrics = run_metrics
+    get_config = scenario.config(retrieval_mode, retrieval_count)
+    history = None
+    if shared:
+        with trace.stage("retrieval"):
+            history = portrait_service.load_stream_history(get_config, scenario.stream_id)
+        trace.set_count("rows_fetched", len(history.messages))
+    for user_id in user_ids:
+        content, notice = await portrait_service.generate_portrait(
+            get_config, user_id, scenario.chat.person_names.get(user_id) or user_id, user_id, scenario.stream_id,
+            bench_model_config(), history=history
+        )
+        if not content:
+            raise RuntimeError(f"画像生成失败: {notice}")
+    for name, stats in run_metrics.stages.items():
+        if name != "total":
+            trace.durations[name] = trace.durations.get(name, 0) + sum(stats.samples)
+    for name, stats in run_metrics.counters.items():
+        if not (shared and name == "rows_fetched"):
+            trace.set_count(name, int(sum(stats.samples)))
+
+
+def fill_live_index(scenario: Scenario, buffer_size: int) -> None:
+    """把聊天流最近 buffer_size 条消息按时间顺序记入内存索引"""
+    live_index.live_message_index.clear()
+    live_index.live_message_index.capacity = buffer_size
+    for message in scenario.chat.find_messages({"chat_id": scenario.stream_id}, limit=buffer_size):
+        live_index.live_message_index.add(scenario.stream_id, message.user_info.user_id,
+                                          message.user_info.user_nickname, message.processed_plain_text,
+                                          message_time=message.time)
+
+
+def measure(loop: asyncio.AbstractEventLoop, case: Callable, repeat: int) -> Dict[str, Any]:
+    """多次运行取总耗时最短的一次，再用 tracemalloc 单独运行一次测量峰值内存"""
+    best = None
+    for _ in range(repeat):
+        name_resolver.person_name_resolver._cache.clear()
+        gc.collect()
+        trace = metrics.RunTrace("bench", "bench")
+        started = time.perf_counter()
+        loop.run_until_complete(case(trace))
+        total = time.perf_counter() - started
+        if best is None or total < best[0]:
+            best = (total, trace)
+
+    name_resolver.person_name_resolver._cache.clear()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        loop.run_until_complete(case(metrics.RunTrace("bench", "bench")))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    total, trace = best
+    return {
+        "total_ms": round(total * 1000, 2),
+        "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in trace.durations.items()},
+        "counts": dict(trace.counts),
+        "peak_mb": round(peak / 1024 / 1024, 2),
+    }
+
+
+def print_row(label: str, result: Dict[str, Any]) -> None:
+    stages = "".join(f"{result['stages_ms'].get(name, 0):10.1f}" for name in STAGE_COLUMNS)
+    counts = "".join(f"{result['counts'].get(name, 0):10d}" for name in COUNT_COLUMNS)
+    print(f"{label:<22}{result['total_ms']:10.1f}{stages}{result['peak_mb']:10.1f}{counts}")
+
+
+def print_comparison(baseline: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> None:
+    """列出与 --baseline 中同一规模、同名场景的总耗时和峰值内存对比"""
+    previous = {(item["size"], item["case"]): item for item in baseline}
+    print()
+    print(f"{'规模':>10}  {'场景':<20}{'之前ms':>10}{'现在ms':>10}{'耗时比':>8}{'之前MB':>10}{'现在MB':>10}{'内存比':>8}")
+    for result in results:
+        before = previous.get((result["size"], result["case"]))
+        if not before:
+            continue
+        time_ratio = result["total_ms"] / before["total_ms"] if before["total_ms"] else float("nan")
+        peak_ratio = result["peak_mb"] / before["peak_mb"] if before["peak_mb"] else float("nan")
+        print(f"{result['size']:>10,}  {result['case']:<20}{before['total_ms']:10.1f}{result['total_ms']:10.1f}"
+              f"{time_ratio:8.2f}{before['peak_mb']:10.1f}{result['peak_mb']:10.1f}{peak_ratio:8.2f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="画像流程的端到端基准测试")
+    parser.add_argument("--sizes", default="10k,100k,1m", help="消息总数，逗号分隔，支持 k/m 后缀")
+    parser.add_argument("--streams", type=int, default=5, help="聊天流数量")
+    parser.add_argument("--users", type=int, default=300, help="用户数量")
+    parser.add_argument("--days", type=float, default=30, help="检索最近多少天的消息，合成数据覆盖 90 天")
+    parser.add_argument("--target-rank", type=int, default=20, help="以最大聊天流中发言数第几多的用户为画像对象")
+    parser.add_argument("--retrieval-counts", default="10000,50000,200000",
+                        help="全量检索场景测试的 retrieval_message_count 取值，逗号分隔")
+    parser.add_argument("--max-message-count", type=int, default=700)
+    parser.add_argument("--max-message-length", type=int, default=200)
+    parser.add_argument("--context-length", type=int, default=3)
+    parser.add_argument("--context-length-after", type=int, default=1)
+    parser.add_argument("--repeat-rate", type=float, default=0.05, help="合成数据中复读上一条消息的概率")
+    parser.add_argument("--compact-similarity", type=float, default=0.8, help="合并重复消息场景使用的相似度阈值")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="流式检索每页读取的消息数")
+    parser.add_argument("--person-latency", type=float, default=0, help="查询人物名称的模拟延迟，单位毫秒")
+    parser.add_argument("--llm-latency", type=float, default=0, help="模型调用的模拟延迟，单位毫秒")
+    parser.add_argument("--repeat", type=int, default=3, help="每个场景运行的次数，取最好成绩")
+    parser.add_argument("--quiet-rank", type=int, default=200, help="自适应范围场景中不活跃的画像对象的发言数排名")
+    parser.add_argument("--batch-size", type=int, default=5, help="逐个画像和群画像场景的画像人数")
+    parser.add_argument("--buffer-size", type=int, default=3000, help="内存索引场景中每个聊天流保留的消息条数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="把结果保存为 JSON 文件")
+    parser.add_argument("--baseline", help="之前用 --json 保存的结果，运行结束后列出前后对比")
+    args = parser.parse_args()
+
+    stand_ins.person_latency = args.person_latency / 1000
+    stand_ins.llm_latency = args.llm_latency / 1000
+    retrieval_counts = [parse_size(item) for item in args.retrieval_counts.split(",") if item.strip()]
+    loop = asyncio.new_event_loop()
+    results: List[Dict[str, Any]] = []
+
+    for size in (parse_size(item) for item in args.sizes.split(",") if item.strip()):
+        started = time.perf_counter()
+        chat = SyntheticChat(size, stream_count=args.streams, user_count=args.users, repeat_rate=args.repeat_rate,
+                             seed=args.seed)
+        build_time = time.perf_counter() - started
+        install(chat)
+        stream_id = chat.largest_stream()
+        active_users = chat.active_users(stream_id)
+        target_user_id = active_users[min(args.target_rank, len(active_users)) - 1]
+        scenario = Scenario(chat, stream_id, target_user_id, args)
+        stream_size = len(chat.streams[stream_id].times)
+
+        print()
+        print(f"== {size:,} 条消息（生成耗时 {build_time:.1f} s），聊天流 {stream_id} 共 {stream_size:,} 条，"
+              f"画像对象为发言数第 {args.target_rank} 多的用户 {target_user_id} ==")
+        print(f"{'场景':<20}{'总耗时ms':>10}{'检索ms':>10}{'筛选ms':>10}{'整理ms':>10}{'模型ms':>10}"
+              f"{'峰值MB':>10}{'读取':>10}{'保留':>10}{'输出行':>10}{'tokens':>10}{'天数':>10}")
+
+        cases: List[tuple] = [
+            (f"全量检索 n={count}", lambda trace, count=count: run_full_retrieval(trace, scenario, count))
+            for count in retrieval_counts
+        ]
+        cases.append((f"按信息量挑选 n={retrieval_counts[0]}",
+                      lambda trace: run_informative(trace, scenario, retrieval_counts[0])))
+        cases.append(("两阶段检索", lambda trace: run_two_phase(trace, scenario)))
+        cases.append(("两阶段检索+合并重复", lambda trace: run_two_phase(trace, scenario, scenario.compact_similarity)))
+        cases.append(("两阶段检索+紧凑格式", lambda trace: run_two_phase(trace, scenario, scenario.compact_similarity,
+                                                                     "compact")))
+        cases.append(("流式检索", lambda trace: run_streaming(trace, scenario)))
+        cases.append(("全部 全局检索", lambda trace: run_all_streams_global(trace, scenario)))
+        cases.append(("全部 分流并发", lambda trace: run_all_streams_scatter(trace, scenario)))
+        cases.append(("generate_portrait", lambda trace: run_generate_portrait(trace, scenario)))
+        # 不活跃的画像对象从检索范围内有消息的用户中选取，数据量较小时排名不足 --quiet-rank 则取发言最少的用户
+        window_users = chat.active_users(stream_id, since=scenario.start_time)
+        quiet_user_id = window_users[min(args.quiet_rank, len(window_users)) - 1]
+        for label, user_id in (("最活跃", active_users[0]), ("活跃", target_user_id), ("不活跃", quiet_user_id)):
+            cases.append((f"固定范围 {label}", lambda trace, user_id=user_id: run_generate_portrait(
+                trace, scenario, "latest", False, user_id)))
+            cases.append((f"自适应范围 {label}", lambda trace, user_id=user_id: run_generate_portrait(
+                trace, scenario, "latest", True, user_id)))
+        batch_users = active_users[:args.batch_size]
+        batch_count = retrieval_counts[0]
+        cases.append((f"逐个画像 两阶段 K={len(batch_users)}", lambda trace: run_group_portraits(
+            trace, scenario, batch_users, "two_phase", batch_count, False)))
+        cases.append((f"逐个画像 流式 K={len(batch_users)}", lambda trace: run_group_portraits(
+            trace, scenario, batch_users, "full", batch_count, False)))
+        cases.append((f"群画像 K={len(batch_users)} n={batch_count}", lambda trace: run_group_portraits(
+            trace, scenario, batch_users, "two_phase", batch_count, True)))
+        # 内存索引只在启用自适应检索时按目标用户的消息数判断能否直接读取；
+        # 缓冲区中消息不够的用户会回退为查询数据库，单独标注并检查确实发生了回退
+        fill_live_index(scenario, args.buffer_size)
+        needed = portrait_service.needed_target_messages(args.max_message_count, args.context_length,
+                                                    args.context_length_after)
+        live_cases = []
+        for label, user_id in (("最活跃", active_users[0]), ("活跃", target_user_id)):
+            warm = live_index.live_message_index.get(stream_id).has_messages(user_id, needed, None)
+            live_cases.append((f"内存索引{'' if warm else '回退'} {label}", lambda trace, user_id=user_id, warm=warm:
+                               run_generate_portrait(trace, scenario, adaptive=True, target_user_id=user_id,
+                                                     from_index=warm)))
+        live_index.live_message_index.clear()
+        for label, case in cases + live_cases:
+            if (label, case) in live_cases:
+                fill_live_index(scenario, args.buffer_size)
+            stand_ins.reset_counters()
+            result = measure(loop, case, args.repeat)
+            live_index.live_message_index.clear()
+            # 每个场景共运行 repeat + 1 次，每次的查询次数相同
+            result.update({"size": size, "case": label, "find_calls": stand_ins.find_calls // (args.repeat + 1)})
+            results.append(result)
+            print_row(label, result)
+
+    loop.close()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.json}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            print_comparison(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
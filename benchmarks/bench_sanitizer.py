@@ -0,0 +1,144 @@
+"""
+消息清洗器的微基准测试
+
+不依赖麦麦本体，可直接运行：
+    python benchmarks/bench_sanitizer.py [消息条数]
+
+对比旧实现（每次调用重新编译正则并逐条规则替换）与 MessageSanitizer 的耗时，并检查两者的清洗结果；
+再追加若干条自定义规则，对比逐条规则替换与合并规则后单次扫描的耗时随规则数的变化
+"""
+import os
+import random
+import re
+import sys
+import time
+from typing import List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sanitizer import DEFAULT_SANITIZE_RULES, MessageSanitizer  # noqa: E402
+
+WORDS = ["哈哈哈", "草", "确实", "今天吃什么", "有没有人打游戏", "这个好离谱", "晚安", "？", "笑死", "我也觉得",
+         "这波操作可以的", "明天早八", "在吗", "+1", "牛的", "what", "ok", "lol", "awsl", "蚌埠住了"]
+
+
+def _sentence(rng: random.Random) -> str:
+    return "".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6)))
+
+
+def build_corpus(count: int, seed: int = 0) -> List[str]:
+    """生成包含普通消息、回复、@、表情包、图片、合并转发和文件的聊天语料"""
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.45:
+            text = _sentence(rng)
+        elif kind < 0.60:
+            text = f"[回复<群友{rng.randint(1, 99)}:{rng.randint(10000, 99999)}> 的消息：{_sentence(rng)}]，说：{_sentence(rng)}"
+        elif kind < 0.72:
+            text = f"@<群友{rng.randint(1, 99)}:{rng.randint(10000, 99999)}> {_sentence(rng)}"
+        elif kind < 0.80:
+            text = f"{_sentence(rng)}[表情包：{rng.choice(['开心', '无语', '猫猫', '狗头'])}]"
+        elif kind < 0.84:
+            text = f"[表情包：{rng.choice(['开心', '无语'])}]{_sentence(rng)}[表情包：{rng.choice(['猫猫', '狗头'])}]"
+        elif kind < 0.92:
+            text = f"[picid:{rng.getrandbits(64):x}]{_sentence(rng) if rng.random() < 0.5 else ''}"
+        elif kind < 0.97:
+            inner = "\n".join(f"群友{rng.randint(1, 99)}: {_sentence(rng)}" for _ in range(rng.randint(3, 30)))
+            text = f"{'=' * 10} 转发消息开始 {'=' * 10}\n{inner}\n{'=' * 10} 转发消息结束 {'=' * 10}"
+        else:
+            text = f"[文件:{_sentence(rng)}.zip]"
+        corpus.append(text)
+    return corpus
+
+
+def legacy_clean_all(corpus: List[str]) -> List[Optional[str]]:
+    """旧实现：每次调用重新编译六个正则，并对每条消息逐条规则替换"""
+    pattern1 = re.compile("={10}\\s*转发消息开始\\s*={10}\\s*([\\s\\S]*?)\\s*={10}\\s*转发消息结束\\s*={10}", re.DOTALL)
+    pattern2 = re.compile(r"\[回复<.+]，说：", re.DOTALL)
+    pattern3 = re.compile(r"@<.+>")
+    pattern4 = re.compile(r"\[表情包.+]", re.DOTALL)
+    pattern5 = re.compile(r"\[picid.+]", re.DOTALL)
+    pattern6 = re.compile(r"\[command.+]", re.DOTALL)
+    patterns = [
+        ("转发消息开始", pattern1),
+        ("回复", pattern2),
+        ("@", pattern3),
+        ("[表情包", pattern4),
+        ("[picid", pattern5),
+        ("[command", pattern6),
+    ]
+    result = []
+    for text in corpus:
+        text = text.strip()
+        if not text or "[文件:" in text:
+            result.append(None)
+            continue
+        for key, pat in patterns:
+            if key in text:
+                text = pat.sub("", text)
+        result.append(text.strip() or None)
+    return result
+
+
+def extra_rules(count: int) -> List[dict]:
+    """生成追加的自定义规则，模拟用户在配置中添加的过滤规则"""
+    return [{"pattern": rf"\[自定义标记{i}[^\]]*]", "action": "remove"} for i in range(count)]
+
+
+def sequential_clean_all(corpus: List[str], rules: List[dict]) -> List[Optional[str]]:
+    """逐条规则替换的可配置实现，作为合并规则的对照"""
+    compiled = [(rule["action"], re.compile(rule["pattern"], re.DOTALL)) for rule in rules]
+    result = []
+    for text in corpus:
+        text = text.strip()
+        for action, pattern in compiled:
+            if action == "drop":
+                if pattern.search(text):
+                    text = ""
+                    break
+            else:
+                text = pattern.sub("", text)
+        result.append(text.strip() or None)
+    return result
+
+
+def _measure(func, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    corpus = build_corpus(count)
+    sanitizer = MessageSanitizer()
+
+    legacy_time = _measure(lambda: legacy_clean_all(corpus))
+    new_time = _measure(lambda: [sanitizer.clean(text) for text in corpus])
+    legacy_result = legacy_clean_all(corpus)
+    new_result = [sanitizer.clean(text) for text in corpus]
+    differences = sum(1 for a, b in zip(legacy_result, new_result) if a != b)
+
+    print(f"消息条数: {count}")
+    print(f"旧实现:          {legacy_time * 1000:8.1f} ms ({legacy_time / count * 1e6:.2f} us/条)")
+    print(f"MessageSanitizer: {new_time * 1000:8.1f} ms ({new_time / count * 1e6:.2f} us/条)")
+    print(f"加速比: {legacy_time / new_time:.2f}x")
+    print(f"清洗结果不同的消息: {differences} 条（旧实现的贪婪匹配会误删同一行中两个标记之间的正常内容）")
+
+    print()
+    print("规则数  逐条替换(ms)  合并扫描(ms)")
+    for extra in (0, 10, 30):
+        rules = DEFAULT_SANITIZE_RULES + extra_rules(extra)
+        sanitizer = MessageSanitizer(rules)
+        sequential_time = _measure(lambda: sequential_clean_all(corpus, rules), repeat=3)
+        combined_time = _measure(lambda: [sanitizer.clean(text) for text in corpus], repeat=3)
+        print(f"{len(rules):6d}  {sequential_time * 1000:12.1f}  {combined_time * 1000:12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+麦麦本体接口的替身，用于离线运行基准测试
+
+install() 会在 sys.modules 中注册插件用到的 src.* 模块：
+- message_repository.find_messages 查询当前的 SyntheticChat
+- person_api 从 SyntheticChat 中读取人物名称，可模拟查询延迟
+- llm_api 不调用任何模型，按设定的延迟返回固定格式的结果
+load_plugin_module() 把插件目录注册为一个包并导入其中的模块，使插件内的相对导入可以正常工作
+"""
+import asyncio
+import importlib
+import logging
+import os
+import sys
+import types
+from typing import Any, Dict, Optional, Tuple
+
+from synthetic_chat import SyntheticChat, SyntheticMessage
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_PACKAGE = "character_sketch_plugin"
+
+BOT_QQ_ACCOUNT = "10000"
+BOT_NICKNAME = "麦麦"
+
+
+class StandIns:
+    """替身的可调参数和调用计数"""
+
+    def __init__(self):
+        self.chat: Optional[SyntheticChat] = None
+        # 每次查询人物名称的模拟延迟，单位秒
+        self.person_latency = 0.0
+        # 每次调用模型的模拟延迟，单位秒
+        self.llm_latency = 0.0
+        self.find_calls = 0
+        self.person_calls = 0
+        self.llm_calls = 0
+
+    def reset_counters(self) -> None:
+        self.find_calls = 0
+        self.person_calls = 0
+        self.llm_calls = 0
+
+
+stand_ins = StandIns()
+
+
+def _find_messages(message_filter: Dict[str, Any], sort=None, limit: int = 0, limit_mode: str = "latest",
+                   filter_bot: bool = False, filter_command: bool = False):
+    stand_ins.find_calls += 1
+    return stand_ins.chat.find_messages(message_filter, sort, limit, limit_mode, filter_bot, filter_command)
+
+
+class _PersonApi:
+    @staticmethod
+    def get_person_id(platform: str, user_id: str) -> str:
+        return user_id
+
+    @staticmethod
+    def get_person_id_by_name(person_name: str) -> Optional[str]:
+        for user_id, name in stand_ins.chat.person_names.items():
+            if name == person_name:
+                return user_id
+        return None
+
+    @staticmethod
+    async def get_person_value(person_id: str, field_name: str, default: Any = None) -> Any:
+        stand_ins.person_calls += 1
+        if stand_ins.person_latency > 0:
+            await asyncio.sleep(stand_ins.person_latency)
+        if field_name == "person_name":
+            return stand_ins.chat.person_names.get(person_id) or default
+        if field_name == "user_id":
+            return person_id
+        return default
+
+
+class _ChatApi:
+    @staticmethod
+    def get_group_streams():
+        return [types.SimpleNamespace(stream_id=stream_id) for stream_id in stand_ins.chat.streams]
+
+    @staticmethod
+    def get_stream_by_group_id(group_id: str):
+        return None
+
+    @staticmethod
+    def get_stream_by_user_id(user_id: str):
+        return None
+
+
+class _LlmApi:
+    @staticmethod
+    async def generate_with_model(prompt: str, model_config: Any = None, **kwargs) -> Tuple[bool, str, str, str]:
+        stand_ins.llm_calls += 1
+        if stand_ins.llm_latency > 0:
+            await asyncio.sleep(stand_ins.llm_latency)
+        return True, f"基于 {len(prompt)} 字提示词生成的画像", "", "bench-model"
+
+    @staticmethod
+    def get_available_models() -> Dict[str, Any]:
+        return {}
+
+
+class _TaskConfig:
+    def __init__(self):
+        self.model_list = []
+        self.max_tokens = 20000
+        self.temperature = 0.7
+        self.slow_threshold = 30
+        self.selection_strategy = "balance"
+
+
+def _module(name: str, **attributes) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install(chat: Optional[SyntheticChat] = None) -> StandIns:
+    """注册 src.* 替身模块，并把查询指向给定的合成聊天记录"""
+    if chat is not None:
+        stand_ins.chat = chat
+    if "src.common.message_repository" in sys.modules:
+        return stand_ins
+    for package in ("src", "src.common", "src.common.data_models", "src.config"):
+        _module(package, __path__=[])
+    _module("src.common.logger", get_logger=logging.getLogger)
+    _module("src.common.data_models.database_data_model", DatabaseMessages=SyntheticMessage)
+    _module("src.common.message_repository", find_messages=_find_messages)
+    _module("src.config.api_ada_configs", TaskConfig=_TaskConfig)
+    _module("src.config.config", global_config=types.SimpleNamespace(
+        bot=types.SimpleNamespace(qq_account=BOT_QQ_ACCOUNT, nickname=BOT_NICKNAME)
+    ))
+    _module("src.plugin_system", person_api=_PersonApi(), chat_api=_ChatApi(), llm_api=_LlmApi())
+    return stand_ins
+
+
+def load_plugin_module(name: str) -> types.ModuleType:
+    """以包的形式导入插件中的模块，例如 load_plugin_module("utils")"""
+    if PLUGIN_PACKAGE not in sys.modules:
+        _module(PLUGIN_PACKAGE, __path__=[PLUGIN_DIR])
+    return importlib.import_module(f"{PLUGIN_PACKAGE}.{name}")
@@ -0,0 +1,289 @@
+"""
+合成聊天记录生成器
+
+生成与 DatabaseMessages 结构相同的消息，用于在没有麦麦本体和真实数据库的环境下测试画像流程的性能。
+消息按列存储在内存中，只有被查询到时才会创建消息对象，以模拟数据库行转换为模型对象的开销；
+因此即使是百万条消息，生成和查询也不会占用过多内存。
+
+生成的数据包含：
+- 多个聊天流，消息量按幂律分布，少数群聊占据大部分消息
+- 发言人数按齐夫分布，少数活跃用户贡献大部分发言，同时会话中的人倾向于连续接话
+- 成串的密集对话与长时间的沉默交替出现
+- 回复、@、表情包、图片、合并转发、文件和命令等各类消息，以及复读和刷屏
+"""
+import random
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+WORDS = ["哈哈哈", "草", "确实", "今天吃什么", "有没有人打游戏", "这个好离谱", "晚安", "？", "笑死", "我也觉得",
+         "这波操作可以的", "明天早八", "在吗", "+1", "牛的", "what", "ok", "lol", "awsl", "蚌埠住了",
+         "刚下班", "这个bug修了一天", "周末去哪玩", "新番好看吗", "求推荐耳机", "考试周救命", "猫猫可爱"]
+STICKERS = ["开心", "无语", "猫猫", "狗头", "震惊", "哭哭"]
+
+
+class SyntheticUserInfo:
+    def __init__(self, user_id: str, user_nickname: str):
+        self.platform = "qq"
+        self.user_id = user_id
+        self.user_nickname = user_nickname
+        self.user_cardname = None
+
+
+class SyntheticChatInfo:
+    def __init__(self, stream_id: str):
+        self.stream_id = stream_id
+        self.platform = "qq"
+        self.create_time = 0.0
+        self.last_active_time = 0.0
+        self.group_info = None
+
+
+class SyntheticMessage:
+    """
+    与 DatabaseMessages 结构相同的消息对象
+    除画像流程用到的字段外也带有数据库模型的其余字段，并且每条消息有各自的 user_info 和 chat_info，
+    使读取大量消息时的内存占用和对象创建开销与真实的数据库查询相近
+    """
+
+    def __init__(self, message_id: str, time: float, chat_id: str, processed_plain_text: str,
+                 user_info: SyntheticUserInfo, is_command: bool = False):
+        self.message_id = message_id
+        self.time = time
+        self.chat_id = chat_id
+        self.reply_to = None
+        self.interest_value = None
+        self.key_words = None
+        self.key_words_lite = None
+        self.is_mentioned = False
+        self.is_at = False
+        self.reply_probability_boost = None
+        self.processed_plain_text = processed_plain_text
+        self.display_message = processed_plain_text
+        self.priority_mode = None
+        self.priority_info = None
+        self.additional_config = None
+        self.is_emoji = False
+        self.is_picid = False
+        self.is_command = is_command
+        self.is_notify = False
+        self.selected_expressions = None
+        self.user_info = user_info
+        self.group_info = None
+        self.chat_info = SyntheticChatInfo(chat_id)
+
+
+class _StreamColumns:
+    """单个聊天流的按列存储，按时间升序排列"""
+
+    def __init__(self, stream_id: str):
+        self.stream_id = stream_id
+        self.times = array("d")
+        self.users = array("i")
+        self.commands = bytearray()
+        self.texts: List[str] = []
+
+
+class SyntheticChat:
+    """
+    合成的聊天记录数据库
+    :param message_count: 消息总数
+    :param stream_count: 聊天流数量
+    :param user_count: 用户数量
+    :param days: 消息覆盖的天数，最后一条消息的时间为当前时间
+    :param repeat_rate: 一条消息复读上一条消息的概率，数值越大越接近复读和刷屏较多的群聊
+    :param seed: 随机种子，相同参数和种子生成的数据完全相同
+    """
+
+    def __init__(self, message_count: int, stream_count: int = 5, user_count: int = 300, days: float = 90,
+                 repeat_rate: float = 0.05, seed: int = 0):
+        self.repeat_rate = repeat_rate
+        self.message_count = message_count
+        self.user_ids = [str(100000 + i) for i in range(user_count)]
+        self.nicknames = [f"群友{i}" for i in range(user_count)]
+        rng = random.Random(seed)
+        # 约七成用户设置了人物名称，其余用户解析时回退到QQ昵称
+        self.person_names: Dict[str, Optional[str]] = {
+            user_id: (f"人物{index}" if rng.random() < 0.7 else None) for index, user_id in enumerate(self.user_ids)
+        }
+        self.streams: Dict[str, _StreamColumns] = {}
+        self._generate(rng, stream_count, user_count, days)
+
+    def _generate(self, rng: random.Random, stream_count: int, user_count: int, days: float) -> None:
+        stream_ids = [f"stream_{i}" for i in range(stream_count)]
+        stream_weights = [1 / (i + 1) ** 1.5 for i in range(stream_count)]
+        user_weights = [1 / (i + 1) ** 1.1 for i in range(user_count)]
+        # 每个聊天流的成员是全部用户的一个子集，发言活跃度按齐夫分布
+        members = {
+            stream_id: rng.sample(range(user_count), max(2, min(user_count, int(user_count * rng.uniform(0.3, 1)))))
+            for stream_id in stream_ids
+        }
+        counts = [0] * stream_count
+        for index in rng.choices(range(stream_count), weights=stream_weights, k=self.message_count):
+            counts[index] += 1
+
+        end_time = time.time()
+        for stream_id, count in zip(stream_ids, counts):
+            columns = _StreamColumns(stream_id)
+            self.streams[stream_id] = columns
+            if not count:
+                continue
+            # 先生成时间间隔：大部分消息处于密集对话中，少数间隔为长时间的沉默
+            mean_gap = days * 86400 / count
+            gaps = [rng.expovariate(1 / (mean_gap * 0.2)) if rng.random() < 0.9 else
+                    rng.expovariate(1 / (mean_gap * 8.2)) for _ in range(count)]
+            total = sum(gaps)
+            scale = days * 86400 / total if total else 0
+            current = end_time - days * 86400
+            stream_members = members[stream_id]
+            weights = [user_weights[rank] for rank in range(len(stream_members))]
+            drawn = rng.choices(stream_members, weights=weights, k=count)
+            recent: List[int] = []
+            for i in range(count):
+                current += gaps[i] * scale
+                if recent and rng.random() < 0.5:
+                    # 会话中的人倾向于连续接话
+                    user = rng.choice(recent)
+                else:
+                    user = drawn[i]
+                    recent.append(user)
+                    if len(recent) > 5:
+                        recent.pop(0)
+                if columns.texts and not columns.commands[-1] and rng.random() < self.repeat_rate:
+                    # 复读上一条消息，偶尔多打或少打几个字
+                    text, is_command = columns.texts[-1], False
+                    if rng.random() < 0.3:
+                        text = text + text[-1] if rng.random() < 0.5 or len(text) < 2 else text[:-1]
+                else:
+                    text, is_command = self._text(rng)
+                columns.times.append(current)
+                columns.users.append(user)
+                columns.commands.append(1 if is_command else 0)
+                columns.texts.append(text)
+
+    def _text(self, rng: random.Random) -> Tuple[str, bool]:
+        def sentence() -> str:
+            return "".join(rng.choice(WORDS) for _ in range(rng.randint(1, 6)))
+
+        def mention() -> str:
+            index = rng.randrange(len(self.user_ids))
+            return f"<{self.nicknames[index]}:{self.user_ids[index]}>"
+
+        kind = rng.random()
+        if kind < 0.50:
+            return sentence(), False
+        if kind < 0.62:
+            return f"[回复{mention()} 的消息：{sentence()}]，说：{sentence()}", False
+        if kind < 0.72:
+            return f"@{mention()} {sentence()}", False
+        if kind < 0.80:
+            return f"{sentence()}[表情包：{rng.choice(STICKERS)}]", False
+        if kind < 0.83:
+            return f"[表情包：{rng.choice(STICKERS)}]", False
+        if kind < 0.90:
+            return f"[picid:{rng.getrandbits(64):x}]{sentence() if rng.random() < 0.5 else ''}", False
+        if kind < 0.93:
+            inner = "\n".join(f"群友{rng.randint(1, 99)}: {sentence()}" for _ in range(rng.randint(3, 30)))
+            return f"{'=' * 10} 转发消息开始 {'=' * 10}\n{inner}\n{'=' * 10} 转发消息结束 {'=' * 10}", False
+        if kind < 0.95:
+            return f"[文件:{sentence()}.zip]", False
+        if kind < 0.97:
+            return f"/{rng.choice(['画像', '签到', '抽卡', '天气'])}", True
+        # 较长的消息
+        return "，".join(sentence() for _ in range(rng.randint(5, 20))), False
+
+    def largest_stream(self) -> str:
+        return max(self.streams.values(), key=lambda columns: len(columns.times)).stream_id
+
+    def active_users(self, stream_id: str, since: Optional[float] = None) -> List[str]:
+        """按发言数降序排列的用户ID，指定 since 时只统计此后不是命令的消息"""
+        columns = self.streams[stream_id]
+        counts: Dict[int, int] = {}
+        if since is None:
+            for user in columns.users:
+                counts[user] = counts.get(user, 0) + 1
+        else:
+            for index in range(bisect_right(columns.times, since), len(columns.times)):
+                if not columns.commands[index]:
+                    user = columns.users[index]
+                    counts[user] = counts.get(user, 0) + 1
+        return [self.user_ids[user] for user, _ in sorted(counts.items(), key=lambda item: -item[1])]
+
+    def _materialize(self, columns: _StreamColumns, index: int) -> SyntheticMessage:
+        user = columns.users[index]
+        return SyntheticMessage(
+            message_id=f"{columns.stream_id}-{index}",
+            time=columns.times[index],
+            chat_id=columns.stream_id,
+            processed_plain_text=columns.texts[index],
+            # 与数据库查询一样，每行的用户ID和昵称都是新创建的字符串
+            user_info=SyntheticUserInfo(str(100000 + user), f"群友{user}"),
+            is_command=bool(columns.commands[index]),
+        )
+
+    def find_messages(self, message_filter: Dict[str, Any], sort: Optional[List[Tuple[str, int]]] = None,
+                      limit: int = 0, limit_mode: str = "latest", filter_bot: bool = False,
+                      filter_command: bool = False) -> List[SyntheticMessage]:
+        """
+        与 message_repository.find_messages 语义相同的查询
+        支持按 chat_id 精确匹配、按 time 的 $gt/$gte/$lt/$lte 范围查询和按 user_id 的 $in 查询，
+        时间范围使用二分查找定位，相当于数据库中的时间索引；用户条件需要逐行检查。
+        有 limit 时按 limit_mode 取最新或最早的 limit 条，结果均按时间升序返回
+        """
+        stream_id = message_filter.get("chat_id")
+        if stream_id is not None:
+            streams = [self.streams[stream_id]] if stream_id in self.streams else []
+        else:
+            streams = list(self.streams.values())
+        user_filter = message_filter.get("user_id")
+        user_indices: Optional[Set[int]] = None
+        if user_filter is not None:
+            wanted = set(user_filter["$in"]) if isinstance(user_filter, dict) else {user_filter}
+            user_indices = {index for index, user_id in enumerate(self.user_ids) if user_id in wanted}
+        time_filter = message_filter.get("time", {})
+
+        rows: List[Tuple[_StreamColumns, int]] = []
+        for columns in streams:
+            lo, hi = _time_bounds(columns.times, time_filter)
+            rows.extend(self._scan(columns, lo, hi, user_indices, filter_command, limit, limit_mode))
+        if len(streams) > 1:
+            rows.sort(key=lambda row: row[0].times[row[1]])
+            if limit > 0:
+                rows = rows[-limit:] if limit_mode == "latest" else rows[:limit]
+        return [self._materialize(columns, index) for columns, index in rows]
+
+    @staticmethod
+    def _scan(columns: _StreamColumns, lo: int, hi: int, user_indices: Optional[Set[int]], filter_command: bool,
+              limit: int, limit_mode: str) -> List[Tuple[_StreamColumns, int]]:
+        def matches(index: int) -> bool:
+            if user_indices is not None and columns.users[index] not in user_indices:
+                return False
+            return not (filter_command and columns.commands[index])
+
+        if limit > 0 and limit_mode == "latest":
+            indices: Iterable[int] = range(hi - 1, lo - 1, -1)
+        else:
+            indices = range(lo, hi)
+        result = []
+        for index in indices:
+            if matches(index):
+                result.append((columns, index))
+                if 0 < limit <= len(result):
+                    break
+        if limit > 0 and limit_mode == "latest":
+            result.reverse()
+        return result
+
+
+def _time_bounds(times: array, time_filter: Dict[str, float]) -> Tuple[int, int]:
+    lo, hi = 0, len(times)
+    if "$gt" in time_filter:
+        lo = max(lo, bisect_right(times, time_filter["$gt"]))
+    if "$gte" in time_filter:
+        lo = max(lo, bisect_left(times, time_filter["$gte"]))
+    if "$lt" in time_filter:
+        hi = min(hi, bisect_left(times, time_filter["$lt"]))
+    if "$lte" in time_filter:
+        hi = min(hi, bisect_right(times, time_filter["$lte"]))
+    return lo, max(lo, hi)
@@ -0,0 +1,81 @@
+import re
+from typing import FrozenSet, Optional
+
+# 比较时忽略的字符：空白和常见的中英文标点
+_IGNORED_CHARS = re.compile(r"[\s!-/:-@\[-`{-~，。！？、；：“”‘’（）【】《》…～·—]+")
+# 连续重复的字符，例如 “哈哈哈哈” 与 “哈哈哈” 视为相同
+_REPEATED_CHAR = re.compile(r"(.)\1+", re.DOTALL)
+
+
+def normalize(text: str) -> str:
+    """把消息规范化为用于比较的形式：忽略大小写、空白和标点，并把连续重复的字符合并为一个"""
+    return _REPEATED_CHAR.sub(r"\1", _IGNORED_CHARS.sub("", text.lower()))
+
+
+def shingles(text: str) -> FrozenSet[str]:
+    """规范化文本的相邻二字组集合，文本只有一个字时为该字本身"""
+    if len(text) < 2:
+        return frozenset((text,))
+    return frozenset(text[i:i + 2] for i in range(len(text) - 1))
+
+
+class RepeatCompactor:
+    """
+    检测连续的重复消息（复读、刷屏、几乎相同的消息），以便合并为一行并标注重复次数
+
+    依次传入按时间排列的消息，每条消息只与上一条未被合并的消息比较：
+    - 规范化后完全相同的消息视为重复；只有标点和空白、规范化后为空的消息只在原文完全相同时视为重复
+    - 其他用户的消息在二字组的 Jaccard 相似度达到 similarity 时也视为重复
+    - 目标用户的消息只会与目标用户自己规范化后完全相同的消息合并，不同内容的发言都会保留；
+      目标用户与其他用户的消息之间不会合并
+    """
+
+    def __init__(self, similarity: float = 0.8, protected_user_id: Optional[str] = None):
+        self.similarity = similarity
+        self.protected_user_id = protected_user_id
+        self._last_user_id: Optional[str] = None
+        self._last_normalized = ""
+        self._last_text = ""
+        self._last_shingles: Optional[FrozenSet[str]] = None
+
+    def is_repeat(self, user_id: str, text: str) -> bool:
+        """
+        判断消息是否与上一条保留的消息重复，不重复时把它记为新的比较对象
+        :param user_id: 发送者用户ID
+        :param text: 清洗后的消息内容
+        :return: 是否应合并到上一条保留的消息中
+        """
+        normalized = normalize(text)
+        if self._last_user_id is not None and self._matches(user_id, text, normalized):
+            return True
+        self._last_user_id = user_id
+        self._last_normalized = normalized
+        self._last_text = text
+        self._last_shingles = None
+        return False
+
+    def _matches(self, user_id: str, text: str, normalized: str) -> bool:
+        is_protected = user_id == self.protected_user_id
+        if is_protected != (self._last_user_id == self.protected_user_id):
+            return False
+        if not normalized or not self._last_normalized:
+            # 规范化后为空时不能说明两条消息相同，例如 “？？？” 和 “!!!”
+            return text.strip() == self._last_text.strip()
+        if normalized == self._last_normalized:
+            return True
+        if is_protected:
+            return False
+        # 长度相差过大时相似度不可能达到阈值，无需计算二字组
+        shorter, longer = sorted((len(normalized), len(self._last_normalized)))
+        if shorter < longer * self.similarity:
+            return False
+        if self._last_shingles is None:
+            self._last_shingles = shingles(self._last_normalized)
+        current = shingles(normalized)
+        intersection = len(current & self._last_shingles)
+        return intersection >= self.similarity * (len(current) + len(self._last_shingles) - intersection)
+
+
+def format_repeat(text: str, repeat: int) -> str:
+    """在合并后的消息末尾标注重复次数"""
+    return f"{text} (×{repeat})" if repeat > 1 else text
@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import time
+from typing import Dict, List, Optional, Tuple
+
+from src.common.logger import get_logger
+from src.config.api_ada_configs import TaskConfig
+from src.config.config import global_config
+from src.plugin_system import person_api
+
+from .portrayal_command import PortrayalCommand
+from ..concurrency import inflight_portraits, portrait_limiter
+from ..live_index import live_message_index
+from ..portrait_service import build_model_config, generate_portrait, load_stream_history, run_limited
+from ..portrait_store import portrait_store
+from ..utils import StreamHistory
+
+logger = get_logger("character_sketch_plugin")
+
+
+class GroupPortraitCommand(PortrayalCommand):
+    """
+    群画像Command - 响应/群画像命令
+
+    一次为多位群友生成画像：
+    1. /群画像 @甲 @乙 … 为被@的用户生成画像
+    2. /群画像 K 为当前聊天流中最活跃的 K 位用户生成画像，省略 K 时使用配置的默认人数，
+       内存索引中有当前聊天流的消息时按其中近期的发言数统计
+    当前聊天流的历史消息只读取一次，为每位画像对象从中过滤出消息和上下文，
+    各画像的LLM调用在并发限制内同时进行，所有画像合并为一条转发消息发送
+    """
+
+    command_name = "群画像"
+    command_description = "一次为多位被@的用户或当前聊天流中最活跃的用户生成画像"
+
+    # === 命令设置（必须填写）===
+    command_pattern = r"^[/#]群画像(?P<refresh>刷新)?(\s*(?P<top_k>\d+))?"
+
+    async def execute(self) -> Tuple[bool, Optional[str], int]:
+        """
+        执行群画像命令
+        Returns:
+            Tuple[bool, Optional[str], int]: (是否执行成功, 可选的回复消息, 拦截消息力度，0代表不拦截，1代表仅不触发回复，replyer可见，2代表不触发回复，replyer不可见)
+        """
+        user_id = self.message.message_info.user_info.user_id
+        is_in_list = user_id in PortrayalCommand.user_id_list
+        if PortrayalCommand.permission_mode == "blacklist" and is_in_list:
+            return True, f"用户 {user_id} 没有使用该命令的权限", 1
+        elif PortrayalCommand.permission_mode == "whitelist" and not is_in_list:
+            return True, f"用户 {user_id} 没有使用该命令的权限", 1
+        if self.get_config("batch.admin_only", True) and user_id not in PortrayalCommand.admin_id_list:
+            await self.send_text("你没有使用该命令的权限")
+            return True, f"", 1
+        model_config, error = build_model_config(self.get_config)
+        if not model_config:
+            logger.error(error)
+            return False, error, 1
+        if not self.get_config("character_sketch_plugin.prompt_template", None):
+            logger.error("画像提示词为空")
+            return False, "画像提示词为空", 1
+
+        stream_id = self.message.chat_stream.stream_id
+        max_targets = self.get_config("batch.max_targets", 10)
+        history: Optional[StreamHistory] = None
+        target_user_ids = []
+        for at_user_id in self.get_at_user_ids():
+            if at_user_id != global_config.bot.qq_account and at_user_id not in target_user_ids:
+                target_user_ids.append(at_user_id)
+        if not target_user_ids:
+            # 没有@任何人时为最活跃的用户画像
+            top_k = int(self.matched_groups.get("top_k") or self.get_config("batch.default_top_k", 5))
+            live = live_message_index.get(stream_id)
+            if live is not None:
+                # 内存索引中有该聊天流的近期消息时按近期的发言数统计，不必先读取历史消息
+                target_user_ids = live.most_active_users(top_k, exclude_user_ids=[global_config.bot.qq_account])
+            else:
+                history = await asyncio.to_thread(load_stream_history, self.get_config, stream_id)
+                target_user_ids = history.most_active_users(top_k,
+                                                            exclude_user_ids=[global_config.bot.qq_account])
+            if not target_user_ids:
+                await self.send_text("当前聊天流中没有找到可以画像的用户。")
+                return True, f"", 1
+        if 0 < max_targets < len(target_user_ids):
+            await self.send_text(f"一次最多为 {max_targets} 位用户画像，只处理前 {max_targets} 位。")
+            target_user_ids = target_user_ids[:max_targets]
+
+        names: Dict[str, str] = {}
+        nicknames: Dict[str, str] = {}
+        for target_user_id in target_user_ids:
+            person_id = person_api.get_person_id('qq', target_user_id)
+            nicknames[target_user_id] = await person_api.get_person_value(person_id, "nickname")
+            names[target_user_id] = await person_api.get_person_value(person_id, "person_name",
+                                                                      nicknames[target_user_id])
+
+        # 近期已经生成过画像的用户直接使用上次的结果，命令中带有“刷新”时全部重新生成
+        refresh = bool(self.matched_groups.get("refresh"))
+        portrait_cache_ttl = self.get_config("character_sketch_plugin.portrait_cache_ttl", 43200)
+        results: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        pending: List[str] = []
+        for target_user_id in target_user_ids:
+            cached = portrait_store.get(target_user_id, stream_id) if not refresh and portrait_cache_ttl > 0 else None
+            if cached and time.time() - cached.created_at < portrait_cache_ttl:
+                results[target_user_id] = (cached.content, None)
+            else:
+                pending.append(target_user_id)
+
+        if pending:
+            if portrait_limiter.is_queue_full():
+                await self.send_text("当前画像请求过多，请稍后再试。")
+                return True, f"", 1
+            cached_notice = f"，另有 {len(results)} 位使用近期已生成的画像" if results else ""
+            await self.send_text(f"正在为 {len(pending)} 位用户生成画像{cached_notice}，请稍候...")
+            if history is None:
+                history = await asyncio.to_thread(load_stream_history, self.get_config, stream_id)
+            # 整个批量任务只占用一个画像并发名额，批量任务内部再按 batch.max_concurrency 并发调用LLM
+            generated = await run_limited(
+                stream_id,
+                functools.partial(self.generate_all, pending, names, nicknames, stream_id, model_config, history,
+                                  refresh),
+                self.send_text
+            )
+            results.update(generated)
+
+        await self.send_portraits([
+            (names[target_user_id] or nicknames[target_user_id] or target_user_id, *results[target_user_id])
+            for target_user_id in target_user_ids
+        ])
+        return True, f"", 1
+
+    async def generate_all(self, target_user_ids: List[str], names: Dict[str, str], nicknames: Dict[str, str],
+                           stream_id: str, model_config: TaskConfig,
+                           history: StreamHistory,
+                           refresh: bool = False) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+        """
+        为多位用户并发生成画像，所有画像共用同一份聊天流历史消息
+        正在由其他请求生成的画像直接等待该任务的结果；refresh 为 True 时忽略之前的画像从头重新生成
+        :return: 用户ID到 (画像内容, 提示文本) 的映射
+        """
+        semaphore = asyncio.Semaphore(max(1, self.get_config("batch.max_concurrency", 2)))
+
+        async def generate_one(target_user_id: str) -> Tuple[Optional[str], Optional[str]]:
+            async with semaphore:
+                return await generate_portrait(self.get_config, target_user_id, names[target_user_id],
+                                               nicknames[target_user_id], stream_id, model_config,
+                                               history=history, refresh=refresh)
+
+        jobs = []
+        for target_user_id in target_user_ids:
+            job_key = (target_user_id, stream_id, refresh)
+            job = inflight_portraits.get(job_key)
+            if not job:
+                job = inflight_portraits.submit(job_key, generate_one(target_user_id))
+            jobs.append(job)
+        outcomes = await asyncio.gather(*(job.wait() for job in jobs), return_exceptions=True)
+        results: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        for target_user_id, outcome in zip(target_user_ids, outcomes):
+            if isinstance(outcome, BaseException):
+                logger.error(f"为用户 {target_user_id} 生成画像失败: {outcome}")
+                outcome = (None, None)
+            results[target_user_id] = outcome
+        return results
+
+    async def send_portraits(self, portraits: List[Tuple[str, Optional[str], Optional[str]]]) -> None:
+        """
+        把多位用户的画像合并为一条转发消息发送，每位用户一个节点
+        :param portraits: (显示名称, 画像内容, 提示文本) 的列表
+        """
+        messages: List[Tuple[str, str, List[Tuple[str, str]]]] = []
+        for display_name, content, notice in portraits:
+            if content:
+                text = f"【{display_name}】\n{content}"
+            else:
+                text = f"【{display_name}】\n{notice or '画像生成失败'}"
+            messages.append((global_config.bot.qq_account, global_config.bot.nickname, [("text", text)]))
+        await self.send_forward(messages)
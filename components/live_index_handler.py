@@ -0,0 +1,38 @@
+import re
+from typing import Optional, Tuple
+
+from src.plugin_system import BaseEventHandler, EventType, MaiMessages
+
+from ..live_index import live_message_index
+
+# 从数据库检索时会排除命令消息，这里按命令的写法排除：以 / 开头的消息和本插件以 # 开头的命令
+COMMAND_PATTERN = re.compile(r"^\s*(?:/|#群?画像)")
+
+
+class LiveIndexHandler(BaseEventHandler):
+    """
+    消息索引处理器 - 把收到的每条消息记入内存索引
+
+    画像请求的目标用户在内存索引中已有足够的近期消息时直接从内存中读取，不再查询数据库；
+    统计最活跃的用户时也优先使用内存索引。
+    plain_text 即数据库中保存的 processed_plain_text；事件中没有消息的发送时间，以收到事件的时间代替
+    """
+
+    event_type = EventType.ON_MESSAGE
+    handler_name = "portrait_live_index_handler"
+    handler_description = "把收到的消息记入画像插件的内存索引，用于快速读取近期消息和统计活跃用户"
+    weight = 0
+    intercept_message = False
+
+    async def execute(self, message: Optional[MaiMessages]) -> Tuple[bool, bool, Optional[str], None, None]:
+        if not message or not message.stream_id:
+            return True, True, None, None, None
+        base_info = message.message_base_info or {}
+        user_id = base_info.get("user_id")
+        if user_id is None:
+            return True, True, None, None, None
+        text = message.plain_text
+        if not text or COMMAND_PATTERN.match(text):
+            return True, True, None, None, None
+        live_message_index.add(message.stream_id, str(user_id), base_info.get("user_nickname"), text)
+        return True, True, None, None, None
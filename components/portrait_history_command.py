@@ -0,0 +1,89 @@
+import time
+from typing import List, Tuple, Optional
+
+from src.common.logger import get_logger
+
+from .portrayal_command import PortrayalCommand
+from ..portrait_store import PortraitRecord, portrait_store
+
+logger = get_logger("character_sketch_plugin")
+
+# 历史画像列表中最多显示的版本数
+HISTORY_LIST_SIZE = 10
+
+
+def _format_time(timestamp: Optional[float], fmt: str = "%Y-%m-%d %H:%M") -> str:
+    if timestamp is None:
+        return "未知"
+    return time.strftime(fmt, time.localtime(timestamp))
+
+
+class PortraitHistoryCommand(PortrayalCommand):
+    """
+    画像历史Command - 响应/画像历史 和 /画像版本N 命令
+
+    直接从画像数据库中读取已经生成过的画像，不调用LLM
+    1. /画像历史 列出画像对象最近的若干个画像版本
+    2. /画像版本N 发送画像对象的第N版画像
+    画像对象和聊天流的指定方式与 /画像 命令相同
+    """
+
+    command_name = "画像历史"
+    command_description = "查看已经生成过的用户画像及其历史版本"
+
+    # === 命令设置（必须填写）===
+    command_pattern = r"^[/#]画像(?:历史|版本(?P<version>\d+))(\s*(?P<name>\S+))?(\s+(?P<chat_id>\S+))?"
+
+    async def execute(self) -> Tuple[bool, Optional[str], int]:
+        """
+        执行画像历史命令
+        Returns:
+            Tuple[bool, Optional[str], int]: (是否执行成功, 可选的回复消息, 拦截消息力度，0代表不拦截，1代表仅不触发回复，replyer可见，2代表不触发回复，replyer不可见)
+        """
+        user_id = self.message.message_info.user_info.user_id
+        is_in_list = user_id in PortrayalCommand.user_id_list
+        if PortrayalCommand.permission_mode == "blacklist" and is_in_list:
+            return True, f"用户 {user_id} 没有使用该命令的权限", 1
+        elif PortrayalCommand.permission_mode == "whitelist" and not is_in_list:
+            return True, f"用户 {user_id} 没有使用该命令的权限", 1
+        is_admin = user_id in PortrayalCommand.admin_id_list
+        target_user_id, person_name, nickname, stream_id = await self.get_portrayal_target()
+        if not target_user_id:
+            await self.send_text("未能确定画像对象的用户ID，请检查命令格式或@的用户信息。")
+            return True, f"", 1
+        if stream_id != self.message.chat_stream.stream_id and not is_admin:
+            await self.send_text("你没有使用该参数的权限")
+            return True, f"", 1
+        display_name = person_name or nickname or target_user_id
+
+        version = self.matched_groups.get("version")
+        if version:
+            record = portrait_store.get_version(target_user_id, stream_id, int(version))
+            if not record:
+                await self.send_text(f"未找到用户 {display_name} 的第 {version} 版画像，可以发送“/画像历史”查看已保存的版本。")
+                return True, f"", 1
+            await self.send_text(f"以下是用户 {display_name} 的第 {record.version} 版画像，{self.describe(record)}")
+            await self.send_portrait(record.content)
+            return True, f"", 1
+
+        records = portrait_store.list_versions(target_user_id, stream_id, HISTORY_LIST_SIZE)
+        if not records:
+            await self.send_text(f"还没有为用户 {display_name} 生成过画像。")
+            return True, f"", 1
+        lines: List[str] = [f"用户 {display_name} 最近的 {len(records)} 个画像版本："]
+        for record in records:
+            lines.append(f"第 {record.version} 版：{self.describe(record)}")
+        lines.append("发送“/画像版本<版本号>”加上原来的参数即可查看对应版本，例如 /画像版本1")
+        await self.send_text("\n".join(lines))
+        return True, f"", 1
+
+    @staticmethod
+    def describe(record: PortraitRecord) -> str:
+        """画像版本的简要信息"""
+        return (
+            f"生成于 {_format_time(record.created_at)}，"
+            f"覆盖 {_format_time(record.start_time, '%Y-%m-%d')} 至 {_format_time(record.last_message_time, '%Y-%m-%d')} "
+            f"的 {record.message_count} 条消息，"
+            f"模型 {record.model_name or '未知'}，"
+            f"约 {record.prompt_tokens} + {record.completion_tokens} tokens"
+        )
@@ -0,0 +1,38 @@
+from typing import Tuple, Optional
+
+from src.plugin_system import BaseCommand
+
+from .portrayal_command import PortrayalCommand
+from ..hedging import llm_runner
+from ..metrics import portrait_metrics
+
+
+class PortraitStatsCommand(BaseCommand):
+    """
+    画像统计Command - 响应/画像统计命令
+
+    向管理员展示最近画像生成各阶段耗时和计数的滚动百分位数，用于定位缓慢的阶段，以及各模型的成功率和耗时
+    """
+
+    command_name = "画像统计"
+    command_description = "查看画像生成各阶段的耗时统计，仅限管理员使用"
+
+    # === 命令设置（必须填写）===
+    command_pattern = r"^[/#]画像统计\s*$"
+
+    async def execute(self) -> Tuple[bool, Optional[str], int]:
+        """
+        执行画像统计命令
+        Returns:
+            Tuple[bool, Optional[str], int]: (是否执行成功, 可选的回复消息, 拦截消息力度，0代表不拦截，1代表仅不触发回复，replyer可见，2代表不触发回复，replyer不可见)
+        """
+        user_id = self.message.message_info.user_info.user_id
+        if user_id not in PortrayalCommand.admin_id_list:
+            await self.send_text("你没有使用该命令的权限")
+            return True, f"用户 {user_id} 没有使用该命令的权限", 1
+        report = portrait_metrics.format_report()
+        model_report = llm_runner.stats.format_report()
+        if model_report:
+            report = f"{report}\n\n{model_report}"
+        await self.send_text(report)
+        return True, f"", 1
@@ -1,18 +1,19 @@
+import functools
 import time
 from typing import List, Tuple, Optional
 
 from maim_message import Seg
 
 from src.common.logger import get_logger
-from src.config.api_ada_configs import TaskConfig
 from src.config.config import global_config
 from src.plugin_system import (
     BaseCommand,
-    llm_api,
     person_api
 )
-from ..utils import get_messages_by_user_in_stream, prepare_portrayal_messages, filter_messages_with_context, \
-    resolve_stream_id
+from ..concurrency import inflight_portraits, portrait_limiter
+from ..portrait_service import build_model_config, generate_portrait, run_limited
+from ..portrait_store import portrait_store
+from ..utils import resolve_stream_id, format_duration
 
 logger = get_logger("character_sketch_plugin")
 
@@ -30,7 +31,8 @@ class PortrayalCommand(BaseCommand):
     command_description = "根据用户的聊天记录生成用户画像"
 
     # === 命令设置（必须填写）===
-    command_pattern = r"^[/#]画像(\s*(?P<name>\S+))?(\s+(?P<chat_id>\S+))?"
+    # 排除 /画像历史、/画像版本N、/画像统计 等由其他命令处理的写法
+    command_pattern = r"^[/#]画像(?!历史|版本\d|统计)(?P<refresh>刷新)?(\s*(?P<name>\S+))?(\s+(?P<chat_id>\S+))?"
 
     permission_mode: str = "blacklist"
     user_id_list: List[str] = []
@@ -50,22 +52,10 @@ class PortrayalCommand(BaseCommand):
             return True, f"用户 {user_id} 没有使用该命令的权限", 1
         is_admin = user_id in PortrayalCommand.admin_id_list
         prompt_template = self.get_config("character_sketch_plugin.prompt_template", None)
-        llm_list = self.get_config("llm_config.llm_list", [])
-
-        if llm_list:
-            model_config = TaskConfig()
-            model_config.model_list = llm_list
-            model_config.max_tokens = self.get_config("llm_config.max_tokens", 20000)
-            model_config.temperature = self.get_config("llm_config.temperature", 0.7)
-            model_config.slow_threshold = self.get_config("llm_config.slow_threshold", 30)
-            model_config.selection_strategy = self.get_config("llm_config.selection_strategy", "balance")
-        else:
-            llm_group = self.get_config("llm_config.llm_group", "utils")
-            models = llm_api.get_available_models()
-            model_config = models.get(llm_group)
-            if not model_config:
-                logger.error(f"未找到可用的 {llm_group} 模型配置")
-                return False, f"未找到可用的 {llm_group} 模型配置", 1
+        model_config, error = build_model_config(self.get_config)
+        if not model_config:
+            logger.error(error)
+            return False, error, 1
         if not prompt_template:
             logger.error("画像提示词为空")
             return False, "画像提示词为空", 1
@@ -75,8 +65,6 @@ class PortrayalCommand(BaseCommand):
             await self.send_text("未能确定画像对象的用户ID，请检查命令格式或@的用户信息。")
             return True, f"", 1
 
-        start_time = time.time() - 24 * 3600 * 30
-        end_time = time.time()
         if not stream_id and not is_admin:
             # 如果没有指定聊天流ID，则将会搜索所有聊天流中该用户的消息 该功能仅限管理员使用
             await self.send_text("你没有使用该参数的权限")
@@ -84,67 +72,57 @@ class PortrayalCommand(BaseCommand):
         if stream_id != self.message.chat_stream.stream_id and not is_admin:
             await self.send_text("你没有使用该参数的权限")
             return True, f"", 1
-        retrieval_message_count = self.get_config("character_sketch_plugin.retrieval_message_count",
-                                                  50000)
-        context_length = self.get_config("character_sketch_plugin.context_length", 10)
-        context_length_after = self.get_config("character_sketch_plugin.context_length_after", 3)
-        max_message_count = self.get_config("character_sketch_plugin.max_message_count", 500)
-        max_message_length = self.get_config("character_sketch_plugin.max_message_length", 200)
-
-        # 获取用户在指定聊天流中的消息记录
-        messages = get_messages_by_user_in_stream([], start_time, end_time, stream_id,
-                                                  retrieval_message_count)
-        retrieval_message_count = len(messages)
-        # 过滤出画像对象的消息和上下文消息
-        messages = filter_messages_with_context(
-            messages,
-            target_user_id,
-            context_length,
-            context_length_after,
-            max_message_count * 2
-        )
-        # 删除对画像生成无用的信息并整理消息内容为字符串列表
-        lines, primary_count, other_count = await prepare_portrayal_messages(
-            messages,
-            max_message_count,
-            primary_user_id=target_user_id,
-            person_name_dict={
-                target_user_id: person_name,
-                global_config.bot.qq_account: global_config.bot.nickname
-            },
-            max_message_length=max_message_length
-        )
-        if not messages:
-            await self.send_text(f"未找到用户 {person_name} 的消息记录，无法生成画像。")
-            return True, f"", 1
-        if not lines:
-            await self.send_text(f"未找到有效的消息内容，无法生成画像。")
-            return True, f"", 1
 
-        await self.send_text(
-            f"使用了 {len(lines)} 条历史消息，其中目标用户 {primary_count} 条，上下文 {other_count} 条。正在生成画像，请稍候...")
+        # 近期已经生成过画像（包括后台预生成的）时直接返回，命令中带有“刷新”时重新生成
+        refresh = bool(self.matched_groups.get("refresh"))
+        portrait_cache_ttl = self.get_config("character_sketch_plugin.portrait_cache_ttl", 43200)
+        cached = portrait_store.get(target_user_id, stream_id) if not refresh and portrait_cache_ttl > 0 else None
+        if cached and time.time() - cached.created_at < portrait_cache_ttl:
+            await self.send_text(
+                f"以下是 {format_duration(time.time() - cached.created_at)}前生成的画像。如需重新生成，请发送“/画像刷新”加上原来的参数。")
+            await self.send_portrait(cached.content)
+            return True, f"", 1
 
-        prompt = prompt_template.format(
-            person_name=person_name,
-            user_nickname=nickname,
-            messages="\n".join(lines),
-            context_length=context_length,
-            context_length_after=context_length_after,
-            message_count=len(messages)
-        )
-        success, response, _, _ = await llm_api.generate_with_model(prompt, model_config=model_config)
-        if not success:
-            logger.error(f"模型响应失败: {response}")
+        # 参数相同的并发请求共享同一个画像任务，刷新请求不与增量更新的任务共享
+        request_stream_id = self.message.chat_stream.stream_id
+        job_key = (target_user_id, stream_id, refresh)
+        job = inflight_portraits.get(job_key)
+        if job:
+            await self.send_text(f"用户 {person_name} 的画像正在生成中，完成后会一并发送，请稍候...")
+        else:
+            if portrait_limiter.is_queue_full():
+                await self.send_text("当前画像请求过多，请稍后再试。")
+                return True, f"", 1
+            job = inflight_portraits.submit(job_key, run_limited(
+                request_stream_id,
+                functools.partial(generate_portrait, self.get_config, target_user_id, person_name, nickname,
+                                  stream_id, model_config, self.send_text, refresh=refresh),
+                self.send_text
+            ))
+        try:
+            content, notice = await job.wait()
+        except Exception as e:
+            logger.error(f"画像生成失败: {e}")
+            return False, f"", 1
+        # 同一个聊天流中的重复请求只发送一次结果
+        if request_stream_id not in job.delivered_streams:
+            job.delivered_streams.add(request_stream_id)
+            if notice:
+                await self.send_text(notice)
+            if content:
+                await self.send_portrait(content)
+        if content is None and notice is None:
             return False, f"", 1
+        return True, f"", 1
 
-        message_body: Tuple[str, str] = ("text", response)
+    async def send_portrait(self, content: str) -> None:
+        """以合并转发的形式发送画像内容"""
+        message_body: Tuple[str, str] = ("text", content)
         message: Tuple[str, str, List[Tuple[str, str]]] = (
             global_config.bot.qq_account, global_config.bot.nickname, [message_body]
         )
         await self.send_forward([message])
 
-        return True, f"", 1
-
     async def get_portrayal_target(self) -> Tuple[str, str, str, str]:
         """
         获取画像目标用户ID
@@ -178,6 +156,28 @@ class PortrayalCommand(BaseCommand):
             return target_user_id, name, nickname, chat_id
 
         # 通过@提取用户ID
+        at_user_ids = self.get_at_user_ids()
+
+        # 已经获取到了被 @ 的用户ID列表
+        if at_user_ids:
+            # 如果有被 @ 的人，只取第一个
+            target_user_id = at_user_ids[0]
+        else:
+            # 否则画像对象为发送者自己
+            target_user_id = self.message.message_info.user_info.user_id
+        if target_user_id == global_config.bot.qq_account:
+            # 如果画像对象是机器人自己，则将画像对象设为发送者自己
+            target_user_id = self.message.message_info.user_info.user_id
+        person_id = person_api.get_person_id('qq', target_user_id)
+        person_name = await person_api.get_person_value(person_id, "person_name")
+        nickname = await person_api.get_person_value(person_id, "nickname")
+        return target_user_id, person_name, nickname, chat_id
+
+    def get_at_user_ids(self) -> List[str]:
+        """
+        提取触发命令的消息中被 @ 的用户ID
+        returns: List[str]: 按出现顺序排列的用户ID
+        """
         # 整理消息分段
         segments: List[Seg]
         if self.message.message_segment.type == "seglist":
@@ -202,18 +202,4 @@ class PortrayalCommand(BaseCommand):
                 continue
             user_id = parts[-1]
             at_user_ids.append(user_id.strip())
-
-        # 已经获取到了被 @ 的用户ID列表
-        if at_user_ids:
-            # 如果有被 @ 的人，只取第一个
-            target_user_id = at_user_ids[0]
-        else:
-            # 否则画像对象为发送者自己
-            target_user_id = self.message.message_info.user_info.user_id
-        if target_user_id == global_config.bot.qq_account:
-            # 如果画像对象是机器人自己，则将画像对象设为发送者自己
-            target_user_id = self.message.message_info.user_info.user_id
-        person_id = person_api.get_person_id('qq', target_user_id)
-        person_name = await person_api.get_person_value(person_id, "person_name")
-        nickname = await person_api.get_person_value(person_id, "nickname")
-        return target_user_id, person_name, nickname, chat_id
+        return at_user_ids
@@ -0,0 +1,37 @@
+from typing import Optional, Tuple
+
+from src.plugin_system import BaseEventHandler, EventType, MaiMessages
+
+from ..prewarm import prewarm_scheduler
+
+
+class PrewarmStartHandler(BaseEventHandler):
+    """
+    画像预生成启动处理器 - 在麦麦启动时启动画像预生成调度器
+    """
+
+    event_type = EventType.ON_START
+    handler_name = "portrait_prewarm_start_handler"
+    handler_description = "启动画像预生成调度器，在空闲时段为活跃用户预先生成画像"
+    weight = 0
+    intercept_message = False
+
+    async def execute(self, message: Optional[MaiMessages]) -> Tuple[bool, bool, Optional[str], None, None]:
+        prewarm_scheduler.start(self.get_config)
+        return True, True, None, None, None
+
+
+class PrewarmStopHandler(BaseEventHandler):
+    """
+    画像预生成停止处理器 - 在麦麦关闭时停止画像预生成调度器
+    """
+
+    event_type = EventType.ON_STOP
+    handler_name = "portrait_prewarm_stop_handler"
+    handler_description = "停止画像预生成调度器"
+    weight = 0
+    intercept_message = False
+
+    async def execute(self, message: Optional[MaiMessages]) -> Tuple[bool, bool, Optional[str], None, None]:
+        prewarm_scheduler.stop()
+        return True, True, None, None, None
@@ -0,0 +1,123 @@
+import asyncio
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Deque, Dict, Hashable, Optional, Set, Tuple
+
+
+class ConcurrencyLimiter:
+    """
+    画像任务的并发限制器，同时限制全局和单个聊天流的并发数
+    超出限制的请求按先来后到排队，某个聊天流达到上限时不会阻塞其他聊天流的请求
+    名额一旦空出就会立即分配给可以执行的排队请求，因此队列中的请求总是处于无法执行的状态，
+    新请求只要自身可以执行就无需排队
+    """
+
+    def __init__(self, max_global: int = 2, max_per_stream: int = 1, max_queue: int = 10):
+        self.max_global = max_global
+        self.max_per_stream = max_per_stream
+        self.max_queue = max_queue
+        self._running = 0
+        self._running_per_stream: Counter = Counter()
+        self._waiters: Deque[Tuple[str, asyncio.Future]] = deque()
+
+    def _can_run(self, stream_id: str) -> bool:
+        if 0 < self.max_global <= self._running:
+            return False
+        if 0 < self.max_per_stream <= self._running_per_stream[stream_id]:
+            return False
+        return True
+
+    def would_wait(self, stream_id: str) -> bool:
+        """该聊天流的新请求是否需要排队"""
+        return not self._can_run(stream_id)
+
+    def ahead_count(self) -> int:
+        """新请求前面还有多少个正在执行或排队的请求"""
+        return self._running + len(self._waiters)
+
+    def is_queue_full(self) -> bool:
+        return 0 < self.max_queue <= len(self._waiters)
+
+    async def acquire(self, stream_id: str) -> None:
+        if self._can_run(stream_id):
+            self._take(stream_id)
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (stream_id, future)
+        self._waiters.append(entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经分配到执行名额后才被取消，需要归还名额
+                self.release(stream_id)
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+            raise
+
+    def release(self, stream_id: str) -> None:
+        self._running -= 1
+        self._running_per_stream[stream_id] -= 1
+        if self._running_per_stream[stream_id] <= 0:
+            del self._running_per_stream[stream_id]
+        self._wake_up()
+
+    @asynccontextmanager
+    async def slot(self, stream_id: str):
+        """在并发限制内执行，用法: async with limiter.slot(stream_id): ..."""
+        await self.acquire(stream_id)
+        try:
+            yield
+        finally:
+            self.release(stream_id)
+
+    def _take(self, stream_id: str) -> None:
+        self._running += 1
+        self._running_per_stream[stream_id] += 1
+
+    def _wake_up(self) -> None:
+        for entry in list(self._waiters):
+            stream_id, future = entry
+            if future.done():
+                self._waiters.remove(entry)
+                continue
+            if not self._can_run(stream_id):
+                continue
+            self._waiters.remove(entry)
+            self._take(stream_id)
+            future.set_result(None)
+
+
+class SharedJob:
+    """一个可被多个请求共同等待的画像任务"""
+
+    def __init__(self, task: "asyncio.Task"):
+        self.task = task
+        # 已经发送过结果的聊天流，同一个聊天流中的重复请求只发送一次结果
+        self.delivered_streams: Set[str] = set()
+
+    async def wait(self) -> Any:
+        # 某个等待者被取消时不应取消其他请求共享的任务
+        return await asyncio.shield(self.task)
+
+
+class InflightRegistry:
+    """正在执行的画像任务，参数相同的并发请求共享同一个任务"""
+
+    def __init__(self):
+        self._jobs: Dict[Hashable, SharedJob] = {}
+
+    def get(self, key: Hashable) -> Optional[SharedJob]:
+        return self._jobs.get(key)
+
+    def submit(self, key: Hashable, coro: Awaitable) -> SharedJob:
+        """创建任务并登记，任务结束后自动移除"""
+        task = asyncio.ensure_future(coro)
+        job = SharedJob(task)
+        self._jobs[key] = job
+        task.add_done_callback(lambda _: self._jobs.pop(key, None) if self._jobs.get(key) is job else None)
+        return job
+
+
+portrait_limiter = ConcurrencyLimiter()
+inflight_portraits = InflightRegistry()
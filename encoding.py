@@ -0,0 +1,134 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .compaction import format_repeat
+from .token_budget import estimate_tokens
+
+# 紧凑格式中日期行的前缀，切分聊天记录时用于识别日期行
+DAY_HEADER_PREFIX = "--- "
+# 紧凑格式中画像对象发言的行首标记
+PRIMARY_MARKER = "*"
+# 与紧凑格式每行开头的 "*时:分 代号: " 大致等长的占位符，用于在格式化之前估算token数
+COMPACT_LINE_PLACEHOLDER = "*00:00 AA: "
+
+# 提供给提示词的聊天记录格式说明
+FULL_FORMAT_DESCRIPTION = "每行聊天记录的格式为“[时间] 发言人: 内容”，内容末尾的 (×N) 表示该消息被连续重复发送了 N 次。"
+COMPACT_FORMAT_DESCRIPTION = (
+    f"聊天记录按天分组，以“{DAY_HEADER_PREFIX}”开头的行是日期；其余每行的格式为“时:分 发言人代号: 内容”，"
+    f"行首带 {PRIMARY_MARKER} 的是画像对象的发言，发言人代号对应的人物见发言人列表；"
+    "内容末尾的 (×N) 表示该消息被连续重复发送了 N 次。"
+)
+
+
+def describe_format(message_format: str) -> str:
+    """提示词变量 {message_format} 的内容"""
+    return COMPACT_FORMAT_DESCRIPTION if message_format == "compact" else FULL_FORMAT_DESCRIPTION
+
+
+def ensure_legend_placeholder(template: str) -> str:
+    """
+    紧凑格式下模型需要发言人列表才能理解代号，提示词模板中没有 {speaker_legend} 时，
+    在 {messages} 之前插入格式说明和发言人列表
+    :param template: 提示词模板
+    :return: 包含 {speaker_legend} 的提示词模板，模板中没有 {messages} 时原样返回
+    """
+    if "{speaker_legend}" in template or "{messages}" not in template:
+        return template
+    block = "" if "{message_format}" in template else "{message_format}\n"
+    block += "发言人列表：\n{speaker_legend}\n\n"
+    return template.replace("{messages}", block + "{messages}", 1)
+
+
+def format_full_line(message_time: float, name: Optional[str], text: str) -> str:
+    """完整格式的一行聊天记录：“[年-月-日 时:分:秒] 发言人: 内容”"""
+    time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message_time))
+    return f"[{time_str}] {name}: {text}"
+
+
+def _alias(index: int) -> str:
+    """按 A、B、…、Z、AA、AB … 的顺序生成发言人代号"""
+    alias = ""
+    index += 1
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        alias = chr(ord("A") + remainder) + alias
+    return alias
+
+
+def assign_aliases(user_ids: List[str], primary_user_id: Optional[str] = None) -> Dict[str, str]:
+    """
+    为发言人分配简短的代号，画像对象固定为 A，其余发言人按发言次数从多到少依次分配
+    :param user_ids: 每条消息的发言人，可以重复
+    :param primary_user_id: 画像对象的用户ID
+    :return: 用户ID到代号的映射
+    """
+    counts: Dict[str, int] = {}
+    for user_id in user_ids:
+        counts[user_id] = counts.get(user_id, 0) + 1
+    ordered = sorted(counts, key=lambda user_id: (user_id != primary_user_id, -counts[user_id]))
+    return {user_id: _alias(index) for index, user_id in enumerate(ordered)}
+
+
+def format_speaker_legend(aliases: Dict[str, str], person_name_dict: Dict[str, str],
+                          primary_user_id: Optional[str] = None) -> str:
+    """发言人列表，每行为 “代号: 人物名称”"""
+    lines = []
+    for user_id, alias in aliases.items():
+        suffix = "（画像对象）" if user_id == primary_user_id else ""
+        lines.append(f"{alias}: {person_name_dict.get(user_id)}{suffix}")
+    return "\n".join(lines)
+
+
+def _day_header(message_time: float) -> str:
+    return f"{DAY_HEADER_PREFIX}{time.strftime('%Y-%m-%d', time.localtime(message_time))} ---"
+
+
+def encode_compact(entries: List[Tuple[float, str, str]], repeats: List[int], person_name_dict: Dict[str, str],
+                   primary_user_id: Optional[str], token_budget: int = 0) -> Tuple[List[str], int, int, str]:
+    """
+    以紧凑格式编码聊天记录：发言人使用简短代号并另附发言人列表，日期只在每天的第一行之前出现一次，
+    每行只保留时分，画像对象的发言在行首加上标记
+
+    :param entries: 按时间倒序排列的 (时间, 用户ID, 内容)
+    :param repeats: 每条消息的重复次数
+    :param person_name_dict: 用户ID到人物名称的映射
+    :param primary_user_id: 画像对象的用户ID
+    :param token_budget: 所有行（包括日期行和发言人列表）的token预算，0表示不限制
+    :return: 按时间升序排列的行、保留的消息条数、估算的token数（包括发言人列表）、发言人列表
+    """
+    aliases = assign_aliases([user_id for _, user_id, _ in entries], primary_user_id)
+    # 发言人列表按所有候选消息的发言人预留预算，实际只列出保留下来的发言人，不会超出预算
+    legend_tokens = estimate_tokens(format_speaker_legend(aliases, person_name_dict, primary_user_id)) + 1
+    budget = max(token_budget - legend_tokens, 1) if token_budget > 0 else 0
+
+    bodies: List[str] = []
+    days: List[str] = []
+    used = 0
+    seen_days = set()
+    for (message_time, user_id, text), repeat in zip(entries, repeats):
+        marker = PRIMARY_MARKER if user_id == primary_user_id else ""
+        body = f"{marker}{time.strftime('%H:%M', time.localtime(message_time))} {aliases[user_id]}: " \
+               f"{format_repeat(text, repeat)}"
+        header = _day_header(message_time)
+        cost = estimate_tokens(body) + 1
+        if header not in seen_days:
+            cost += estimate_tokens(header) + 1
+        if budget > 0 and used + cost > budget:
+            break
+        seen_days.add(header)
+        used += cost
+        bodies.append(body)
+        days.append(header)
+
+    kept = len(bodies)
+    lines: List[str] = []
+    current_day = None
+    for index in range(kept - 1, -1, -1):
+        if days[index] != current_day:
+            current_day = days[index]
+            lines.append(current_day)
+        lines.append(bodies[index])
+    kept_aliases = {user_id: alias for user_id, alias in aliases.items()
+                    if any(user_id == entry_user for _, entry_user, _ in entries[:kept])}
+    legend = format_speaker_legend(kept_aliases, person_name_dict, primary_user_id)
+    return lines, kept, used + estimate_tokens(legend) + 1, legend
@@ -0,0 +1,213 @@
+import asyncio
+import copy
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.common.logger import get_logger
+from src.plugin_system import llm_api
+
+from .metrics import RollingStats
+
+logger = get_logger("character_sketch_plugin")
+
+# 每个模型保留的最近请求数
+MODEL_STATS_WINDOW = 50
+# 成功率低于该值时按该值计算，避免只失败过的模型被无限推后
+MIN_SUCCESS_RATE = 0.1
+# 每个模型至少有这么多条记录之后才按统计决定请求顺序，在此之前轮流以各个模型开头
+MIN_MODEL_SAMPLES = 3
+# 统计足够后每隔这么多次请求仍轮流以各个模型开头一次，使排在后面的模型的统计不会过时
+EXPLORATION_INTERVAL = 10
+
+# generate_with_model 的返回值：是否成功、回复或错误信息、推理过程、模型名称
+LlmResult = Tuple[bool, str, Optional[str], Optional[str]]
+
+
+class ModelLatencyStats:
+    """记录每个模型最近请求的耗时和成败，用于决定先请求哪个模型"""
+
+    def __init__(self, window: int = MODEL_STATS_WINDOW):
+        self.window = window
+        # 成功请求的耗时，单位秒
+        self.latencies: Dict[str, RollingStats] = {}
+        # 请求结果，成功为 1，失败为 0
+        self.results: Dict[str, RollingStats] = {}
+        # 每个模型的记录数，包括被取消的请求
+        self.sample_counts: Dict[str, int] = {}
+        # 决定过的请求顺序数，以及轮流开头时下一个开头的模型下标
+        self._planned = 0
+        self._rotation = 0
+
+    def record(self, model: str, success: bool, seconds: float) -> None:
+        self.sample_counts[model] = self.sample_counts.get(model, 0) + 1
+        self.results.setdefault(model, RollingStats(self.window)).add(1 if success else 0)
+        if success:
+            self.latencies.setdefault(model, RollingStats(self.window)).add(seconds)
+
+    def record_outpaced(self, model: str, seconds: float) -> None:
+        """
+        记录一次比备用请求更慢、被取消的请求：它的实际耗时至少为已经等待的时间，按该时间计入耗时
+        不计入成功率，因为无法知道它最终会成功还是失败
+        """
+        self.sample_counts[model] = self.sample_counts.get(model, 0) + 1
+        self.latencies.setdefault(model, RollingStats(self.window)).add(seconds)
+
+    def expected_latency(self, model: str) -> Optional[float]:
+        """
+        模型的预期耗时：耗时中位数除以成功率，约等于得到一次成功回复平均需要的时间
+        没有任何记录的模型返回 None
+        """
+        results = self.results.get(model)
+        latencies = self.latencies.get(model)
+        has_results = results is not None and bool(results.samples)
+        has_latencies = latencies is not None and bool(latencies.samples)
+        if not has_results and not has_latencies:
+            return None
+        success_rate = 1.0
+        if has_results:
+            success_rate = max(sum(results.samples) / len(results.samples), MIN_SUCCESS_RATE)
+        # 只失败过的模型按最慢的模型计算
+        median = latencies.percentile(50) if has_latencies else self._slowest()
+        return median / success_rate
+
+    def _slowest(self) -> float:
+        medians = [stats.percentile(50) for stats in self.latencies.values() if stats.samples]
+        return max(medians) if medians else 1.0
+
+    def order(self, models: List[str]) -> List[str]:
+        """
+        按预期耗时从小到大排列模型，预期耗时相同时保持配置中的顺序
+        没有记录的模型排在有记录的模型之后，只在前面的模型失败或过慢时才会被请求
+        """
+        def key(model: str) -> Tuple[bool, float]:
+            expected = self.expected_latency(model)
+            return expected is None, expected or 0.0
+
+        return sorted(models, key=key)
+
+    def plan(self, models: List[str]) -> List[str]:
+        """
+        决定一次请求的模型顺序
+        有模型的记录少于 MIN_MODEL_SAMPLES 条时，以及之后每 EXPLORATION_INTERVAL 次请求，按配置的顺序轮流以各个模型开头，
+        使每个模型都能积累并更新统计；其余时候按 order 的结果，即预期耗时最短的模型优先
+        """
+        self._planned += 1
+        explore = any(self.sample_counts.get(model, 0) < MIN_MODEL_SAMPLES for model in models)
+        if explore or self._planned % EXPLORATION_INTERVAL == 0:
+            start = self._rotation % len(models)
+            self._rotation += 1
+            return models[start:] + models[:start]
+        return self.order(models)
+
+    def format_report(self) -> str:
+        """生成给管理员查看的各模型统计"""
+        if not self.results and not self.latencies:
+            return ""
+        lines = ["模型：完成的请求数 / 成功率 / 耗时p50(s) / 耗时p90(s)，耗时包含因过慢被取消的请求已等待的时间"]
+        for model in {**self.results, **self.latencies}:
+            results = self.results.get(model)
+            latencies = self.latencies.get(model)
+            summary = latencies.summary() if latencies else {"count": 0}
+            count = len(results.samples) if results else 0
+            success_rate = f"{sum(results.samples) / count * 100:.0f}%" if count else "-"
+            if summary["count"]:
+                lines.append(f"{model}：{count} / {success_rate} / {summary['p50']:.1f} / {summary['p90']:.1f}")
+            else:
+                lines.append(f"{model}：{count} / {success_rate} / - / -")
+        return "\n".join(lines)
+
+
+class HedgedRunner:
+    """
+    在 model_list 的多个模型之间对冲和故障转移的LLM请求器，接口与 llm_api.generate_with_model 相同
+
+    - 按各模型的预期耗时决定请求顺序（见 ModelLatencyStats.plan，模型配置的 selection_strategy 为 random 时随机排列），
+      每次只请求一个模型
+    - 请求失败时立即改为请求下一个模型
+    - 请求超过 hedge_delay 秒仍未返回时，再向下一个模型发起备用请求，先成功返回的结果胜出，其余请求被取消；
+      比胜出的请求更早发出却仍未返回的请求按已等待的时间计入耗时，使卡住的模型被排到后面
+    model_list 中只有一个模型时与直接调用 llm 相同
+    """
+
+    def __init__(self, llm: Any = llm_api, stats: Optional[ModelLatencyStats] = None, hedge_delay: float = 0,
+                 failover: bool = True):
+        self.llm = llm
+        self.stats = stats or ModelLatencyStats()
+        # 发起备用请求前等待的秒数，0表示不对冲
+        self.hedge_delay = hedge_delay
+        # 请求失败时是否改为请求下一个模型
+        self.failover = failover
+
+    async def generate_with_model(self, prompt: str, model_config: Any, **kwargs) -> LlmResult:
+        """
+        :param prompt: 提示词
+        :param model_config: 模型配置，其中的 model_list 为可以使用的模型
+        :return: 是否成功、回复或错误信息、推理过程、模型名称
+        """
+        models = list(getattr(model_config, "model_list", None) or [])
+        if len(models) <= 1 or (not self.failover and self.hedge_delay <= 0):
+            return await self.llm.generate_with_model(prompt, model_config=model_config, **kwargs)
+
+        if getattr(model_config, "selection_strategy", "balance") == "random":
+            queue = random.sample(models, len(models))
+        else:
+            queue = self.stats.plan(models)
+        running: Dict[asyncio.Task, str] = {}
+        started_at: Dict[asyncio.Task, float] = {}
+        last_error = "所有模型均请求失败"
+        winner_started: Optional[float] = None
+
+        def launch() -> None:
+            model = queue.pop(0)
+            task = asyncio.ensure_future(self._attempt(prompt, model_config, model, kwargs))
+            running[task] = model
+            started_at[task] = time.perf_counter()
+
+        launch()
+        try:
+            while running:
+                timeout = self.hedge_delay if queue and self.hedge_delay > 0 else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info(f"模型 {'、'.join(running.values())} 超过 {self.hedge_delay} 秒未返回，"
+                                f"向 {queue[0]} 发起备用请求")
+                    launch()
+                    continue
+                for task in done:
+                    model = running.pop(task)
+                    success, response, reasoning, model_name = task.result()
+                    if success:
+                        winner_started = started_at[task]
+                        return success, response, reasoning, model_name or model
+                    last_error = response
+                    logger.warning(f"模型 {model} 请求失败: {response}")
+                    if queue and self.failover:
+                        launch()
+            return False, last_error, None, None
+        finally:
+            now = time.perf_counter()
+            for task, model in running.items():
+                task.cancel()
+                if winner_started is not None and started_at[task] < winner_started:
+                    self.stats.record_outpaced(model, now - started_at[task])
+
+    async def _attempt(self, prompt: str, model_config: Any, model: str, kwargs: Dict[str, Any]) -> LlmResult:
+        """只使用一个模型请求，记录耗时和成败，异常视为失败"""
+        single = copy.copy(model_config)
+        single.model_list = [model]
+        started = time.perf_counter()
+        try:
+            success, response, reasoning, model_name = await self.llm.generate_with_model(
+                prompt, model_config=single, **kwargs
+            )
+        except asyncio.CancelledError:
+            # 被更快的请求取代，由 generate_with_model 决定是否计入耗时
+            raise
+        except Exception as e:
+            success, response, reasoning, model_name = False, str(e), None, model
+        self.stats.record(model, success, time.perf_counter() - started)
+        return success, response, reasoning, model_name
+
+
+llm_runner = HedgedRunner()
@@ -0,0 +1,140 @@
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional
+
+from src.common.logger import get_logger
+
+from .records import MessageRecord
+from .utils import StreamHistory
+
+logger = get_logger("character_sketch_plugin")
+
+
+class StreamIndex:
+    """
+    单个聊天流最近消息的内存索引
+
+    按到达顺序保存最近 capacity 条消息的轻量记录，超出时丢弃最早的消息。
+    每条消息有一个递增的序号，同时维护每个用户在缓冲区中的消息数、最近发言时间和消息序号，
+    判断某个用户最近的消息是否足够、统计最活跃的用户时都不需要遍历缓冲区
+    """
+
+    def __init__(self, capacity: int, created_at: float):
+        self.capacity = max(1, capacity)
+        # 晚于该时间收到的消息都在缓冲区中；丢弃消息后推进为被丢弃消息的时间
+        self.covered_since = created_at
+        # 缓冲区，_records[_start:] 为有效的消息；丢弃的消息累计到 capacity 条后才真正从列表中删除
+        self._records: List[MessageRecord] = []
+        self._start = 0
+        # _records[0] 的序号
+        self._base_seq = 0
+        # 用户ID到该用户在缓冲区中的消息数、最近发言时间、消息序号（升序）的映射
+        self.counts: Counter = Counter()
+        self.last_seen: Dict[str, float] = {}
+        self.offsets: Dict[str, Deque[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._records) - self._start
+
+    def append(self, record: MessageRecord) -> None:
+        """追加一条消息，缓冲区已满时丢弃最早的一条"""
+        user_id = record.user_id
+        self.offsets.setdefault(user_id, deque()).append(self._base_seq + len(self._records))
+        self._records.append(record)
+        self.counts[user_id] += 1
+        self.last_seen[user_id] = record.time
+        if len(self) > self.capacity:
+            self._evict()
+
+    def _evict(self) -> None:
+        oldest = self._records[self._start]
+        self._start += 1
+        self.covered_since = max(self.covered_since, oldest.time)
+        user_id = oldest.user_id
+        self.offsets[user_id].popleft()
+        self.counts[user_id] -= 1
+        if not self.counts[user_id]:
+            del self.counts[user_id], self.last_seen[user_id], self.offsets[user_id]
+        if self._start >= self.capacity:
+            del self._records[:self._start]
+            self._base_seq += self._start
+            self._start = 0
+
+    def covers(self, start_time: Optional[float]) -> bool:
+        """晚于 start_time 的消息是否都在缓冲区中"""
+        return start_time is not None and start_time >= self.covered_since
+
+    def has_messages(self, user_id: str, needed: int, start_time: Optional[float] = None) -> bool:
+        """缓冲区中晚于 start_time 的该用户消息是否至少有 needed 条，只检查最近的 needed 条"""
+        positions = self.offsets.get(user_id)
+        if not positions or len(positions) < needed:
+            return False
+        if not start_time or needed <= 0:
+            return True
+        oldest_needed = positions[-needed]
+        return self._records[oldest_needed - self._base_seq].time > start_time
+
+    def most_active_users(self, top_k: int, exclude_user_ids: Iterable[str] = ()) -> List[str]:
+        """按缓冲区中的发言数降序排列的用户ID，发言数相同时最近发言的用户在前"""
+        excluded = set(exclude_user_ids)
+        ranked = sorted(
+            (user_id for user_id in self.counts if user_id not in excluded),
+            key=lambda user_id: (self.counts[user_id], self.last_seen[user_id]),
+            reverse=True
+        )
+        return ranked[:top_k]
+
+    def history(self) -> StreamHistory:
+        """
+        以缓冲区中的消息构造聊天流历史消息，之后可以像批量画像一样直接从中过滤
+        返回的是当时缓冲区的副本，此后收到的消息不会影响已经构造的历史消息
+        """
+        return StreamHistory(self._records[self._start:])
+
+
+class LiveMessageIndex:
+    """
+    所有聊天流最近消息的内存索引，由收到消息的事件处理器维护
+    最多跟踪 max_streams 个聊天流，超出时丢弃最久没有新消息的聊天流
+    """
+
+    def __init__(self, capacity: int = 3000, max_streams: int = 20):
+        # 每个聊天流保留的消息条数
+        self.capacity = capacity
+        # 最多跟踪的聊天流数量
+        self.max_streams = max_streams
+        self._streams: "OrderedDict[str, StreamIndex]" = OrderedDict()
+
+    def add(self, stream_id: str, user_id: str, user_nickname: str, text: str,
+            message_time: Optional[float] = None) -> None:
+        """
+        记录一条新消息
+        :param stream_id: 聊天流ID
+        :param user_id: 发送者的用户ID
+        :param user_nickname: 发送者的QQ昵称
+        :param text: 消息的纯文本内容
+        :param message_time: 消息时间，省略时使用当前时间
+        """
+        if self.capacity <= 0:
+            return
+        now = time.time()
+        stream = self._streams.get(stream_id)
+        if stream is None:
+            stream = self._streams[stream_id] = StreamIndex(self.capacity, now)
+            if 0 < self.max_streams < len(self._streams):
+                evicted, _ = self._streams.popitem(last=False)
+                logger.debug(f"内存索引跟踪的聊天流超过 {self.max_streams} 个，已丢弃聊天流 {evicted}")
+        else:
+            self._streams.move_to_end(stream_id)
+        stream.append(MessageRecord(now if message_time is None else message_time, stream_id, user_id,
+                                    user_nickname, text))
+
+    def get(self, stream_id: str) -> Optional[StreamIndex]:
+        """聊天流的内存索引，没有收到过该聊天流的消息时为 None"""
+        return self._streams.get(stream_id)
+
+    def clear(self) -> None:
+        self._streams.clear()
+
+
+live_message_index = LiveMessageIndex()
@@ -0,0 +1,104 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.common.logger import get_logger
+from src.plugin_system import llm_api
+
+from .encoding import DAY_HEADER_PREFIX
+from .token_budget import estimate_tokens
+
+logger = get_logger("portrayal_plugin")
+
+
+def count_messages(lines: List[str]) -> int:
+    """聊天记录中的消息条数，不计紧凑格式的日期行"""
+    return sum(1 for line in lines if not line.startswith(DAY_HEADER_PREFIX))
+
+
+def split_lines(lines: List[str], segment_token_budget: int) -> List[List[str]]:
+    """
+    按token预算把聊天记录切分为连续的若干段，单行超过预算时独占一段
+    紧凑格式下，不以日期行开头的分段会在开头补上所在日期的日期行
+    :param lines: 按时间升序排列的聊天记录
+    :param segment_token_budget: 每段聊天记录的token预算
+    :return: 切分后的聊天记录段
+    """
+    segments: List[List[str]] = []
+    current: List[str] = []
+    used = 0
+    day_header: Optional[str] = None
+    for line in lines:
+        tokens = estimate_tokens(line) + 1
+        if current and used + tokens > segment_token_budget:
+            segments.append(current)
+            current = []
+            used = 0
+            if day_header is not None and not line.startswith(DAY_HEADER_PREFIX):
+                current.append(day_header)
+                used += estimate_tokens(day_header) + 1
+        if line.startswith(DAY_HEADER_PREFIX):
+            day_header = line
+        current.append(line)
+        used += tokens
+    if current:
+        segments.append(current)
+    return segments
+
+
+async def generate_portrait_map_reduce(
+        segments: List[List[str]],
+        map_prompt_template: str,
+        reduce_prompt_template: str,
+        prompt_variables: Dict[str, Any],
+        model_config: Any,
+        max_concurrency: int = 4,
+        llm: Any = llm_api) -> Tuple[bool, str, Optional[str]]:
+    """
+    分段生成画像：先并发分析每段聊天记录，再把各段的分析结果合并为最终画像
+
+    :param segments: 切分好的聊天记录段
+    :param map_prompt_template: 分析单段聊天记录的提示词，额外支持变量 {messages} {message_count} {segment_index} {segment_count}
+    :param reduce_prompt_template: 合并分析结果的提示词，额外支持变量 {partial_analyses} {segment_count} {message_count}
+    :param prompt_variables: 两个提示词共用的变量
+    :param model_config: 模型配置
+    :param max_concurrency: 同时分析的最大段数
+    :param llm: 提供 generate_with_model 的对象，默认为 llm_api
+    :return: 是否成功、最终画像或错误信息、最终画像使用的模型名称
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    segment_count = len(segments)
+
+    async def analyse(index: int, segment: List[str]) -> Optional[str]:
+        prompt = map_prompt_template.format(
+            messages="\n".join(segment),
+            message_count=count_messages(segment),
+            segment_index=index + 1,
+            segment_count=segment_count,
+            **prompt_variables
+        )
+        async with semaphore:
+            success, response, _, _ = await llm.generate_with_model(prompt, model_config=model_config)
+        if not success:
+            logger.warning(f"第 {index + 1}/{segment_count} 段聊天记录分析失败: {response}")
+            return None
+        return response
+
+    partials = await asyncio.gather(*(analyse(index, segment) for index, segment in enumerate(segments)))
+    succeeded = [(index, partial) for index, partial in enumerate(partials) if partial]
+    if not succeeded:
+        return False, "所有分段的分析均失败", None
+    logger.debug(f"分段分析完成，成功 {len(succeeded)}/{segment_count} 段")
+
+    partial_analyses = "\n\n".join(
+        f"### 第 {index + 1} 段（共 {count_messages(segments[index])} 条消息）\n{partial}" for index, partial in succeeded
+    )
+    prompt = reduce_prompt_template.format(
+        partial_analyses=partial_analyses,
+        segment_count=len(succeeded),
+        message_count=sum(count_messages(segments[index]) for index, _ in succeeded),
+        **prompt_variables
+    )
+    success, response, _, model_name = await llm.generate_with_model(prompt, model_config=model_config)
+    if not success:
+        return False, response, None
+    return True, response, model_name
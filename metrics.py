@@ -0,0 +1,209 @@
+import json
+import math
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+from src.common.logger import get_logger
+
+logger = get_logger("character_sketch_plugin")
+
+T = TypeVar("T")
+
+# 每项指标保留的最近样本数
+DEFAULT_WINDOW = 200
+
+# 阶段名称及其显示名称，按画像生成的先后顺序排列
+STAGE_NAMES: Dict[str, str] = {
+    "retrieval": "检索消息",
+    "filter": "筛选上下文",
+    "prepare": "清洗与解析名称",
+    "format": "格式化提示词",
+    "llm": "模型调用",
+    "total": "总耗时",
+}
+
+# 计数指标及其显示名称
+COUNTER_NAMES: Dict[str, str] = {
+    "window_days": "检索天数",
+    "rows_probed": "确定检索范围时读取的消息数",
+    "rows_fetched": "读取消息数",
+    "rows_from_index": "从内存索引读取的消息数",
+    "rows_kept": "保留消息数",
+    "lines": "输出行数",
+    "merged": "合并的重复消息数",
+    "prompt_chars": "提示词字符数",
+    "prompt_tokens": "提示词估算tokens",
+}
+
+
+def _pick(ordered: List[float], p: float) -> float:
+    """在已排序的样本中按最近邻秩法取百分位数"""
+    return ordered[max(1, math.ceil(p / 100 * len(ordered))) - 1]
+
+
+class RollingStats:
+    """保留最近若干个样本，用于计算滚动百分位数"""
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def add(self, value: float) -> None:
+        self.samples.append(value)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """
+        按最近邻秩法计算百分位数
+        :param p: 百分位，取值 0-100
+        :return: 百分位数，没有样本时返回 None
+        """
+        if not self.samples:
+            return None
+        return _pick(sorted(self.samples), p)
+
+    def summary(self) -> Dict[str, float]:
+        """样本数以及 p50、p90、p99 和最大值"""
+        if not self.samples:
+            return {"count": 0}
+        ordered = sorted(self.samples)
+        return {
+            "count": len(ordered),
+            "p50": _pick(ordered, 50),
+            "p90": _pick(ordered, 90),
+            "p99": _pick(ordered, 99),
+            "max": ordered[-1],
+        }
+
+
+class PortraitMetrics:
+    """汇总每次画像生成的各阶段耗时和计数，只保存在内存中"""
+
+    def __init__(self, window: int = DEFAULT_WINDOW):
+        self.window = window
+        self.stages: Dict[str, RollingStats] = {}
+        self.counters: Dict[str, RollingStats] = {}
+        # 各种结果的累计次数
+        self.outcomes: Counter = Counter()
+
+    def record(self, trace: "RunTrace") -> None:
+        for name, seconds in trace.durations.items():
+            self.stages.setdefault(name, RollingStats(self.window)).add(seconds)
+        for name, value in trace.counts.items():
+            self.counters.setdefault(name, RollingStats(self.window)).add(value)
+        self.outcomes[trace.outcome] += 1
+
+    def format_report(self) -> str:
+        """生成给管理员查看的统计报告"""
+        total_runs = sum(self.outcomes.values())
+        if not total_runs:
+            return "暂无画像生成记录。"
+        lines: List[str] = [
+            f"画像生成统计（累计 {total_runs} 次，百分位基于最近 {self.window} 次）",
+            "结果：" + "，".join(f"{name} {count} 次" for name, count in self.outcomes.most_common()),
+            "",
+            "阶段耗时(ms)：次数 / p50 / p90 / p99 / 最大",
+        ]
+        for name, display_name in STAGE_NAMES.items():
+            stats = self.stages.get(name)
+            if stats is None or not stats.samples:
+                continue
+            summary = stats.summary()
+            lines.append(
+                f"{display_name}：{summary['count']} / {summary['p50'] * 1000:.0f} / {summary['p90'] * 1000:.0f} / "
+                f"{summary['p99'] * 1000:.0f} / {summary['max'] * 1000:.0f}"
+            )
+        lines.append("")
+        lines.append("计数：p50 / p90 / 最大")
+        for name, display_name in COUNTER_NAMES.items():
+            stats = self.counters.get(name)
+            if stats is None or not stats.samples:
+                continue
+            summary = stats.summary()
+            lines.append(f"{display_name}：{summary['p50']:.0f} / {summary['p90']:.0f} / {summary['max']:.0f}")
+        return "\n".join(lines)
+
+
+class RunTrace:
+    """
+    一次画像生成的计时和计数
+    阶段可以嵌套，例如边检索边筛选时，检索消耗的时间只计入检索阶段，不会重复计入筛选阶段
+    """
+
+    def __init__(self, target_user_id: str, stream_id: str):
+        self.target_user_id = target_user_id
+        self.stream_id = stream_id
+        self.durations: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.outcome = "unknown"
+        self._started_at = time.perf_counter()
+        self._stack: List[str] = []
+        self._mark = self._started_at
+
+    def _enter(self, name: str) -> None:
+        now = time.perf_counter()
+        if self._stack:
+            self._add_time(self._stack[-1], now - self._mark)
+        self._stack.append(name)
+        self._mark = now
+
+    def _exit(self) -> None:
+        now = time.perf_counter()
+        self._add_time(self._stack.pop(), now - self._mark)
+        self._mark = now
+
+    def _add_time(self, name: str, seconds: float) -> None:
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        """计时一个阶段，用法: with trace.stage("llm"): ..."""
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def timed_iter(self, name: str, iterable: Iterable[T], counter: Optional[str] = None) -> Iterator[T]:
+        """
+        包装一个惰性的迭代器，把每次取下一个元素的耗时计入指定阶段
+        :param counter: 统计产出元素个数的计数名称，省略时不统计
+        """
+        iterator = iter(iterable)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            if counter:
+                self.count(counter)
+            yield item
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def set_count(self, name: str, value: int) -> None:
+        self.counts[name] = value
+
+    def finish(self, outcome: str, metrics: Optional[PortraitMetrics] = None) -> None:
+        """
+        结束计时，汇总到统计中并输出一行结构化的调试日志
+        :param outcome: 本次生成的结果
+        :param metrics: 汇总统计，默认为 portrait_metrics
+        """
+        self.outcome = outcome
+        self.durations["total"] = time.perf_counter() - self._started_at
+        (metrics or portrait_metrics).record(self)
+        logger.debug("画像生成统计 " + json.dumps({
+            "target_user_id": self.target_user_id,
+            "stream_id": self.stream_id,
+            "outcome": outcome,
+            "stages_ms": {name: round(seconds * 1000, 1) for name, seconds in self.durations.items()},
+            "counts": self.counts,
+        }, ensure_ascii=False))
+
+
+portrait_metrics = PortraitMetrics()
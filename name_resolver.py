@@ -0,0 +1,74 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from src.common.logger import get_logger
+from src.plugin_system import person_api
+
+logger = get_logger("portrayal_plugin")
+
+
+class PersonNameResolver:
+    """
+    用户ID到人物名称的解析器，在所有命令调用之间共享一个带过期时间的LRU缓存
+    未命中缓存的用户会被一次性收集后并发查询，而不是逐条等待
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = 600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    def get_cached(self, user_id: str) -> Optional[str]:
+        """从缓存中获取人物名称，不存在或已过期时返回 None"""
+        entry = self._cache.get(user_id)
+        if entry is None:
+            return None
+        name, expire_at = entry
+        if expire_at < time.monotonic():
+            del self._cache[user_id]
+            return None
+        self._cache.move_to_end(user_id)
+        return name
+
+    def put(self, user_id: str, name: str) -> None:
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        if self.ttl <= 0 or not name:
+            return
+        self._cache[user_id] = (name, time.monotonic() + self.ttl)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    async def resolve_many(self, users: Dict[str, str]) -> Dict[str, str]:
+        """
+        批量解析人物名称
+        :param users: 用户ID到QQ昵称的映射，查询不到人物名称时使用QQ昵称
+        :return: 用户ID到人物名称的映射
+        """
+        result: Dict[str, str] = {}
+        missing = []
+        for user_id, nickname in users.items():
+            name = self.get_cached(user_id)
+            if name:
+                result[user_id] = name
+            else:
+                missing.append((user_id, nickname))
+        if not missing:
+            return result
+        names = await asyncio.gather(*(self._lookup(user_id, nickname) for user_id, nickname in missing))
+        for (user_id, nickname), name in zip(missing, names):
+            name = name or nickname
+            result[user_id] = name
+            self.put(user_id, name)
+        logger.debug(f"解析人物名称 {len(users)} 个，其中缓存命中 {len(users) - len(missing)} 个")
+        return result
+
+    @staticmethod
+    async def _lookup(user_id: str, nickname: str) -> Optional[str]:
+        person_id = person_api.get_person_id('qq', user_id)
+        return await person_api.get_person_value(person_id, "person_name", nickname)
+
+
+person_name_resolver = PersonNameResolver()
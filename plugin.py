@@ -7,7 +7,18 @@ from src.plugin_system import (
     ComponentInfo,
     ConfigField
 )
+from .components.group_portrait_command import GroupPortraitCommand
+from .components.live_index_handler import LiveIndexHandler
+from .components.portrait_history_command import PortraitHistoryCommand
+from .components.portrait_stats_command import PortraitStatsCommand
 from .components.portrayal_command import PortrayalCommand
+from .components.prewarm_handler import PrewarmStartHandler, PrewarmStopHandler
+from .concurrency import portrait_limiter
+from .hedging import llm_runner
+from .live_index import live_message_index
+from .name_resolver import person_name_resolver
+from .portrait_store import portrait_store
+from .sanitizer import DEFAULT_SANITIZE_RULES, message_sanitizer
 
 logger = get_logger("character_sketch_plugin")
 
@@ -25,6 +36,16 @@ class PortrayalPlugin(BasePlugin):
         "character_sketch_plugin": "画像插件配置",
         # llm配置
         "llm_config": "LLM模型配置",
+        # 分段画像
+        "map_reduce": "分段画像配置，聊天记录过长时分段并发分析后再合并",
+        # 画像预生成
+        "prewarm": "画像预生成配置，在空闲时段为活跃用户预先生成画像",
+        # 群画像
+        "batch": "群画像配置，/群画像 命令一次为多位用户生成画像",
+        # 内存消息索引
+        "live_index": "内存消息索引配置，在内存中保留每个聊天流最近的消息，画像时优先从内存读取",
+        # 并发限制
+        "concurrency": "并发限制，避免大量画像请求同时执行",
         # 权限设置
         "permissions": "权限设置，定义哪些用户可以使用插件功能",
     }  # 配置文件各节描述
@@ -52,7 +73,69 @@ class PortrayalPlugin(BasePlugin):
             "retrieval_message_count": ConfigField(
                 type=int,
                 default=30000,
-                description="生成用户画像时检索的最大消息记录条数。用于从数据库中读取消息并从中筛选。请注意性能消耗",
+                description="生成用户画像时检索的最大消息记录条数。用于从数据库中读取消息并从中筛选，两阶段检索读取的上下文消息同样受该值限制。请注意性能消耗",
+            ),
+            # 最多检索最近多少天的消息
+            "max_retrieval_days": ConfigField(
+                type=int,
+                default=90,
+                description="生成画像时最多检索最近多少天的消息。跨聊天流画像和群画像同样适用",
+            ),
+            # 是否自适应地确定检索范围
+            "adaptive_retrieval": ConfigField(
+                type=bool,
+                default=True,
+                description="是否自适应地确定检索范围。启用后依次尝试最近 1、3、7、30、90 天（不超过 max_retrieval_days），目标用户的消息足够填满 max_message_count 时立即停止扩大，活跃的用户只需读取最近几天的消息，不活跃的用户也能向前追溯足够远。关闭时总是检索最近 max_retrieval_days 天。selection_mode 为 informative 时不使用，总是在最近 max_retrieval_days 天内挑选",
+            ),
+            # 消息检索方式 two_phase（两阶段检索）或 full（全量检索）
+            "retrieval_mode": ConfigField(
+                type=str,
+                choices=['two_phase', 'full'],
+                default="two_phase",
+                description="消息检索方式。two_phase（两阶段检索）先只查询目标用户的消息，再按时间范围查询其上下文，读取的消息远少于全量检索；full（全量检索）读取聊天流中最近 retrieval_message_count 条消息后再筛选。跨聊天流（全部）画像始终在各个聊天流中分别使用两阶段检索",
+            ),
+            # 消息挑选方式
+            "selection_mode": ConfigField(
+                type=str,
+                choices=['latest', 'informative'],
+                default="latest",
+                description="消息挑选方式。latest 保留最近的消息；informative 读取最近 retrieval_message_count 条消息，在整个检索范围内按消息长度、用词新颖度、时间分布和引起的互动挑选信息量最高的目标用户消息及其上下文，可以用更少的消息得到更全面的画像。informative 不适用于跨聊天流（全部）画像",
+            ),
+            # 跨聊天流画像时最多检索的聊天流数量
+            "cross_stream_max_streams": ConfigField(
+                type=int,
+                default=10,
+                description="跨聊天流（全部）画像时，只检索目标用户发言最多的若干个聊天流，各聊天流按目标用户的发言数分配消息条数。0表示不限制",
+            ),
+            # 跨聊天流画像时同时检索的聊天流数量
+            "cross_stream_concurrency": ConfigField(
+                type=int,
+                default=4,
+                description="跨聊天流（全部）画像时同时检索的聊天流数量",
+            ),
+            # 分页读取消息时每次向数据库查询的消息条数
+            "retrieval_chunk_size": ConfigField(
+                type=int,
+                default=2000,
+                description="全量检索时按时间倒序分页读取消息，每页读取的消息条数。凑够 max_message_count 条有效消息后会立即停止读取，内存占用只与该值有关。按信息量挑选和群画像读取大量消息时也按该值分页，每页立即转换为轻量记录",
+            ),
+            # 两阶段检索时合并相邻目标用户消息的最大时间间隔 单位秒
+            "context_merge_gap": ConfigField(
+                type=float,
+                default=600,
+                description="两阶段检索时，间隔不超过该秒数的目标用户消息会被合并为一个时间段，按时间范围一次性查询段内的全部消息。调大可减少查询次数，但会读取更多无关消息",
+            ),
+            # 两阶段检索时最多查询的时间段数量
+            "context_max_segments": ConfigField(
+                type=int,
+                default=100,
+                description="两阶段检索时最多查询多少个时间段，从最近的时间段开始，每个时间段最多需要3次查询。两阶段检索读取的消息总数同样受 retrieval_message_count 限制。0表示不限制",
+            ),
+            # 人物名称缓存的有效期 单位秒
+            "name_cache_ttl": ConfigField(
+                type=float,
+                default=600,
+                description="人物名称缓存的有效期，单位秒。整理聊天记录时解析出的人物名称会在多次命令之间共享，0表示不缓存",
             ),
             # 生成画像时的单条消息最大字数限制，超过这个字数的消息会被截断 0表示不限制
             "max_message_length": ConfigField(
@@ -60,6 +143,49 @@ class PortrayalPlugin(BasePlugin):
                 default=200,
                 description="生成画像时的单条消息最大字数限制，超过这个字数的消息会被截断。0表示不限制。",
             ),
+            # 是否合并连续的重复消息
+            "compact_repeats": ConfigField(
+                type=bool,
+                default=True,
+                description="是否把连续的重复消息（复读、刷屏、几乎相同的消息）合并为一行并标注重复次数，如“哈哈哈 (×12)”，以节省提示词token。目标用户自己的不同发言不会被合并",
+            ),
+            # 判定近似重复消息的相似度阈值
+            "compact_similarity": ConfigField(
+                type=float,
+                default=0.8,
+                description="判定两条连续消息近似重复的相似度阈值（0-1），忽略标点和连续重复的字后按相邻二字组计算相似度。1表示只合并完全相同的消息",
+            ),
+            # 聊天记录的格式 full 完整格式 compact 紧凑格式
+            "message_format": ConfigField(
+                type=str,
+                default="full",
+                choices=['full', 'compact'],
+                description="发送给LLM的聊天记录格式。full：每行为“[年-月-日 时:分:秒] 发言人: 内容”；compact：紧凑格式，发言人使用A、B、C等代号并附发言人列表，日期按天单独成行，每行只保留时分，目标用户的发言以 * 开头，可节省约两成token。提示词中没有 {speaker_legend} 时会自动在 {messages} 之前插入格式说明和发言人列表",
+            ),
+            # 消息清洗规则 remove 删除匹配的内容，drop 丢弃整条消息
+            "sanitize_rules": ConfigField(
+                type=list,
+                item_type="object",
+                item_fields={
+                    "pattern": {
+                        "type": "string",
+                        "label": "正则表达式",
+                        "placeholder": "匹配需要清洗的内容的正则表达式"
+                    },
+                    "action": {
+                        "type": "string",
+                        "label": "处理方式",
+                        "placeholder": "remove（删除匹配的内容）或 drop（丢弃整条消息）"
+                    },
+                    "description": {
+                        "type": "string",
+                        "label": "描述",
+                        "placeholder": "可选，对该规则的简短描述，仅便于查看，不会影响功能"
+                    },
+                },
+                default=[dict(rule) for rule in DEFAULT_SANITIZE_RULES],
+                description="整理聊天记录时使用的消息清洗规则。action 为 remove 时删除消息中匹配的内容，为 drop 时丢弃整条消息。所有规则会在插件加载时合并编译，请尽量使用非贪婪匹配",
+            ),
             # 生成用户画像时使用的提示词
             # 支持变量：
             # 用户昵称:{person_name}
@@ -68,11 +194,49 @@ class PortrayalPlugin(BasePlugin):
             # 消息内容 {messages}
             # 上文消息数量 {context_length}
             # 下文消息数量 {context_length_after}
+            # 聊天记录格式说明 {message_format}
+            # 发言人列表 {speaker_legend}（仅紧凑格式）
             "prompt_template": ConfigField(
                 type=str,
                 input_type="textarea",
-                default="# Role\n你是一位拥有敏锐洞察力的资深心理侧写师和AI人格架构师。你擅长通过零散的聊天记录，精准捕捉人物的性格底色、说话习惯和社交属性。你的分析既专业又带有娱乐性，能够通过字里行间发现用户的“灵魂本质”。\n\n# Context\n我需要你分析群聊用户「{person_name}」（QQ昵称：{user_nickname}）。\n为了帮助你理解语境，我提供了该用户发送的消息，以及每条消息前 {context_length} 条和后 {context_length_after} 条的上下文消息。\n**注意**：\n1. 聊天记录中的图片已被过滤，请忽略图片缺失带来的影响。\n2. 聊天记录有限，请关注**重复出现的模式**（如口癖、情绪倾向、对待他人的态度），避免因单句脱离语境的发言而产生“过拟合”的误判。\n3. 区分“目标用户发言”与“他人发言”，他人发言仅作为理解语境的参考。\n\n# Task\n请基于提供的聊天记录，完成以下两个任务：\n\n## 任务一：全方位用户画像 (Profile Analysis)\n请生成一份详细的分析报告，包含以下维度：\n1.  **核心性格 (MBTI推测)**：推测其MBTI倾向，并用3个关键词概括性格（如：傲娇、老好人、乐子人）。\n2.  **语言风格 (Linguistic Style)**：分析其用词习惯、标点使用（是否爱用波浪号、句号等）、常用梗、语气助词（如：捏、喵、卧槽）。\n3.  **社交生态 (Social Role)**：在群里的定位（如：群主、潜水员、话题终结者、复读机、捧哏）。\n4.  **兴趣与能力 (Interests & Abilities)**：根据聊天内容推断其爱好、擅长的领域或经常讨论的话题。\n5.  **潜在弱点/槽点 (Roast)**：以幽默/调侃的语气指出该用户的一个可爱缺点或槽点。\n\n## 任务二：AI克隆指令\n基于以上分析，使用中文编写一段**高质量的System Prompt**，用于指导另一个AI完美扮演该用户。该Prompt应该包含人物设定、对话规则。\n\n# Input Data\n--- 聊天记录开始 ---\n{messages}\n--- 聊天记录结束 ---\n\n# Output Requirement\n请先输出【任务一】的分析结果，风格要生动、幽默，符合娱乐向定位。\n然后在一个 **Markdown代码块** 中输出【任务二】的Prompt。",
-                description="生成用户画像时使用的提示词 支持变量：用户昵称 {person_name} 用户QQ昵称 {user_nickname} 消息数量 {message_count} 消息内容 {messages} 上文消息数量 {context_length} 下文消息数量 {context_length_after}",
+                default="# Role\n你是一位拥有敏锐洞察力的资深心理侧写师和AI人格架构师。你擅长通过零散的聊天记录，精准捕捉人物的性格底色、说话习惯和社交属性。你的分析既专业又带有娱乐性，能够通过字里行间发现用户的“灵魂本质”。\n\n# Context\n我需要你分析群聊用户「{person_name}」（QQ昵称：{user_nickname}）。\n为了帮助你理解语境，我提供了该用户发送的消息，以及每条消息前 {context_length} 条和后 {context_length_after} 条的上下文消息。\n**注意**：\n1. 聊天记录中的图片已被过滤，请忽略图片缺失带来的影响。\n2. 聊天记录有限，请关注**重复出现的模式**（如口癖、情绪倾向、对待他人的态度），避免因单句脱离语境的发言而产生“过拟合”的误判。\n3. 区分“目标用户发言”与“他人发言”，他人发言仅作为理解语境的参考。\n\n# Task\n请基于提供的聊天记录，完成以下两个任务：\n\n## 任务一：全方位用户画像 (Profile Analysis)\n请生成一份详细的分析报告，包含以下维度：\n1.  **核心性格 (MBTI推测)**：推测其MBTI倾向，并用3个关键词概括性格（如：傲娇、老好人、乐子人）。\n2.  **语言风格 (Linguistic Style)**：分析其用词习惯、标点使用（是否爱用波浪号、句号等）、常用梗、语气助词（如：捏、喵、卧槽）。\n3.  **社交生态 (Social Role)**：在群里的定位（如：群主、潜水员、话题终结者、复读机、捧哏）。\n4.  **兴趣与能力 (Interests & Abilities)**：根据聊天内容推断其爱好、擅长的领域或经常讨论的话题。\n5.  **潜在弱点/槽点 (Roast)**：以幽默/调侃的语气指出该用户的一个可爱缺点或槽点。\n\n## 任务二：AI克隆指令\n基于以上分析，使用中文编写一段**高质量的System Prompt**，用于指导另一个AI完美扮演该用户。该Prompt应该包含人物设定、对话规则。\n\n# Input Data\n{message_format}\n--- 聊天记录开始 ---\n{messages}\n--- 聊天记录结束 ---\n\n# Output Requirement\n请先输出【任务一】的分析结果，风格要生动、幽默，符合娱乐向定位。\n然后在一个 **Markdown代码块** 中输出【任务二】的Prompt。",
+                description="生成用户画像时使用的提示词 支持变量：用户昵称 {person_name} 用户QQ昵称 {user_nickname} 消息数量 {message_count} 消息内容 {messages} 上文消息数量 {context_length} 下文消息数量 {context_length_after} 聊天记录格式说明 {message_format} 发言人列表 {speaker_legend}（仅紧凑格式）",
+            ),
+            # 是否启用增量画像 再次为同一用户画像时只把上次的画像和此后的新消息发送给llm
+            "incremental_update": ConfigField(
+                type=bool,
+                default=True,
+                description="是否启用增量画像。启用后再次为同一聊天流中的同一用户画像时，只会把上次的画像和此后的新消息发送给LLM进行更新，可大幅减少token消耗和等待时间。使用 /画像刷新 时忽略上次的画像，从头重新生成",
+            ),
+            # 画像缓存有效期 单位秒
+            "portrait_cache_ttl": ConfigField(
+                type=int,
+                default=43200,
+                description="画像缓存有效期，单位秒。在有效期内再次请求同一用户的画像时直接返回上次生成的结果，不调用LLM；在命令中的“画像”后加上“刷新”（如 /画像刷新 @某人）可忽略缓存和上次的画像，从头重新生成。0表示不缓存",
+            ),
+            # 每个用户在每个聊天流中最多保留的画像版本数
+            "max_portrait_versions": ConfigField(
+                type=int,
+                default=20,
+                description="每个用户在每个聊天流中最多保留的画像版本数，超出后删除最旧的版本，0表示不限制。画像保存在插件目录下的 data/portraits.db 中，可以通过 /画像历史 和 /画像版本N 命令查看",
+            ),
+            # 增量更新画像时使用的提示词
+            # 支持变量：
+            # 用户昵称:{person_name}
+            # 用户QQ昵称:{user_nickname}
+            # 上次的画像 {previous_portrait}
+            # 上次画像的生成时间 {previous_time}
+            # 新增消息数量 {message_count}
+            # 新增消息内容 {messages}
+            # 上文消息数量 {context_length}
+            # 下文消息数量 {context_length_after}
+            # 聊天记录格式说明 {message_format}
+            # 发言人列表 {speaker_legend}（仅紧凑格式）
+            "update_prompt_template": ConfigField(
+                type=str,
+                input_type="textarea",
+                default="# Role\n你是一位拥有敏锐洞察力的资深心理侧写师和AI人格架构师。你擅长通过零散的聊天记录，精准捕捉人物的性格底色、说话习惯和社交属性。\n\n# Context\n你曾在 {previous_time} 为群聊用户「{person_name}」（QQ昵称：{user_nickname}）生成过一份画像。此后该用户又产生了新的聊天记录。\n为了帮助你理解语境，我提供了该用户新发送的消息，以及每条消息前 {context_length} 条和后 {context_length_after} 条的上下文消息。\n**注意**：\n1. 聊天记录中的图片已被过滤，请忽略图片缺失带来的影响。\n2. 新的聊天记录只是补充，请在原画像的基础上进行修正和补充，不要因为少量新消息而推翻原有的整体判断。\n3. 区分“目标用户发言”与“他人发言”，他人发言仅作为理解语境的参考。\n\n# 上次的画像\n--- 画像开始 ---\n{previous_portrait}\n--- 画像结束 ---\n\n# 新增的聊天记录\n{message_format}\n--- 聊天记录开始 ---\n{messages}\n--- 聊天记录结束 ---\n\n# Output Requirement\n请按照上次画像的结构输出更新后的完整画像：先输出【任务一】全方位用户画像的分析结果，风格要生动、幽默，符合娱乐向定位。\n然后在一个 **Markdown代码块** 中输出更新后的【任务二】AI克隆指令。",
+                description="增量更新画像时使用的提示词 支持变量：用户昵称 {person_name} 用户QQ昵称 {user_nickname} 上次的画像 {previous_portrait} 上次画像的生成时间 {previous_time} 新增消息数量 {message_count} 新增消息内容 {messages} 上文消息数量 {context_length} 下文消息数量 {context_length_after} 聊天记录格式说明 {message_format} 发言人列表 {speaker_legend}（仅紧凑格式）",
             ),
         },
         "llm_config": {
@@ -96,6 +260,31 @@ class PortrayalPlugin(BasePlugin):
                 default=20000,
                 description="生成用户画像时使用的模型的最大输出token数，仅对手动设置的模型生效 请根据实际情况设置，避免超过模型限制",
             ),
+            # 没有单独设置token预算的模型使用的提示词token预算 0表示不限制
+            "default_token_budget": ConfigField(
+                type=int,
+                default=32000,
+                description="提示词（包含模板和聊天记录）的token预算，没有在下方单独设置预算的模型使用该值。聊天记录会从最新的开始装入，直到达到预算或 max_message_count。0表示不限制。token数为粗略估算",
+            ),
+            # 每个模型单独的提示词token预算
+            "token_budgets": ConfigField(
+                type=list,
+                item_type="object",
+                item_fields={
+                    "model": {
+                        "type": "string",
+                        "label": "模型名称",
+                        "placeholder": "模型管理中添加的模型的名称"
+                    },
+                    "token_budget": {
+                        "type": "integer",
+                        "label": "token预算",
+                        "placeholder": "该模型的提示词token预算"
+                    },
+                },
+                default=[{"model": "gemini-2.5-pro", "token_budget": 200000}],
+                description="为指定模型单独设置提示词token预算，可以按模型的上下文窗口设置。同时配置了多个模型时会使用其中最小的预算，因为每次请求可能选中其中任意一个模型",
+            ),
             # 生成用户画像时使用的模型的温度
             "temperature": ConfigField(
                 type=float,
@@ -113,7 +302,169 @@ class PortrayalPlugin(BasePlugin):
                 type=str,
                 choices=['balance', 'random'],
                 default="balance",
-                description="生成用户画像时使用的模型的选择策略，仅对手动设置的模型生效 balance（负载均衡）或 random（随机选择）",
+                description="生成用户画像时使用的模型的选择策略，仅对手动设置的模型生效 balance（负载均衡）或 random（随机选择）。配置了多个模型且启用 failover 或 hedge_delay 时，balance 按各模型最近的耗时和成功率决定请求顺序，random 每次随机排列请求顺序",
+            ),
+            # 请求失败时是否改用下一个模型
+            "failover": ConfigField(
+                type=bool,
+                default=True,
+                description="配置了多个模型时，请求失败后是否立即改用下一个模型重试。模型的请求顺序根据各模型最近的耗时和成功率自动调整：每个模型都有几次记录之前，以及之后每10次请求中的1次，按配置的顺序轮流以各个模型开头，其余时候优先请求预期耗时最短的模型，可以在 /画像统计 中查看",
+            ),
+            # 发起备用请求前等待的秒数 0表示不发起备用请求
+            "hedge_delay": ConfigField(
+                type=float,
+                default=0,
+                description="配置了多个模型时，请求超过该秒数仍未返回则同时向下一个模型发起备用请求，先成功返回的结果胜出，另一个请求会被取消。可以减少模型卡住时的等待，但会增加请求次数。0表示不发起备用请求",
+            ),
+        },
+        "map_reduce": {
+            # 是否启用分段画像
+            "enable": ConfigField(
+                type=bool,
+                default=False,
+                description="是否启用分段画像。启用后首次画像会使用下方的 max_message_count 读取更长的聊天记录，超过一段的token预算时切分为多段并发分析，再把各段的分析结果合并为最终画像。会增加请求次数，但耗时约等于分析一段的时间",
+            ),
+            # 分段画像时使用的最大消息记录条数
+            "max_message_count": ConfigField(
+                type=int,
+                default=5000,
+                description="分段画像时使用的最大消息记录条数，包含上下文消息。启用分段画像时代替基础配置中的 max_message_count",
+            ),
+            # 每段聊天记录的token预算
+            "segment_token_budget": ConfigField(
+                type=int,
+                default=16000,
+                description="每段聊天记录的token预算。不会超过模型配置中的token预算",
+            ),
+            # 同时分析的最大段数
+            "max_concurrency": ConfigField(
+                type=int,
+                default=4,
+                description="同时分析的最大段数，请根据模型的并发限制设置",
+            ),
+            # 分析单段聊天记录时使用的提示词
+            "map_prompt_template": ConfigField(
+                type=str,
+                input_type="textarea",
+                default="# Role\n你是一位拥有敏锐洞察力的资深心理侧写师。\n\n# Context\n我正在分段分析群聊用户「{person_name}」（QQ昵称：{user_nickname}）的聊天记录，这是第 {segment_index}/{segment_count} 段，共 {message_count} 条消息，包含该用户发送的消息，以及每条消息前 {context_length} 条和后 {context_length_after} 条的上下文消息。\n聊天记录中的图片已被过滤，他人发言仅作为理解语境的参考。\n\n# Task\n请只根据这一段聊天记录，简明地整理出关于该用户的观察要点：\n1. 性格特征与情绪倾向\n2. 语言风格（用词习惯、标点、口癖、常用梗、语气助词）\n3. 在群里的社交角色和对待他人的态度\n4. 兴趣爱好与擅长的领域\n5. 有趣的槽点\n请尽量引用原话作为依据，只输出观察要点，不要输出完整画像。\n\n{message_format}\n--- 聊天记录开始 ---\n{messages}\n--- 聊天记录结束 ---",
+                description="分析单段聊天记录时使用的提示词 支持变量：用户昵称 {person_name} 用户QQ昵称 {user_nickname} 本段消息内容 {messages} 本段消息数量 {message_count} 段序号 {segment_index} 总段数 {segment_count} 上文消息数量 {context_length} 下文消息数量 {context_length_after} 聊天记录格式说明 {message_format} 发言人列表 {speaker_legend}（仅紧凑格式）",
+            ),
+            # 合并各段分析结果时使用的提示词
+            "reduce_prompt_template": ConfigField(
+                type=str,
+                input_type="textarea",
+                default="# Role\n你是一位拥有敏锐洞察力的资深心理侧写师和AI人格架构师。你擅长通过零散的聊天记录，精准捕捉人物的性格底色、说话习惯和社交属性。你的分析既专业又带有娱乐性，能够通过字里行间发现用户的“灵魂本质”。\n\n# Context\n我把群聊用户「{person_name}」（QQ昵称：{user_nickname}）的 {message_count} 条聊天记录分为 {segment_count} 段，分别整理了观察要点。\n**注意**：请关注在多段中**重复出现的模式**，不要因为只在某一段出现的个别现象而产生误判。\n\n# 各段的观察要点\n{partial_analyses}\n\n# Task\n请综合以上观察要点，完成以下两个任务：\n\n## 任务一：全方位用户画像 (Profile Analysis)\n请生成一份详细的分析报告，包含以下维度：\n1.  **核心性格 (MBTI推测)**：推测其MBTI倾向，并用3个关键词概括性格（如：傲娇、老好人、乐子人）。\n2.  **语言风格 (Linguistic Style)**：分析其用词习惯、标点使用（是否爱用波浪号、句号等）、常用梗、语气助词（如：捏、喵、卧槽）。\n3.  **社交生态 (Social Role)**：在群里的定位（如：群主、潜水员、话题终结者、复读机、捧哏）。\n4.  **兴趣与能力 (Interests & Abilities)**：根据聊天内容推断其爱好、擅长的领域或经常讨论的话题。\n5.  **潜在弱点/槽点 (Roast)**：以幽默/调侃的语气指出该用户的一个可爱缺点或槽点。\n\n## 任务二：AI克隆指令\n基于以上分析，使用中文编写一段**高质量的System Prompt**，用于指导另一个AI完美扮演该用户。该Prompt应该包含人物设定、对话规则。\n\n# Output Requirement\n请先输出【任务一】的分析结果，风格要生动、幽默，符合娱乐向定位。\n然后在一个 **Markdown代码块** 中输出【任务二】的Prompt。",
+                description="合并各段分析结果时使用的提示词 支持变量：用户昵称 {person_name} 用户QQ昵称 {user_nickname} 各段的分析结果 {partial_analyses} 总段数 {segment_count} 总消息数量 {message_count} 上文消息数量 {context_length} 下文消息数量 {context_length_after} 聊天记录格式说明 {message_format} 发言人列表 {speaker_legend}（仅紧凑格式）",
+            ),
+        },
+        "prewarm": {
+            # 是否启用画像预生成
+            "enable": ConfigField(
+                type=bool,
+                default=False,
+                description="是否启用画像预生成。启用后会在下方设置的时段内找出每个群聊中最活跃的用户，在后台为他们生成或刷新画像，用户请求时可以直接返回结果。预生成的画像在基础配置的 portrait_cache_ttl 内有效，过期后才会重新生成",
+            ),
+            # 预生成时段的开始时间（小时）
+            "start_hour": ConfigField(
+                type=int,
+                default=3,
+                description="预生成时段的开始时间（小时，0-23）",
+            ),
+            # 预生成时段的结束时间（小时）
+            "end_hour": ConfigField(
+                type=int,
+                default=6,
+                description="预生成时段的结束时间（小时，0-23，不含）。可以跨越零点，例如 22 到 6；与开始时间相同表示全天",
+            ),
+            # 每个群聊预生成画像的用户数
+            "top_k": ConfigField(
+                type=int,
+                default=5,
+                description="每个群聊中为最活跃的多少个用户预生成画像",
+            ),
+            # 统计活跃度时使用的天数
+            "activity_days": ConfigField(
+                type=int,
+                default=7,
+                description="统计用户活跃度时使用最近多少天的消息",
+            ),
+            # 统计活跃度时最多读取的消息条数
+            "activity_message_count": ConfigField(
+                type=int,
+                default=5000,
+                description="统计用户活跃度时每个群聊最多读取的消息条数",
+            ),
+            # 两次预生成之间的间隔 单位秒
+            "interval": ConfigField(
+                type=float,
+                default=120,
+                description="两次预生成之间的间隔，单位秒，用于限制模型调用频率",
+            ),
+        },
+        "batch": {
+            # 是否仅限管理员使用 /群画像
+            "admin_only": ConfigField(
+                type=bool,
+                default=True,
+                description="/群画像 命令是否仅限管理员使用。一次群画像会调用多次LLM，消耗较多额度",
+            ),
+            # 未@任何人时画像的用户数
+            "default_top_k": ConfigField(
+                type=int,
+                default=5,
+                description="/群画像 没有@任何人且没有指定人数时，为当前聊天流中最活跃的多少位用户画像",
+            ),
+            # 一次群画像的最大人数
+            "max_targets": ConfigField(
+                type=int,
+                default=10,
+                description="一次群画像最多为多少位用户画像，0表示不限制",
+            ),
+            # 群画像时同时调用LLM的最大数量
+            "max_concurrency": ConfigField(
+                type=int,
+                default=2,
+                description="群画像时同时为多少位用户调用LLM。整个群画像只占用一个并发限制中的名额",
+            ),
+        },
+        "live_index": {
+            # 是否启用内存消息索引
+            "enable": ConfigField(
+                type=bool,
+                default=False,
+                description="是否在内存中记录收到的消息。画像对象在内存中已有足够的近期消息时直接从内存读取，不再查询数据库；/群画像 和画像预生成统计最活跃的用户时也优先使用内存中的记录。机器人自己发送的消息不会被记录，因此从内存读取时上下文中没有机器人的发言，提供给LLM的聊天记录与从数据库读取时不完全相同，默认关闭",
+            ),
+            # 每个聊天流保留的消息条数
+            "buffer_size": ConfigField(
+                type=int,
+                default=3000,
+                description="每个聊天流在内存中保留最近多少条消息，超出时丢弃最早的消息",
+            ),
+            # 最多记录的聊天流数量
+            "max_streams": ConfigField(
+                type=int,
+                default=20,
+                description="最多在内存中记录多少个聊天流，超出时丢弃最久没有新消息的聊天流，0表示不限制",
+            ),
+        },
+        "concurrency": {
+            # 全局同时执行的最大画像任务数
+            "max_global": ConfigField(
+                type=int,
+                default=2,
+                description="所有聊天流中同时执行的最大画像任务数，超出的请求会排队。0表示不限制。为同一用户在同一聊天流中的重复请求会共享同一个任务，不会重复占用名额",
+            ),
+            # 单个聊天流同时执行的最大画像任务数
+            "max_per_stream": ConfigField(
+                type=int,
+                default=1,
+                description="单个聊天流中同时执行的最大画像任务数，超出的请求会排队。0表示不限制",
+            ),
+            # 最大排队数
+            "max_queue": ConfigField(
+                type=int,
+                default=10,
+                description="最多允许排队的画像请求数，超出时直接提示稍后再试。0表示不限制",
             ),
         },
         "permissions": {
@@ -166,6 +517,32 @@ class PortrayalPlugin(BasePlugin):
         PortrayalCommand.permission_mode = permission_mode
         PortrayalCommand.user_id_list = user_id_list
         PortrayalCommand.admin_id_list = admin_id_list
-        return [
+        portrait_store.max_versions = self.config.get("character_sketch_plugin", {}).get("max_portrait_versions", 20)
+        person_name_resolver.ttl = self.config.get("character_sketch_plugin", {}).get("name_cache_ttl", 600)
+        concurrency_config = self.config.get("concurrency", {})
+        portrait_limiter.max_global = concurrency_config.get("max_global", 2)
+        portrait_limiter.max_per_stream = concurrency_config.get("max_per_stream", 1)
+        portrait_limiter.max_queue = concurrency_config.get("max_queue", 10)
+        llm_runner.failover = self.config.get("llm_config", {}).get("failover", True)
+        llm_runner.hedge_delay = self.config.get("llm_config", {}).get("hedge_delay", 0)
+        live_index_config = self.config.get("live_index", {})
+        live_message_index.capacity = live_index_config.get("buffer_size", 3000)
+        live_message_index.max_streams = live_index_config.get("max_streams", 20)
+        sanitize_rules = self.config.get("character_sketch_plugin", {}).get("sanitize_rules", DEFAULT_SANITIZE_RULES)
+        message_sanitizer.set_rules(sanitize_rules)
+        for rule in message_sanitizer.invalid_rules:
+            logger.warning(f"消息清洗规则无效，已跳过: {rule}")
+        components: List[Tuple[ComponentInfo, Type]] = [
             (PortrayalCommand.get_command_info(), PortrayalCommand),
+            (PortraitHistoryCommand.get_command_info(), PortraitHistoryCommand),
+            (PortraitStatsCommand.get_command_info(), PortraitStatsCommand),
+            (GroupPortraitCommand.get_command_info(), GroupPortraitCommand),
         ]
+        if live_index_config.get("enable", False):
+            components.append((LiveIndexHandler.get_handler_info(), LiveIndexHandler))
+        else:
+            live_message_index.clear()
+        if self.config.get("prewarm", {}).get("enable", False):
+            components.append((PrewarmStartHandler.get_handler_info(), PrewarmStartHandler))
+            components.append((PrewarmStopHandler.get_handler_info(), PrewarmStopHandler))
+        return components
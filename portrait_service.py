@@ -0,0 +1,414 @@
+import asyncio
+import math
+import time
+from typing import Any, Awaitable, Callable, Optional, Tuple
+
+from src.common.logger import get_logger
+from src.config.api_ada_configs import TaskConfig
+from src.config.config import global_config
+from src.plugin_system import llm_api
+
+from .concurrency import portrait_limiter
+from .encoding import describe_format, ensure_legend_placeholder
+from .hedging import llm_runner
+from .live_index import live_message_index
+from .map_reduce import generate_portrait_map_reduce, split_lines
+from .metrics import RunTrace
+from .portrait_store import PortraitRecord, portrait_store
+from .selection import select_informative_messages
+from .token_budget import estimate_tokens, resolve_token_budget
+from .utils import iter_messages_by_user_in_stream, iter_messages_with_context, \
+    prepare_portrayal_messages_stream, filter_messages_with_context, get_user_messages_with_context, \
+    gather_user_messages_across_streams, get_messages_paged, StreamHistory, find_retrieval_start, retrieval_windows
+
+logger = get_logger("character_sketch_plugin")
+
+# 读取插件配置的函数，与组件的 get_config 签名相同
+ConfigGetter = Callable[[str, Any], Any]
+# 发送提示文本的函数
+Notifier = Callable[[str], Awaitable[Any]]
+
+# 自适应检索时按该倍数多要求一些目标用户的消息：清洗后部分消息会被丢弃，相邻消息的上下文也可能重叠
+WINDOW_FILL_MARGIN = 1.5
+
+
+async def _ignore_notice(_: str) -> None:
+    pass
+
+
+def build_model_config(get_config: ConfigGetter) -> Tuple[Optional[TaskConfig], Optional[str]]:
+    """
+    根据插件配置构建生成画像使用的模型配置
+    :return: (模型配置, 错误信息)
+    """
+    llm_list = get_config("llm_config.llm_list", [])
+    if llm_list:
+        model_config = TaskConfig()
+        model_config.model_list = llm_list
+        model_config.max_tokens = get_config("llm_config.max_tokens", 20000)
+        model_config.temperature = get_config("llm_config.temperature", 0.7)
+        model_config.slow_threshold = get_config("llm_config.slow_threshold", 30)
+        model_config.selection_strategy = get_config("llm_config.selection_strategy", "balance")
+        return model_config, None
+    llm_group = get_config("llm_config.llm_group", "utils")
+    models = llm_api.get_available_models()
+    model_config = models.get(llm_group)
+    if not model_config:
+        return None, f"未找到可用的 {llm_group} 模型配置"
+    return model_config, None
+
+
+async def run_limited(stream_id: str, factory: Callable[[], Awaitable], notify: Optional[Notifier] = None) -> Any:
+    """在并发限制内执行画像任务，需要排队时先发送提示"""
+    if notify and portrait_limiter.would_wait(stream_id):
+        await notify(f"排队中，前面还有 {portrait_limiter.ahead_count()} 个画像请求，请稍候...")
+    async with portrait_limiter.slot(stream_id):
+        return await factory()
+
+
+def needed_target_messages(max_message_count: int, context_length: int, context_length_after: int) -> int:
+    """填满 max_message_count 条消息（包含上下文）大约需要的目标用户消息数，用于确定检索范围和判断内存索引是否足够"""
+    return max(1, math.ceil(max_message_count * WINDOW_FILL_MARGIN / (1 + context_length + context_length_after)))
+
+
+def load_stream_history(get_config: ConfigGetter, stream_id: str) -> StreamHistory:
+    """
+    读取聊天流中最近的 retrieval_message_count 条消息，供批量画像时多个画像对象共用
+    :param get_config: 读取插件配置的函数
+    :param stream_id: 聊天流ID
+    :return: 聊天流历史消息
+    """
+    end_time = time.time()
+    messages = get_messages_paged(
+        [],
+        end_time - 24 * 3600 * get_config("character_sketch_plugin.max_retrieval_days", 90),
+        end_time,
+        stream_id,
+        get_config("character_sketch_plugin.retrieval_message_count", 50000),
+        get_config("character_sketch_plugin.retrieval_chunk_size", 2000)
+    )
+    return StreamHistory(messages)
+
+
+async def generate_portrait(get_config: ConfigGetter, target_user_id: str, person_name: str, nickname: str,
+                            stream_id: str, model_config: TaskConfig, notify: Optional[Notifier] = None,
+                            history: Optional[StreamHistory] = None,
+                            refresh: bool = False) -> Tuple[Optional[str], Optional[str]]:
+    """
+    检索并整理聊天记录，调用LLM生成画像并保存
+    :param get_config: 读取插件配置的函数
+    :param target_user_id: 画像对象的用户ID
+    :param person_name: 画像对象的人物名称
+    :param nickname: 画像对象的QQ昵称
+    :param stream_id: 聊天流ID，为空表示所有聊天流
+    :param model_config: 模型配置
+    :param notify: 发送进度提示的函数，省略时不发送
+    :param history: 预先读取的聊天流历史消息，提供时不再检索，直接从中过滤出画像对象的消息和上下文，用于批量画像
+    :param refresh: 是否忽略之前的画像从头重新生成，为 False 时有之前的画像则增量更新
+    :return: (画像内容, 需要提示给用户的文本)，生成失败时均为 None
+    """
+    trace = RunTrace(target_user_id, stream_id)
+    try:
+        return await _generate_portrait(trace, get_config, target_user_id, person_name, nickname, stream_id,
+                                        model_config, notify or _ignore_notice, history, refresh)
+    except Exception:
+        trace.outcome = "异常"
+        raise
+    finally:
+        trace.finish(trace.outcome)
+
+
+async def _generate_portrait(trace: RunTrace, get_config: ConfigGetter, target_user_id: str, person_name: str,
+                             nickname: str, stream_id: str, model_config: TaskConfig, notify: Notifier,
+                             history: Optional[StreamHistory], refresh: bool) -> Tuple[Optional[str], Optional[str]]:
+    """generate_portrait 的实现，各阶段的耗时和计数记录在 trace 中，返回前设置 trace.outcome"""
+    prompt_template = get_config("character_sketch_plugin.prompt_template", None)
+    if not prompt_template:
+        logger.error("画像提示词为空")
+        trace.outcome = "配置错误"
+        return None, "画像提示词为空"
+    end_time = time.time()
+    max_retrieval_days = get_config("character_sketch_plugin.max_retrieval_days", 90)
+    adaptive_retrieval = get_config("character_sketch_plugin.adaptive_retrieval", True)
+    retrieval_message_count = get_config("character_sketch_plugin.retrieval_message_count", 50000)
+    context_length = get_config("character_sketch_plugin.context_length", 10)
+    context_length_after = get_config("character_sketch_plugin.context_length_after", 3)
+    max_message_count = get_config("character_sketch_plugin.max_message_count", 500)
+    max_message_length = get_config("character_sketch_plugin.max_message_length", 200)
+    retrieval_mode = get_config("character_sketch_plugin.retrieval_mode", "two_phase")
+    selection_mode = get_config("character_sketch_plugin.selection_mode", "latest")
+    retrieval_chunk_size = get_config("character_sketch_plugin.retrieval_chunk_size", 2000)
+    context_merge_gap = get_config("character_sketch_plugin.context_merge_gap", 600)
+    context_max_segments = get_config("character_sketch_plugin.context_max_segments", 100)
+    incremental_update = get_config("character_sketch_plugin.incremental_update", True)
+    update_prompt_template = get_config("character_sketch_plugin.update_prompt_template", None)
+    compact_repeats = get_config("character_sketch_plugin.compact_repeats", True)
+    compact_similarity = get_config("character_sketch_plugin.compact_similarity", 0.8)
+    message_format = get_config("character_sketch_plugin.message_format", "full")
+
+    # 如果之前为该用户生成过画像，则只检索此后的新消息进行增量更新；刷新时忽略之前的画像，从头重新生成
+    previous = None
+    if incremental_update and update_prompt_template and not refresh:
+        previous = portrait_store.get(target_user_id, stream_id)
+    if previous:
+        logger.debug(f"找到 {target_user_id} 的历史画像，仅检索 {previous.last_message_time} 之后的消息")
+
+    # 准备提示词模板和变量，并扣除模板自身占用的token，得到聊天记录可用的token预算
+    prompt_variables = {
+        "person_name": person_name,
+        "user_nickname": nickname,
+        "context_length": context_length,
+        "context_length_after": context_length_after,
+        "message_format": describe_format(message_format),
+        # 发言人列表在整理消息后才能确定，其token数已计入聊天记录的预算
+        "speaker_legend": "",
+    }
+    if previous:
+        template = update_prompt_template
+        prompt_variables["previous_portrait"] = previous.content
+        prompt_variables["previous_time"] = time.strftime("%Y-%m-%d %H:%M:%S",
+                                                          time.localtime(previous.created_at))
+    else:
+        template = prompt_template
+    if message_format == "compact":
+        template = ensure_legend_placeholder(template)
+    template_tokens = estimate_tokens(template.format(messages="", message_count=0, **prompt_variables))
+    token_budget = resolve_token_budget(
+        list(getattr(model_config, "model_list", []) or []),
+        get_config("llm_config.token_budgets", []),
+        get_config("llm_config.default_token_budget", 0)
+    )
+    message_token_budget = 0
+    if token_budget > 0:
+        message_token_budget = token_budget - template_tokens
+        if message_token_budget <= 0:
+            # 模板本身已超出预算时一条消息也放不下，不必再检索消息
+            logger.warning(f"提示词模板约 {template_tokens} tokens，已超过token预算 {token_budget}")
+            trace.outcome = "配置错误"
+            return None, f"提示词模板约 {template_tokens} tokens，超过token预算 {token_budget}，请精简提示词模板或调大token预算"
+    # 分段画像只用于首次画像，增量更新时新增的消息通常不多
+    map_reduce_enabled = get_config("map_reduce.enable", False) and not previous
+    if map_reduce_enabled:
+        max_message_count = get_config("map_reduce.max_message_count", 5000)
+        segment_token_budget = get_config("map_reduce.segment_token_budget", 16000)
+        if message_token_budget > 0:
+            segment_token_budget = min(segment_token_budget, message_token_budget)
+        # 聊天记录会被切分，不再受单次请求的token预算限制
+        message_token_budget = 0
+
+    # 确定检索的时间范围：从最近一天开始逐步扩大，直到目标用户的消息足够填满 max_message_count
+    earliest_time = previous.last_message_time if previous else None
+    needed = needed_target_messages(max_message_count, context_length, context_length_after)
+    # 按信息量挑选要在整个 max_retrieval_days 范围内挑选，不能因为目标用户最近的消息已经足够就缩小挑选范围
+    adaptive_retrieval = adaptive_retrieval and selection_mode != "informative"
+    from_index = False
+    if history is None and stream_id:
+        # 内存索引中已有需要的全部新消息，或者已有足够的目标用户消息时，直接从内存中读取，不再查询数据库
+        live = live_message_index.get(stream_id)
+        if live is not None and (live.covers(earliest_time) or (adaptive_retrieval and live.has_messages(
+                target_user_id, needed, earliest_time))):
+            history = live.history()
+            from_index = True
+            logger.debug(f"从内存索引读取聊天流 {stream_id} 最近的 {len(history.messages)} 条消息")
+    if history is not None:
+        # 批量画像共用的消息或内存索引中的消息已经在内存中，不再单独确定范围
+        start_time = earliest_time
+    else:
+        with trace.stage("retrieval"):
+            start_time, window_days, probed = find_retrieval_start(
+                target_user_id,
+                stream_id,
+                end_time,
+                retrieval_windows(max_retrieval_days, adaptive_retrieval),
+                needed,
+                earliest_time
+            )
+        trace.set_count("rows_probed", probed)
+        trace.set_count("window_days", math.ceil(window_days))
+        logger.debug(f"检索最近 {window_days:.1f} 天的消息，判断范围时读取了 {probed} 条消息")
+
+    # 获取用户在指定聊天流中的消息记录
+    if not stream_id:
+        # 跨聊天流画像：分别在目标用户活跃的各个聊天流中并发检索，上下文只取自同一个聊天流，最后按时间归并
+        with trace.stage("retrieval"):
+            messages = await gather_user_messages_across_streams(
+                target_user_id,
+                start_time,
+                end_time,
+                context_length,
+                context_length_after,
+                max_message_count * 2,
+                context_merge_gap,
+                get_config("character_sketch_plugin.cross_stream_max_streams", 10),
+                get_config("character_sketch_plugin.cross_stream_concurrency", 4),
+                retrieval_message_count,
+                context_max_segments
+            )
+        trace.set_count("rows_kept", len(messages))
+        candidates = reversed(messages)
+    elif history is not None:
+        # 批量画像或内存索引：从已有的聊天流历史消息中过滤，不再检索
+        trace.set_count("rows_from_index" if from_index else "rows_fetched", len(history.messages))
+        with trace.stage("filter"):
+            if selection_mode == "informative":
+                messages = select_informative_messages(
+                    history.since(start_time),
+                    target_user_id,
+                    context_length,
+                    context_length_after,
+                    max_message_count
+                )
+            else:
+                messages = history.filter_with_context(
+                    target_user_id,
+                    start_time,
+                    context_length,
+                    context_length_after,
+                    max_message_count * 2
+                )
+        trace.set_count("rows_kept", len(messages))
+        candidates = reversed(messages)
+    elif selection_mode == "informative":
+        # 读取整个检索范围内的消息，挑选信息量最高的目标用户消息及其上下文，而不是只取最近的消息
+        # 读取的消息较多，查询和挑选都在线程中执行以免阻塞事件循环
+        with trace.stage("retrieval"):
+            messages = await asyncio.to_thread(get_messages_paged, [], start_time, end_time, stream_id,
+                                               retrieval_message_count, retrieval_chunk_size)
+        trace.set_count("rows_fetched", len(messages))
+        with trace.stage("filter"):
+            messages = await asyncio.to_thread(
+                select_informative_messages,
+                messages,
+                target_user_id,
+                context_length,
+                context_length_after,
+                max_message_count
+            )
+        trace.set_count("rows_kept", len(messages))
+        candidates = reversed(messages)
+    elif retrieval_mode == "two_phase":
+        # 数据库查询是同步的，在线程中执行以免阻塞事件循环
+        with trace.stage("retrieval"):
+            messages = await asyncio.to_thread(
+                get_user_messages_with_context,
+                target_user_id,
+                start_time,
+                end_time,
+                stream_id,
+                context_length,
+                context_length_after,
+                max_message_count * 2,
+                context_merge_gap,
+                retrieval_message_count,
+                context_max_segments
+            )
+        trace.set_count("rows_fetched", len(messages))
+        # 过滤出画像对象的消息和上下文消息
+        with trace.stage("filter"):
+            messages = filter_messages_with_context(
+                messages,
+                target_user_id,
+                context_length,
+                context_length_after,
+                max_message_count * 2
+            )
+        trace.set_count("rows_kept", len(messages))
+        candidates = reversed(messages)
+    else:
+        # 按时间倒序分页读取消息，边读取边过滤出画像对象的消息和上下文消息，凑够需要的条数后立即停止读取
+        # 读取和筛选交替进行，分别计时，只统计实际被消费的消息
+        candidates = trace.timed_iter("filter", iter_messages_with_context(
+            trace.timed_iter("retrieval", iter_messages_by_user_in_stream(
+                [], start_time, end_time, stream_id, retrieval_chunk_size, retrieval_message_count
+            ), counter="rows_fetched"),
+            target_user_id,
+            context_length,
+            context_length_after
+        ), counter="rows_kept")
+    # 删除对画像生成无用的信息并整理消息内容为字符串列表
+    with trace.stage("prepare"):
+        prepared = await prepare_portrayal_messages_stream(
+            candidates,
+            max_message_count,
+            primary_user_id=target_user_id,
+            person_name_dict={
+                target_user_id: person_name,
+                global_config.bot.qq_account: global_config.bot.nickname
+            },
+            max_message_length=max_message_length,
+            token_budget=message_token_budget,
+            compact_similarity=compact_similarity if compact_repeats else 0,
+            message_format=message_format
+        )
+    lines = prepared.lines
+    trace.set_count("lines", len(lines))
+    trace.set_count("merged", prepared.merged_count)
+    primary_count = prepared.primary_count
+    other_count = prepared.other_count
+    latest_time = prepared.latest_time
+    # 紧凑格式的聊天记录中包含日期行，消息条数以实际保留的消息为准
+    message_count = primary_count + other_count
+    prompt_variables["speaker_legend"] = prepared.speaker_legend
+    if previous and (not lines or not primary_count):
+        # 上次画像之后目标用户没有新的有效发言，直接复用上次的画像
+        trace.outcome = "复用上次画像"
+        return previous.content, f"用户 {person_name} 自上次画像以来没有新的发言，以下为上次生成的画像。"
+    if latest_time is None:
+        trace.outcome = "没有消息"
+        return None, f"未找到用户 {person_name} 的消息记录，无法生成画像。"
+    if not lines:
+        trace.outcome = "没有消息"
+        return None, f"未找到有效的消息内容，无法生成画像。"
+
+    merged_notice = f"，另有 {prepared.merged_count} 条重复消息已合并" if prepared.merged_count else ""
+    segments = split_lines(lines, segment_token_budget) if map_reduce_enabled else [lines]
+    # 分段画像时为所有分段提示词的估算token数之和
+    prompt_tokens = template_tokens * len(segments) + prepared.token_count
+    trace.set_count("prompt_tokens", prompt_tokens)
+    if len(segments) > 1:
+        await notify(
+            f"使用了 {message_count} 条历史消息，其中目标用户 {primary_count} 条，上下文 {other_count} 条{merged_notice}，约 {prepared.token_count} tokens，分为 {len(segments)} 段分析。正在生成画像，请稍候...")
+        map_prompt_template = get_config("map_reduce.map_prompt_template", "")
+        if message_format == "compact":
+            map_prompt_template = ensure_legend_placeholder(map_prompt_template)
+        # 分段提示词在各分段的任务中格式化，耗时计入模型调用
+        with trace.stage("llm"):
+            success, response, model_name = await generate_portrait_map_reduce(
+                segments,
+                map_prompt_template,
+                get_config("map_reduce.reduce_prompt_template", ""),
+                prompt_variables,
+                model_config,
+                get_config("map_reduce.max_concurrency", 4),
+                llm_runner
+            )
+    else:
+        with trace.stage("format"):
+            prompt = template.format(messages="\n".join(lines), message_count=message_count, **prompt_variables)
+        trace.set_count("prompt_chars", len(prompt))
+        if previous:
+            await notify(
+                f"距上次画像新增 {message_count} 条历史消息，其中目标用户 {primary_count} 条，上下文 {other_count} 条{merged_notice}，提示词约 {prompt_tokens} tokens。正在增量更新画像，请稍候...")
+        else:
+            await notify(
+                f"使用了 {message_count} 条历史消息，其中目标用户 {primary_count} 条，上下文 {other_count} 条{merged_notice}，提示词约 {prompt_tokens} tokens。正在生成画像，请稍候...")
+        with trace.stage("llm"):
+            success, response, _, model_name = await llm_runner.generate_with_model(prompt, model_config=model_config)
+    if not success:
+        logger.error(f"模型响应失败: {response}")
+        trace.outcome = "模型调用失败"
+        return None, None
+
+    portrait_store.save(PortraitRecord(
+        target_user_id=target_user_id,
+        stream_id=stream_id,
+        content=response,
+        last_message_time=latest_time,
+        message_count=message_count + (previous.message_count if previous else 0),
+        start_time=previous.start_time if previous else prepared.earliest_time,
+        model_name=model_name,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=estimate_tokens(response)
+    ))
+    trace.outcome = "成功"
+    return response, None
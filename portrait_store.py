@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import time
+from typing import List, Optional
+
+from src.common.logger import get_logger
+
+logger = get_logger("character_sketch_plugin")
+
+# 画像数据库的默认路径，位于插件目录下的 data 文件夹
+DEFAULT_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "portraits.db")
+
+_COLUMNS = ("target_user_id, stream_id, version, content, start_time, last_message_time, message_count, "
+            "model_name, prompt_tokens, completion_tokens, created_at")
+
+
+class PortraitRecord:
+    """一次画像生成的结果，以及它覆盖到的消息时间范围"""
+
+    def __init__(self, target_user_id: str, stream_id: str, content: str, last_message_time: float,
+                 message_count: int, created_at: Optional[float] = None, start_time: Optional[float] = None,
+                 model_name: Optional[str] = None, prompt_tokens: int = 0, completion_tokens: int = 0,
+                 version: Optional[int] = None):
+        self.target_user_id = target_user_id
+        self.stream_id = stream_id
+        self.content = content
+        # 画像覆盖的最新消息时间，增量更新时从这里继续检索
+        self.last_message_time = last_message_time
+        self.message_count = message_count
+        self.created_at = created_at if created_at is not None else time.time()
+        # 画像覆盖的最早消息时间
+        self.start_time = start_time
+        self.model_name = model_name
+        # 提示词和画像内容的估算token数
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        # 该用户在该聊天流中的第几版画像，保存后才会分配
+        self.version = version
+
+
+class PortraitStore:
+    """
+    基于 SQLite 的画像存储，以 (画像对象用户ID, 聊天流ID) 为键保存每一次生成的画像
+    每次保存都会新增一个版本，查询最新画像或历史版本都只需一次索引查找，不需要调用LLM；
+    再次为同一用户画像时，只需把最新的画像和此后的新消息交给LLM进行增量更新
+    """
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH, max_versions: int = 20):
+        self.db_path = db_path
+        # 每个用户在每个聊天流中最多保留的版本数，0表示不限制
+        self.max_versions = max_versions
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            if self.db_path != ":memory:":
+                os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS portraits ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "target_user_id TEXT NOT NULL, "
+                "stream_id TEXT NOT NULL, "
+                "version INTEGER NOT NULL, "
+                "content TEXT NOT NULL, "
+                "start_time REAL, "
+                "last_message_time REAL NOT NULL, "
+                "message_count INTEGER NOT NULL, "
+                "model_name TEXT, "
+                "prompt_tokens INTEGER NOT NULL DEFAULT 0, "
+                "completion_tokens INTEGER NOT NULL DEFAULT 0, "
+                "created_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_portraits_target "
+                "ON portraits (target_user_id, stream_id, version)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _query(self, sql: str, params: tuple) -> List[PortraitRecord]:
+        try:
+            rows = self._connect().execute(f"SELECT {_COLUMNS} FROM portraits WHERE {sql}", params).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"读取画像数据库失败: {e}")
+            return []
+        return [
+            PortraitRecord(
+                target_user_id=row[0],
+                stream_id=row[1],
+                version=row[2],
+                content=row[3],
+                start_time=row[4],
+                last_message_time=row[5],
+                message_count=row[6],
+                model_name=row[7],
+                prompt_tokens=row[8],
+                completion_tokens=row[9],
+                created_at=row[10],
+            )
+            for row in rows
+        ]
+
+    def get(self, target_user_id: str, stream_id: str) -> Optional[PortraitRecord]:
+        """获取画像对象在指定聊天流中最新的画像，没有则返回 None"""
+        records = self._query(
+            "target_user_id = ? AND stream_id = ? ORDER BY version DESC LIMIT 1",
+            (target_user_id, stream_id or "")
+        )
+        return records[0] if records else None
+
+    def get_version(self, target_user_id: str, stream_id: str, version: int) -> Optional[PortraitRecord]:
+        """获取画像对象在指定聊天流中的指定版本，没有则返回 None"""
+        records = self._query(
+            "target_user_id = ? AND stream_id = ? AND version = ?",
+            (target_user_id, stream_id or "", version)
+        )
+        return records[0] if records else None
+
+    def list_versions(self, target_user_id: str, stream_id: str, limit: int = 10) -> List[PortraitRecord]:
+        """
+        获取画像对象在指定聊天流中的历史画像
+        :param limit: 最多返回的版本数
+        :return: 按版本号倒序排列的画像列表
+        """
+        return self._query(
+            "target_user_id = ? AND stream_id = ? ORDER BY version DESC LIMIT ?",
+            (target_user_id, stream_id or "", limit)
+        )
+
+    def save(self, record: PortraitRecord) -> Optional[int]:
+        """
+        保存画像为该用户在该聊天流中的新版本，超出保留数量时删除最旧的版本
+        :return: 新画像的版本号，保存失败时返回 None
+        """
+        stream_id = record.stream_id or ""
+        try:
+            conn = self._connect()
+            with conn:
+                row = conn.execute(
+                    "SELECT MAX(version) FROM portraits WHERE target_user_id = ? AND stream_id = ?",
+                    (record.target_user_id, stream_id)
+                ).fetchone()
+                version = (row[0] or 0) + 1
+                conn.execute(
+                    f"INSERT INTO portraits ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (record.target_user_id, stream_id, version, record.content, record.start_time,
+                     record.last_message_time, record.message_count, record.model_name, record.prompt_tokens,
+                     record.completion_tokens, record.created_at)
+                )
+                if self.max_versions > 0:
+                    conn.execute(
+                        "DELETE FROM portraits WHERE target_user_id = ? AND stream_id = ? AND version <= ?",
+                        (record.target_user_id, stream_id, version - self.max_versions)
+                    )
+        except sqlite3.Error as e:
+            logger.error(f"保存画像失败: {e}")
+            return None
+        record.version = version
+        return version
+
+
+portrait_store = PortraitStore()
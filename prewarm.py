@@ -0,0 +1,142 @@
+import asyncio
+import functools
+import time
+from typing import Optional
+
+from src.common.logger import get_logger
+from src.config.config import global_config
+from src.plugin_system import chat_api, person_api
+
+from .concurrency import inflight_portraits
+from .live_index import live_message_index
+from .portrait_service import ConfigGetter, build_model_config, generate_portrait, run_limited
+from .portrait_store import portrait_store
+from .utils import get_most_active_users
+
+logger = get_logger("character_sketch_plugin")
+
+# 检查是否处于预生成时段的间隔 单位秒
+CHECK_INTERVAL = 300
+
+
+def is_in_hours(hour: int, start_hour: int, end_hour: int) -> bool:
+    """判断小时数是否处于 [start_hour, end_hour) 时段内，支持跨越零点的时段，起止相同表示全天"""
+    if start_hour == end_hour:
+        return True
+    if start_hour < end_hour:
+        return start_hour <= hour < end_hour
+    return hour >= start_hour or hour < end_hour
+
+
+class PrewarmScheduler:
+    """
+    画像预生成调度器
+    在配置的空闲时段内找出每个群聊中最活跃的用户，按限速在后台为他们生成或刷新画像，
+    之后用户请求画像时可以直接返回预先生成的结果
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, get_config: ConfigGetter) -> None:
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._run(get_config))
+        logger.info("画像预生成调度器已启动")
+
+    def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+        self._task = None
+
+    def _in_window(self, get_config: ConfigGetter) -> bool:
+        start_hour = get_config("prewarm.start_hour", 3)
+        end_hour = get_config("prewarm.end_hour", 6)
+        return is_in_hours(time.localtime().tm_hour, start_hour, end_hour)
+
+    async def _run(self, get_config: ConfigGetter) -> None:
+        while True:
+            try:
+                if self._in_window(get_config):
+                    await self.prewarm_once(get_config)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"画像预生成失败: {e}")
+            await asyncio.sleep(CHECK_INTERVAL)
+
+    async def prewarm_once(self, get_config: ConfigGetter) -> int:
+        """
+        为每个群聊中最活跃的用户预生成画像，离开空闲时段时立即停止
+        :return: 本轮生成的画像数
+        """
+        model_config, error = build_model_config(get_config)
+        if not model_config:
+            logger.error(f"画像预生成失败: {error}")
+            return 0
+        top_k = get_config("prewarm.top_k", 5)
+        activity_days = get_config("prewarm.activity_days", 7)
+        activity_message_count = get_config("prewarm.activity_message_count", 5000)
+        interval = get_config("prewarm.interval", 120)
+        cache_ttl = get_config("character_sketch_plugin.portrait_cache_ttl", 43200)
+
+        generated = 0
+        now = time.time()
+        for stream in chat_api.get_group_streams():
+            stream_id = stream.stream_id
+            activity_start = now - activity_days * 24 * 3600
+            live = live_message_index.get(stream_id)
+            if live is not None and live.covers(activity_start):
+                # 统计时段内的消息都在内存索引中，无需查询数据库
+                user_ids = live.most_active_users(top_k, exclude_user_ids=[global_config.bot.qq_account])
+            else:
+                # 分页查询数据库是同步的，在线程中执行以免阻塞事件循环
+                try:
+                    user_ids = await asyncio.to_thread(
+                        get_most_active_users,
+                        stream_id,
+                        activity_start,
+                        now,
+                        top_k,
+                        activity_message_count,
+                        exclude_user_ids=[global_config.bot.qq_account]
+                    )
+                except Exception as e:
+                    logger.error(f"统计聊天流 {stream_id} 的活跃用户失败，已跳过: {e}")
+                    continue
+            for user_id in user_ids:
+                if not self._in_window(get_config):
+                    logger.info(f"已离开画像预生成时段，本轮共生成 {generated} 个画像")
+                    return generated
+                cached = portrait_store.get(user_id, stream_id)
+                if cached and time.time() - cached.created_at < cache_ttl:
+                    continue
+                job_key = (user_id, stream_id, False)
+                if inflight_portraits.get(job_key):
+                    continue
+                # 单个用户生成失败时记录日志后继续为其他用户生成
+                try:
+                    person_id = person_api.get_person_id('qq', user_id)
+                    nickname = await person_api.get_person_value(person_id, "nickname")
+                    person_name = await person_api.get_person_value(person_id, "person_name", nickname)
+                    job = inflight_portraits.submit(job_key, run_limited(
+                        stream_id,
+                        functools.partial(generate_portrait, get_config, user_id, person_name, nickname, stream_id,
+                                          model_config)
+                    ))
+                    content, _ = await job.wait()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"为聊天流 {stream_id} 中的用户 {user_id} 预生成画像失败: {e}")
+                    content = None
+                if content:
+                    generated += 1
+                    logger.debug(f"已为聊天流 {stream_id} 中的用户 {user_id} 预生成画像")
+                # 限速，避免空闲时段集中消耗模型额度
+                await asyncio.sleep(interval)
+        logger.info(f"本轮画像预生成完成，共生成 {generated} 个画像")
+        return generated
+
+
+prewarm_scheduler = PrewarmScheduler()
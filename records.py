@@ -0,0 +1,47 @@
+from typing import Dict, Iterable, List, Optional
+
+from src.common.data_models.database_data_model import DatabaseMessages
+
+
+class MessageRecord:
+    """
+    画像流程使用的轻量消息记录
+
+    数据库消息对象带有数十个字段以及各自的 user_info、chat_info 等子对象，而画像流程只用到其中几个字段。
+    检索时立即把消息投影为只有这些字段的 __slots__ 对象，原始对象随即可以被回收；
+    相同的用户ID、昵称和聊天流ID共用同一个字符串对象
+    """
+
+    __slots__ = ("time", "chat_id", "user_id", "user_nickname", "text")
+
+    def __init__(self, time: float, chat_id: str, user_id: str, user_nickname: str, text: str):
+        # 消息时间戳
+        self.time = time
+        # 聊天流ID
+        self.chat_id = chat_id
+        # 发送者的用户ID
+        self.user_id = user_id
+        # 发送者当时的QQ昵称
+        self.user_nickname = user_nickname
+        # 消息的纯文本内容，即 processed_plain_text
+        self.text = text
+
+    def __repr__(self) -> str:
+        return f"MessageRecord(time={self.time!r}, user_id={self.user_id!r}, text={self.text!r})"
+
+
+def to_records(messages: Iterable[DatabaseMessages]) -> List[MessageRecord]:
+    """
+    把数据库消息逐条投影为轻量记录，保持原有顺序
+    同一次投影中相同的用户ID、昵称和聊天流ID只保留第一次出现的字符串对象，其余记录共用该对象
+    """
+    shared: Dict[Optional[str], Optional[str]] = {}
+    share = shared.setdefault
+    records: List[MessageRecord] = []
+    append = records.append
+    for message in messages:
+        user_info = message.user_info
+        user_id, nickname, chat_id = user_info.user_id, user_info.user_nickname, message.chat_id
+        append(MessageRecord(message.time, share(chat_id, chat_id), share(user_id, user_id),
+                             share(nickname, nickname), message.processed_plain_text))
+    return records
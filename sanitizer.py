@@ -0,0 +1,166 @@
+import re
+from typing import Dict, List, Optional
+
+# 默认的消息清洗规则
+# action 为 remove 时删除匹配到的内容，为 drop 时丢弃整条消息
+# 规则中尽量使用非贪婪匹配或排除型字符集，避免在整行消息上回溯
+DEFAULT_SANITIZE_RULES: List[Dict[str, str]] = [
+    {
+        "pattern": r"={10}\s*转发消息开始\s*={10}.*?={10}\s*转发消息结束\s*={10}",
+        "action": "remove",
+        "description": "合并转发的消息",
+    },
+    {
+        "pattern": r"\[回复<.*?]，说：",
+        "action": "remove",
+        "description": "回复消息时附带的被回复内容",
+    },
+    {
+        "pattern": r"@<[^>]*>",
+        "action": "remove",
+        "description": "@某人",
+    },
+    {
+        "pattern": r"\[表情包[^\]]*]",
+        "action": "remove",
+        "description": "表情包",
+    },
+    {
+        "pattern": r"\[picid[^\]]*]",
+        "action": "remove",
+        "description": "图片",
+    },
+    {
+        "pattern": r"\[command[^\]]*]",
+        "action": "remove",
+        "description": "命令",
+    },
+    {
+        "pattern": r"\[文件:",
+        "action": "drop",
+        "description": "文件消息",
+    },
+]
+
+
+class MessageSanitizer:
+    """
+    消息清洗器，删除消息中对画像生成无用的内容
+
+    所有 remove 规则会被合并为一个正则表达式，一次扫描即可删除全部匹配内容；
+    所有 drop 规则同样合并为一个正则表达式，用于判断是否丢弃整条消息。
+    规则只在加载时编译一次。当每条规则都以字面量开头时，合并后的正则会加上首字符的前瞻断言，
+    使正则引擎可以快速跳过不可能匹配的位置。
+    含有捕获组（合并后组号会改变，反向引用的含义随之改变）或无法与其他规则合并（例如开头的 (?i) 等全局标志）的规则
+    单独编译，清洗时在合并的正则之后依次执行
+    """
+
+    def __init__(self, rules: Optional[List[Dict[str, str]]] = None):
+        self.rules: List[Dict[str, str]] = []
+        self.invalid_rules: List[Dict[str, str]] = []
+        self._remove_patterns: List[re.Pattern] = []
+        self._drop_patterns: List[re.Pattern] = []
+        self.set_rules(DEFAULT_SANITIZE_RULES if rules is None else rules)
+
+    def set_rules(self, rules: List[Dict[str, str]]) -> None:
+        """
+        替换清洗规则并重新编译
+        无法编译的规则会被跳过并记录在 invalid_rules 中
+        :param rules: 规则列表，每条规则包含 pattern、action（remove 或 drop）和可选的 description
+        """
+        valid_rules = []
+        invalid_rules = []
+        remove_patterns = []
+        drop_patterns = []
+        for rule in rules:
+            pattern = rule.get("pattern", "")
+            action = rule.get("action", "remove")
+            if not pattern or action not in ("remove", "drop"):
+                invalid_rules.append(rule)
+                continue
+            try:
+                re.compile(pattern, re.DOTALL)
+            except re.error:
+                invalid_rules.append(rule)
+                continue
+            valid_rules.append(rule)
+            (remove_patterns if action == "remove" else drop_patterns).append(pattern)
+        self.rules = valid_rules
+        self.invalid_rules = invalid_rules
+        self._remove_patterns = self._combine(remove_patterns)
+        self._drop_patterns = self._combine(drop_patterns)
+
+    @staticmethod
+    def _combine(patterns: List[str]) -> List[re.Pattern]:
+        """
+        把可以合并的规则编译为一个正则表达式，其余规则各自编译
+        :return: 编译后的正则表达式列表，合并的正则表达式（如果有）在最前面
+        """
+        compiled = [re.compile(pattern, re.DOTALL) for pattern in patterns]
+        mergeable = [pattern for pattern, regex in zip(patterns, compiled) if not regex.groups]
+        separate = [regex for regex in compiled if regex.groups]
+        if len(mergeable) <= 1:
+            # 单条规则时正则引擎自身就能利用字面量前缀加速
+            return [regex for regex in compiled if not regex.groups] + separate
+        combined = "|".join(f"(?:{pattern})" for pattern in mergeable)
+        prefixes = [_literal_prefix(pattern) for pattern in mergeable]
+        if all(prefixes):
+            first_chars = "".join(sorted({re.escape(prefix[0]) for prefix in prefixes}))
+            combined = f"(?=[{first_chars}])(?:{combined})"
+        try:
+            return [re.compile(combined, re.DOTALL)] + separate
+        except re.error:
+            # 例如规则开头的 (?i) 等全局标志在合并后不再位于开头，此时不合并，逐条执行
+            return compiled
+
+    def clean(self, text: str) -> Optional[str]:
+        """
+        清洗单条消息
+        :param text: 消息原文
+        :return: 清洗后的消息，消息需要被丢弃或清洗后为空时返回 None
+        """
+        text = text.strip()
+        if not text:
+            return None
+        for pattern in self._drop_patterns:
+            if pattern.search(text):
+                return None
+        for pattern in self._remove_patterns:
+            text = pattern.sub("", text)
+        return text.strip() or None
+
+
+def _literal_prefix(pattern: str) -> str:
+    """提取正则表达式开头必须出现的字面量，例如 r"\[表情包[^\]]*]" 的前缀为 "[表情包" """
+    if re.search(r"(?<!\\)\|", pattern):
+        # 含有分支的规则不一定以同一个字面量开头
+        return ""
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                # \s、\d 等字符类不是字面量
+                break
+            literal = pattern[i + 1]
+            i += 2
+        elif char in ".^$*+?{}[]()|":
+            break
+        else:
+            literal = char
+            i += 1
+        if i < len(pattern) and pattern[i] in "*?{":
+            # 字面量后跟可能匹配零次的量词时它不一定出现，跟 {n} 时至少出现一次
+            if pattern[i] != "{" or pattern[i + 1:i + 2] in ("0", ",", ""):
+                break
+            prefix.append(literal)
+            break
+        if i < len(pattern) and pattern[i] == "+":
+            prefix.append(literal)
+            break
+        prefix.append(literal)
+    return "".join(prefix)
+
+
+message_sanitizer = MessageSanitizer()
@@ -0,0 +1,126 @@
+import heapq
+import math
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Set
+
+from src.common.logger import get_logger
+
+from .compaction import normalize, shingles
+from .records import MessageRecord
+from .sanitizer import message_sanitizer
+
+logger = get_logger("character_sketch_plugin")
+
+# 各项得分的权重
+LENGTH_WEIGHT = 0.3
+NOVELTY_WEIGHT = 0.4
+ENGAGEMENT_WEIGHT = 0.3
+# 消息长度达到该字数后长度得分不再增加
+LENGTH_SATURATION = 80
+# 目标用户发言后多少秒内、多少条消息内其他用户的发言计为互动
+ENGAGEMENT_SECONDS = 600
+ENGAGEMENT_MESSAGES = 5
+# 互动得分达到上限所需的互动数
+ENGAGEMENT_SATURATION = 4
+# 同一天内每多选中一条消息，该天其余消息的得分乘以该系数，使选中的消息分散在整个时间范围内
+SAME_DAY_DECAY = 0.7
+
+
+def score_messages(messages: List[MessageRecord], primary_user_id: str) -> Dict[int, float]:
+    """
+    为目标用户的每条消息计算信息量得分
+    得分由三部分组成：消息长度；词汇新颖度，即消息中的二字组在目标用户所有消息中的平均逆文档频率；
+    发言引起的互动，即随后一段时间内其他用户的发言数以及对该消息的回复数
+    :param messages: 按时间升序排列的消息
+    :param primary_user_id: 目标用户ID
+    :return: 目标用户消息在 messages 中的下标到得分的映射，清洗后为空或重复的消息不参与评分
+    """
+    documents: Dict[int, frozenset] = {}
+    lengths: Dict[int, int] = {}
+    seen: Set[str] = set()
+    engagement: Counter = Counter()
+    reply_marker = f":{primary_user_id}>"
+    last_anchor: Optional[int] = None
+    for index, msg in enumerate(messages):
+        if msg.user_id == primary_user_id:
+            last_anchor = index
+            text = message_sanitizer.clean(msg.text)
+            if not text:
+                continue
+            normalized = normalize(text)
+            if normalized in seen:
+                # 重复的发言没有新的信息
+                continue
+            seen.add(normalized)
+            documents[index] = shingles(normalized)
+            lengths[index] = len(text)
+            continue
+        if last_anchor is None:
+            continue
+        raw_text = msg.text or ""
+        if raw_text.startswith("[回复") and reply_marker in raw_text[:raw_text.find("]")]:
+            # 回复目标用户的消息，近似地记在目标用户最近的一条发言上
+            engagement[last_anchor] += 2
+        elif (index - last_anchor <= ENGAGEMENT_MESSAGES
+              and msg.time - messages[last_anchor].time <= ENGAGEMENT_SECONDS):
+            engagement[last_anchor] += 1
+    if not documents:
+        return {}
+
+    # 一次性统计所有文档的二字组文档频率，再计算每条消息的平均逆文档频率
+    document_frequency: Counter = Counter()
+    for tokens in documents.values():
+        document_frequency.update(tokens)
+    total = len(documents)
+    idf = {token: math.log((total + 1) / (count + 1)) + 1 for token, count in document_frequency.items()}
+    novelty = {index: sum(idf[token] for token in tokens) / len(tokens) for index, tokens in documents.items()}
+    max_novelty = max(novelty.values()) or 1
+
+    return {
+        index: LENGTH_WEIGHT * min(lengths[index], LENGTH_SATURATION) / LENGTH_SATURATION
+        + NOVELTY_WEIGHT * novelty[index] / max_novelty
+        + ENGAGEMENT_WEIGHT * min(engagement[index], ENGAGEMENT_SATURATION) / ENGAGEMENT_SATURATION
+        for index in documents
+    }
+
+
+def select_informative_messages(messages: List[MessageRecord], primary_user_id: str, context_length: int,
+                                context_length_after: int = 0, limit: int = 1000) -> List[MessageRecord]:
+    """
+    在整个检索范围内挑选信息量最高的目标用户消息，并附带其上下文，作为 filter_messages_with_context 的替代
+    按得分从高到低贪心地选择消息，同一天内已选中的消息越多，该天其余消息的得分越低；
+    加入一条消息及其上下文后超过 limit 时跳过该消息
+    :param messages: 按时间升序排列的消息
+    :param primary_user_id: 目标用户ID
+    :param context_length: 目标用户消息之前的的上下文消息条数
+    :param context_length_after: 目标用户消息之后的上下文消息条数。默认为0
+    :param limit: 最多保留的消息条数（包含上下文），默认为1000
+    :return: 按时间升序排列的选中消息及其上下文
+    """
+    scores = score_messages(messages, primary_user_id)
+    context_length = max(context_length, 0)
+    context_length_after = max(context_length_after or 0, 0)
+    heap = [(-score, index) for index, score in scores.items()]
+    heapq.heapify(heap)
+    picked_per_day: Counter = Counter()
+    included: Set[int] = set()
+    picked = 0
+    while heap and len(included) < limit:
+        negative_score, index = heapq.heappop(heap)
+        local_time = time.localtime(messages[index].time)
+        day = (local_time.tm_year, local_time.tm_yday)
+        adjusted = scores[index] * SAME_DAY_DECAY ** picked_per_day[day]
+        if heap and adjusted < -negative_score and adjusted < -heap[0][0]:
+            # 得分已因同一天的消息被选中而降低，放回堆中按新的得分重新排序
+            heapq.heappush(heap, (-adjusted, index))
+            continue
+        window = range(max(0, index - context_length), min(len(messages), index + context_length_after + 1))
+        new_indices = [i for i in window if i not in included]
+        if len(included) + len(new_indices) > limit:
+            continue
+        included.update(new_indices)
+        picked_per_day[day] += 1
+        picked += 1
+    logger.debug(f"按信息量挑选消息: 候选 {len(scores)} 条, 选中 {picked} 条, 包含上下文共 {len(included)} 条")
+    return [messages[i] for i in sorted(included)]
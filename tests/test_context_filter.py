@@ -0,0 +1,96 @@
+"""
+filter_messages_with_context 与 context_indices 的等价性测试
+
+以旧实现（把每个上下文窗口中的每个下标加入集合，最后对下标排序）为参照，
+在随机生成的小规模输入（包含乱序和时间相同的消息）和合成聊天记录上检查两者的结果完全一致。
+不依赖麦麦本体，使用 benchmarks 中的接口替身和合成聊天记录：
+    python -m pytest tests
+"""
+import os
+import random
+import sys
+from typing import List
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from standins import install, load_plugin_module  # noqa: E402
+from synthetic_chat import SyntheticChat, SyntheticMessage, SyntheticUserInfo  # noqa: E402
+
+install()
+utils = load_plugin_module("utils")
+records = load_plugin_module("records")
+
+
+def reference_filter(messages: List, primary_user_id: str, context_length: int, context_length_after: int = 0,
+                     limit: int = 1000) -> List:
+    """旧实现：把每个上下文窗口中的每个下标加入集合，最后对下标排序"""
+    if not messages:
+        return []
+    if context_length <= 0 and (context_length_after is None or context_length_after <= 0):
+        filtered = [m for m in messages if m.user_id == primary_user_id]
+        return sorted(filtered, key=lambda x: x.time)[-limit:]
+    ordered = sorted(messages, key=lambda msg: msg.time)
+    include_indices = set()
+    for idx in range(len(ordered) - 1, -1, -1):
+        if len(include_indices) >= limit:
+            break
+        msg = ordered[idx]
+        if msg.user_id == primary_user_id:
+            start = max(0, idx - context_length)
+            end = min(len(ordered) - 1, idx + context_length_after)
+            for i in range(start, end + 1):
+                include_indices.add(i)
+    if not include_indices:
+        return []
+    result_indices = sorted(include_indices)
+    if len(result_indices) > limit:
+        result_indices = result_indices[-limit:]
+    return [ordered[i] for i in result_indices]
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_inputs_match_reference(seed):
+    """随机生成小规模输入，覆盖乱序、时间相同、窗口相邻和重叠、limit 截断等情况"""
+    rng = random.Random(seed)
+    users = [SyntheticUserInfo(str(i), f"群友{i}") for i in range(4)]
+    for case in range(500):
+        count = rng.randint(0, 60)
+        messages = records.to_records(SyntheticMessage(str(i), float(rng.randint(0, 40)), "s", "", rng.choice(users))
+                                      for i in range(count))
+        if rng.random() < 0.5:
+            messages.sort(key=lambda msg: msg.time)
+        before, after, limit = rng.randint(0, 5), rng.randint(0, 5), rng.randint(1, 70)
+        expected = reference_filter(messages, "0", before, after, limit)
+        assert utils.filter_messages_with_context(messages, "0", before, after, limit) == expected, \
+            f"用例 {case}: count={count} before={before} after={after} limit={limit}"
+        ordered = sorted(messages, key=lambda msg: msg.time)
+        mask = bytearray(msg.user_id == "0" for msg in ordered)
+        indices = utils.context_indices(mask, before, after, limit)
+        assert [ordered[i] for i in indices] == expected, f"用例 {case} 的 context_indices 结果不一致"
+
+
+@pytest.fixture(scope="module")
+def synthetic_stream():
+    chat = SyntheticChat(20000, seed=0)
+    stream_id = chat.largest_stream()
+    messages = records.to_records(chat.find_messages({"chat_id": stream_id}))
+    return chat, stream_id, messages
+
+
+@pytest.mark.parametrize("rank", [1, 20, 200])
+@pytest.mark.parametrize("limit", [1400, 100000])
+def test_synthetic_chat_matches_reference(synthetic_stream, rank, limit):
+    chat, stream_id, messages = synthetic_stream
+    ranked = chat.active_users(stream_id)
+    target = ranked[min(rank, len(ranked)) - 1]
+    shuffled = messages[:]
+    random.Random(rank).shuffle(shuffled)
+    expected = reference_filter(messages, target, 3, 1, limit)
+    assert utils.filter_messages_with_context(messages, target, 3, 1, limit) == expected
+    assert utils.filter_messages_with_context(shuffled, target, 3, 1, limit) == expected
+    target_index = chat.user_ids.index(target)
+    indices = utils.context_indices(bytearray(user == target_index for user in chat.streams[stream_id].users),
+                                    3, 1, limit)
+    assert [messages[i] for i in indices] == expected
@@ -0,0 +1,122 @@
+"""
+分段画像 split_lines 与 generate_portrait_map_reduce 的测试
+
+使用记录调用情况、可按分段注入失败的替身模型，检查分段数量和日期行的补充、并发上限、
+失败分段的处理以及全部分段失败时的返回值。不依赖麦麦本体：
+    python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+from typing import List, Optional, Set
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+
+from standins import install, load_plugin_module  # noqa: E402
+
+install()
+map_reduce = load_plugin_module("map_reduce")
+encoding = load_plugin_module("encoding")
+token_budget = load_plugin_module("token_budget")
+
+MAP_TEMPLATE = "分析「{person_name}」第 {segment_index}/{segment_count} 段，共 {message_count} 条\n{messages}"
+REDUCE_TEMPLATE = "合并「{person_name}」的 {segment_count} 段，共 {message_count} 条\n{partial_analyses}"
+PROMPT_VARIABLES = {"person_name": "测试用户"}
+
+
+class StubLLM:
+    """替身模型：记录收到的提示词和同时进行的调用数，提示词中包含指定内容时返回失败"""
+
+    def __init__(self, fail_markers: Optional[Set[str]] = None, delay: float = 0.01):
+        self.fail_markers = fail_markers or set()
+        self.delay = delay
+        self.prompts: List[str] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def generate_with_model(self, prompt: str, model_config=None):
+        self.prompts.append(prompt)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if any(marker in prompt for marker in self.fail_markers):
+            return False, "模拟的调用失败", "", None
+        if prompt.startswith("合并"):
+            return True, "最终画像", "", "stub-model"
+        # 以本段第一条消息作为分析结果，便于检查合并时使用了哪些分段
+        first = next(line for line in prompt.splitlines()[1:] if not line.startswith(encoding.DAY_HEADER_PREFIX))
+        return True, f"观察：{first}", "", "stub-model"
+
+
+def compact_day(day: str, count: int, start: int) -> List[str]:
+    """紧凑格式的一天聊天记录：日期行加 count 条等长的消息"""
+    return [f"{encoding.DAY_HEADER_PREFIX}{day} ---"] + [f"*12:{start + i:02d} A: 第{start + i:02d}条消息" for i in range(count)]
+
+
+def line_cost(line: str) -> int:
+    return token_budget.estimate_tokens(line) + 1
+
+
+def make_segments(count: int) -> List[List[str]]:
+    return [[f"*12:{i:02d} A: 第{i:02d}段的消息"] for i in range(count)]
+
+
+def test_split_lines_carries_day_headers():
+    day1 = compact_day("2024-05-01", 6, 0)
+    day2 = compact_day("2024-05-02", 6, 6)
+    lines = day1 + day2
+    header_cost, message_cost = line_cost(day1[0]), line_cost(day1[1])
+    assert header_cost <= message_cost
+    # 每段最多容纳一个日期行和四条消息：
+    # [日期1 1-4] [日期1 5-6 日期2 7] [日期2 8-11] [日期2 12]
+    segments = map_reduce.split_lines(lines, header_cost + 4 * message_cost)
+    assert len(segments) == 4
+    assert [segment[0] for segment in segments] == [day1[0], day1[0], day2[0], day2[0]]
+    assert segments[1] == [day1[0]] + day1[5:] + day2[:2]
+    for segment in segments:
+        assert sum(line_cost(line) for line in segment) <= header_cost + 4 * message_cost
+    # 去掉补充的日期行后与原聊天记录一致
+    restored = segments[0] + [line for segment in segments[1:] for line in segment[1:]]
+    assert restored == lines
+    assert sum(map_reduce.count_messages(segment) for segment in segments) == 12
+
+
+def test_split_lines_oversized_line_takes_own_segment():
+    lines = ["短消息", "长" * 50, "短消息"]
+    assert map_reduce.split_lines(lines, 10) == [["短消息"], ["长" * 50], ["短消息"]]
+
+
+def test_map_concurrency_is_limited():
+    llm = StubLLM()
+    success, response, model_name = asyncio.run(map_reduce.generate_portrait_map_reduce(
+        make_segments(8), MAP_TEMPLATE, REDUCE_TEMPLATE, PROMPT_VARIABLES, None, max_concurrency=3, llm=llm))
+    assert (success, response, model_name) == (True, "最终画像", "stub-model")
+    assert 1 < llm.max_in_flight <= 3
+    # 8 次分段分析加 1 次合并
+    assert len(llm.prompts) == 9
+
+
+def test_failed_segment_is_excluded_from_partial_analyses():
+    segments = make_segments(4)
+    llm = StubLLM(fail_markers={"第01段"})
+    success, response, _ = asyncio.run(map_reduce.generate_portrait_map_reduce(
+        segments, MAP_TEMPLATE, REDUCE_TEMPLATE, PROMPT_VARIABLES, None, max_concurrency=2, llm=llm))
+    assert (success, response) == (True, "最终画像")
+    reduce_prompt = llm.prompts[-1]
+    assert reduce_prompt.startswith("合并「测试用户」的 3 段，共 3 条")
+    assert "第01段" not in reduce_prompt and "### 第 2 段" not in reduce_prompt
+    for index in (0, 2, 3):
+        assert f"观察：{segments[index][0]}" in reduce_prompt
+        assert f"### 第 {index + 1} 段" in reduce_prompt
+
+
+def test_all_segments_failed():
+    llm = StubLLM(fail_markers={"段的消息"})
+    result = asyncio.run(map_reduce.generate_portrait_map_reduce(
+        make_segments(3), MAP_TEMPLATE, REDUCE_TEMPLATE, PROMPT_VARIABLES, None, max_concurrency=2, llm=llm))
+    assert result == (False, "所有分段的分析均失败", None)
+    # 没有进行合并
+    assert len(llm.prompts) == 3
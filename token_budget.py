@@ -0,0 +1,53 @@
+from typing import Dict, List, Optional
+
+# 粗略估算token数时使用的系数
+# 中日韩等非ASCII字符在常见分词器中大多为一个字一个token，ASCII文本平均约四个字符一个token
+NON_ASCII_TOKENS_PER_CHAR = 1.0
+ASCII_TOKENS_PER_CHAR = 0.25
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算文本的token数，不依赖任何分词器
+    :param text: 文本
+    :return: 估算的token数
+    """
+    if not text:
+        return 0
+    ascii_count = len(text.encode("ascii", "ignore"))
+    non_ascii_count = len(text) - ascii_count
+    return int(non_ascii_count * NON_ASCII_TOKENS_PER_CHAR + ascii_count * ASCII_TOKENS_PER_CHAR) + 1
+
+
+def resolve_token_budget(model_names: List[str], token_budgets: List[Dict], default_budget: int) -> int:
+    """
+    计算一组模型可用的提示词token预算
+    模型按负载均衡或随机策略选择，任何一个都可能被选中，因此取其中最小的预算
+    :param model_names: 模型名称列表，为空时使用默认预算
+    :param token_budgets: 每个模型的预算配置，每项包含 model 和 token_budget
+    :param default_budget: 没有单独配置的模型使用的预算，0表示不限制
+    :return: token预算，0表示不限制
+    """
+    budget_map = {item.get("model"): int(item.get("token_budget", 0)) for item in token_budgets if item.get("model")}
+    budgets = [budget_map.get(name, default_budget) for name in model_names] or [default_budget]
+    limited = [budget for budget in budgets if budget > 0]
+    return min(limited) if limited else 0
+
+
+def pack_lines(lines: List[str], budget: int, line_tokens: Optional[List[int]] = None) -> int:
+    """
+    计算在预算内最多能保留多少行，从列表开头开始装入
+    :param lines: 按优先级排列的文本行，通常为时间倒序
+    :param budget: token预算，0表示不限制
+    :param line_tokens: 已经算好的每行token数，省略时重新估算
+    :return: 能装入预算的行数
+    """
+    if budget <= 0:
+        return len(lines)
+    used = 0
+    for index, line in enumerate(lines):
+        # 每行末尾的换行符按一个token计算
+        used += (line_tokens[index] if line_tokens is not None else estimate_tokens(line)) + 1
+        if used > budget:
+            return index
+    return len(lines)
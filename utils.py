@@ -1,28 +1,52 @@
-import re
-import time
-from typing import List, Optional, Dict, Any, Tuple
+import asyncio
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+from itertools import islice
+from operator import attrgetter, le
+from typing import List, Optional, Dict, Any, Tuple, Iterable, Iterator, Set
 
 from src.common.data_models.database_data_model import DatabaseMessages
 from src.common.logger import get_logger
 from src.common.message_repository import find_messages
-from src.plugin_system import (
-    chat_api,
-    person_api
-)
+from src.plugin_system import chat_api
+from .compaction import RepeatCompactor, format_repeat
+from .encoding import COMPACT_LINE_PLACEHOLDER, encode_compact, format_full_line
+from .name_resolver import person_name_resolver
+from .records import MessageRecord, to_records
+from .sanitizer import message_sanitizer
+from .token_budget import estimate_tokens, pack_lines
 
 logger = get_logger("portrayal_plugin")
 
+# 与格式化后每行开头的 "[%Y-%m-%d %H:%M:%S] " 等长的占位符，用于在格式化之前估算token数
+LINE_TIME_PLACEHOLDER = "[2000-01-01 00:00:00] "
+
+# 聊天记录的格式：full 为每行带完整时间和发言人名称，compact 为紧凑格式，见 encoding.encode_compact
+MESSAGE_FORMATS = ("full", "compact")
+
+# 自适应检索依次尝试的时间范围（天），超过最大天数的部分会被截去
+RETRIEVAL_WINDOW_STEPS = (1, 3, 7, 30, 90)
+
 
 def get_messages_by_user_in_stream(user_ids: List[str], start_time: Optional[float], end_time: Optional[float],
                                    stream_id: Optional[str],
-                                   limit: int = 1000) -> List[DatabaseMessages]:
-    """获取指定用户在指定聊天流中的消息记录"""
+                                   limit: int = 1000) -> List[MessageRecord]:
+    """获取指定用户在指定聊天流中的消息记录，查询结果立即投影为轻量记录"""
+    return to_records(_find_user_messages(user_ids, start_time, end_time, stream_id, limit))
+
+
+def _find_user_messages(user_ids: List[str], start_time: Optional[float], end_time: Optional[float],
+                        stream_id: Optional[str], limit: int,
+                        include_end: bool = False) -> List[DatabaseMessages]:
+    """查询指定用户在指定聊天流中的数据库消息，include_end 为 True 时包含时间恰好为 end_time 的消息"""
     filter_query: Dict[str, Any] = {}
     time_range = {}
     if start_time:
         time_range["$gt"] = start_time
     if end_time:
-        time_range["$lt"] = end_time
+        time_range["$lte" if include_end else "$lt"] = end_time
     if time_range:
         filter_query["time"] = time_range
     if user_ids:
@@ -30,18 +54,380 @@ def get_messages_by_user_in_stream(user_ids: List[str], start_time: Optional[flo
     if stream_id:
         filter_query["chat_id"] = stream_id
     sort_order = [("time", 1)] if limit == 0 else None
-    messages = find_messages(
+    return find_messages(
         message_filter=filter_query,
         sort=sort_order,
         limit=limit,
         limit_mode="latest",
         filter_command=True
     )
-    return messages
+
+
+def get_user_messages_with_context(primary_user_id: str, start_time: Optional[float], end_time: Optional[float],
+                                   stream_id: str, context_length: int, context_length_after: int = 0,
+                                   limit: int = 1000, merge_gap: float = 600, max_rows: int = 0,
+                                   max_segments: int = 0) -> List[MessageRecord]:
+    """
+    两阶段检索目标用户的消息及其上下文，避免把整个聊天流的消息全部读入内存
+
+    1. 只查询目标用户的消息，得到其发言时间点
+    2. 将间隔不超过 merge_gap 秒的发言合并为一个时间段，从最近的时间段开始，对每个时间段按时间范围查询段内的消息，
+       并额外查询时间段之前的 context_length 条和之后的 context_length_after 条消息
+    3. 第二阶段累计读取 max_rows 条消息后停止，时间段内的消息过多时只读取其中最近的部分，
+       因此目标用户在繁忙的聊天中连续发言时也不会读取一整天的消息
+
+    返回的消息按时间升序排列，每条目标用户消息前后的上下文与在完整消息列表中看到的一致，
+    可以直接交给 filter_messages_with_context 进行截取
+    :param primary_user_id: 目标用户ID
+    :param start_time: 开始时间
+    :param end_time: 结束时间
+    :param stream_id: 聊天流ID
+    :param context_length: 目标用户消息之前的的上下文消息条数
+    :param context_length_after: 目标用户消息之后的上下文消息条数。默认为0
+    :param limit: 最多检索的目标用户消息条数，默认为1000
+    :param merge_gap: 合并相邻目标用户消息的最大时间间隔，单位秒
+    :param max_rows: 第二阶段最多读取的消息条数，0表示不限制
+    :param max_segments: 最多查询的时间段数量，只保留最近的时间段，每个时间段最多需要3次查询，0表示不限制
+    :return: 目标用户的消息及其上下文消息
+    """
+    anchors = get_messages_by_user_in_stream([primary_user_id], start_time, end_time, stream_id, limit)
+    if not anchors:
+        return []
+    anchors.sort(key=lambda msg: msg.time)
+
+    # 合并时间上相邻的目标用户消息
+    segments: List[Tuple[float, float]] = []
+    segment_start = segment_end = anchors[0].time
+    for msg in anchors[1:]:
+        if msg.time - segment_end > merge_gap:
+            segments.append((segment_start, segment_end))
+            segment_start = msg.time
+        segment_end = msg.time
+    segments.append((segment_start, segment_end))
+    if 0 < max_segments < len(segments):
+        segments = segments[-max_segments:]
+
+    # 按消息ID去重，每批查询结果立即投影为轻量记录
+    collected: Dict[str, MessageRecord] = {}
+    remaining = max_rows
+    queried = 0
+    for segment_start, segment_end in reversed(segments):
+        if max_rows > 0 and remaining <= 0:
+            break
+        queried += 1
+        batches = [_find_stream_messages(stream_id, {"$gte": segment_start, "$lte": segment_end},
+                                         remaining if max_rows > 0 else 0, "latest")]
+        if context_length > 0:
+            batches.append(_find_stream_messages(stream_id, {"$lt": segment_start}, context_length, "latest"))
+        if context_length_after and context_length_after > 0:
+            batches.append(_find_stream_messages(stream_id, {"$gt": segment_end}, context_length_after, "earliest"))
+        for batch in batches:
+            remaining -= len(batch)
+            for msg, record in zip(batch, to_records(batch)):
+                collected[msg.message_id] = record
+    logger.debug(f"两阶段检索: 目标用户消息 {len(anchors)} 条, 时间段 {len(segments)} 个, 查询了 {queried} 个, "
+                 f"共读取 {len(collected)} 条消息")
+    return sorted(collected.values(), key=lambda msg: msg.time)
+
+
+def retrieval_windows(max_days: float, adaptive: bool = True) -> List[float]:
+    """
+    自适应检索依次尝试的时间范围
+    :param max_days: 最大检索天数
+    :param adaptive: 为 False 时只使用最大天数
+    :return: 由小到大排列的天数，最后一项总是 max_days
+    """
+    if not adaptive:
+        return [max_days]
+    return [days for days in RETRIEVAL_WINDOW_STEPS if days < max_days] + [max_days]
+
+
+def find_retrieval_start(user_id: str, stream_id: Optional[str], end_time: float, windows_days: List[float],
+                         needed: int, earliest_time: Optional[float] = None) -> Tuple[float, float, int]:
+    """
+    从最近的一小段时间开始逐步扩大检索范围，直到目标用户的消息数足够为止
+    每次只读取目标用户的至多 needed 条消息来判断，因此活跃用户只需检索最近几天，不活跃的用户也能向前追溯足够远
+
+    :param user_id: 目标用户ID
+    :param stream_id: 聊天流ID，为空表示所有聊天流
+    :param end_time: 检索的结束时间
+    :param windows_days: 由小到大依次尝试的天数，见 retrieval_windows
+    :param needed: 需要的目标用户消息数
+    :param earliest_time: 检索范围的下限，例如增量画像时上次画像的最后一条消息的时间，到达下限后不再扩大
+    :return: 检索的开始时间、对应的天数、判断过程中读取的消息数
+    """
+    fetched = 0
+    start_time, days = end_time, 0.0
+    for index, days in enumerate(windows_days):
+        start_time = end_time - days * 24 * 3600
+        if earliest_time and start_time <= earliest_time:
+            return earliest_time, (end_time - earliest_time) / (24 * 3600), fetched
+        if index == len(windows_days) - 1:
+            # 已经是最大的范围，无需再判断
+            break
+        probe = get_messages_by_user_in_stream([user_id], start_time, end_time, stream_id, needed)
+        fetched += len(probe)
+        if len(probe) >= needed:
+            break
+    return start_time, days, fetched
+
+
+def get_user_active_streams(user_id: str, start_time: Optional[float], end_time: Optional[float],
+                            limit: int = 2000) -> List[Tuple[str, int]]:
+    """
+    统计用户在各个聊天流中的发言数
+    :param user_id: 用户ID
+    :param start_time: 开始时间
+    :param end_time: 结束时间
+    :param limit: 最多统计的该用户消息条数，从最新的消息开始统计
+    :return: 按发言数降序排列的 (聊天流ID, 发言数) 列表
+    """
+    messages = get_messages_by_user_in_stream([user_id], start_time, end_time, None, limit)
+    return Counter(msg.chat_id for msg in messages if msg.chat_id).most_common()
+
+
+def allocate_quotas(weights: List[int], total: int) -> List[int]:
+    """
+    按权重把总配额分配给各项，使用最大余数法保证分配结果之和恰好等于 total
+    :param weights: 每项的权重
+    :param total: 总配额
+    :return: 每项分到的配额
+    """
+    weight_sum = sum(weights)
+    if weight_sum <= 0 or total <= 0:
+        return [0] * len(weights)
+    exact = [total * weight / weight_sum for weight in weights]
+    quotas = [int(value) for value in exact]
+    remainders = sorted(range(len(weights)), key=lambda index: exact[index] - quotas[index], reverse=True)
+    for index in remainders[:total - sum(quotas)]:
+        quotas[index] += 1
+    return quotas
+
+
+async def gather_user_messages_across_streams(primary_user_id: str, start_time: Optional[float],
+                                              end_time: Optional[float], context_length: int,
+                                              context_length_after: int = 0, limit: int = 1000,
+                                              merge_gap: float = 600, max_streams: int = 10,
+                                              max_concurrency: int = 4, max_rows: int = 0,
+                                              max_segments: int = 0) -> List[MessageRecord]:
+    """
+    跨聊天流检索目标用户的消息及其上下文
+
+    1. 在线程中统计目标用户最近的发言分布在哪些聊天流中，取发言最多的 max_streams 个
+    2. 按各聊天流中的发言数把 limit 和 max_rows 分配为每个聊天流的配额
+    3. 在线程中并发地对每个聊天流进行两阶段检索并截取上下文，上下文只来自同一个聊天流
+    4. 把各聊天流按时间升序排列的结果进行多路归并
+
+    :param primary_user_id: 目标用户ID
+    :param start_time: 开始时间
+    :param end_time: 结束时间
+    :param context_length: 目标用户消息之前的的上下文消息条数
+    :param context_length_after: 目标用户消息之后的上下文消息条数。默认为0
+    :param limit: 所有聊天流合计最多保留的消息条数（包含上下文）
+    :param merge_gap: 两阶段检索时合并相邻目标用户消息的最大时间间隔，单位秒
+    :param max_streams: 最多检索的聊天流数量
+    :param max_concurrency: 同时检索的最大聊天流数量
+    :param max_rows: 所有聊天流合计在两阶段检索的第二阶段最多读取的消息条数，0表示不限制
+    :param max_segments: 每个聊天流最多查询的时间段数量，0表示不限制
+    :return: 按时间升序排列的消息列表
+    """
+    active_streams = await asyncio.to_thread(get_user_active_streams, primary_user_id, start_time, end_time,
+                                             max(limit * 2, 100))
+    active_streams = active_streams[:max_streams] if max_streams > 0 else active_streams
+    if not active_streams:
+        return []
+    counts = [count for _, count in active_streams]
+    quotas = allocate_quotas(counts, limit)
+    row_quotas = allocate_quotas(counts, max_rows) if max_rows > 0 else [0] * len(counts)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    def collect(stream_id: str, quota: int, row_quota: int) -> List[MessageRecord]:
+        messages = get_user_messages_with_context(primary_user_id, start_time, end_time, stream_id, context_length,
+                                                  context_length_after, quota, merge_gap, row_quota, max_segments)
+        return filter_messages_with_context(messages, primary_user_id, context_length, context_length_after, quota)
+
+    async def collect_limited(stream_id: str, quota: int, row_quota: int) -> List[MessageRecord]:
+        async with semaphore:
+            return await asyncio.to_thread(collect, stream_id, quota, row_quota)
+
+    results = await asyncio.gather(*(
+        collect_limited(stream_id, quota, row_quota)
+        for (stream_id, _), quota, row_quota in zip(active_streams, quotas, row_quotas)
+        if quota > 0 and (max_rows <= 0 or row_quota > 0)
+    ))
+    logger.debug(f"跨聊天流检索: 聊天流 {len(results)} 个, 配额 {quotas}, 共保留 {sum(map(len, results))} 条消息")
+    return list(heapq.merge(*results, key=lambda msg: msg.time))
+
+
+def iter_messages_by_user_in_stream(user_ids: List[str], start_time: Optional[float], end_time: Optional[float],
+                                    stream_id: Optional[str], chunk_size: int = 2000,
+                                    limit: int = 0) -> Iterator[MessageRecord]:
+    """
+    按时间倒序分页读取指定用户在指定聊天流中的消息记录，每次只向数据库查询 chunk_size 条
+    调用方停止迭代后不会再发起后续查询，因此内存占用与 chunk_size 而不是 limit 相关
+    下一页的查询包含上一页最早的时间点，并按消息ID排除该时间点上已经读取过的消息，
+    因此多条消息时间相同且跨越两页时不会漏读
+    :param user_ids: 用户ID列表，为空表示所有用户
+    :param start_time: 开始时间
+    :param end_time: 结束时间
+    :param stream_id: 聊天流ID，为空表示所有聊天流
+    :param chunk_size: 每页查询的消息条数
+    :param limit: 最多读取的消息条数，0表示不限制
+    :return: 按时间倒序排列的消息生成器
+    """
+    cursor = end_time
+    # 时间恰好为 cursor 的消息中已经读取过的消息ID
+    seen_ids: Set[str] = set()
+    fetched = 0
+    while True:
+        page_size = chunk_size if limit <= 0 else min(chunk_size, limit - fetched)
+        if page_size <= 0:
+            return
+        # 已读取的消息会被再次查出，多查询相同的条数，去掉它们后仍有 page_size 条
+        query_size = page_size + len(seen_ids)
+        rows = _find_user_messages(user_ids, start_time, cursor, stream_id, query_size, include_end=bool(seen_ids))
+        page = [msg for msg in rows if msg.message_id not in seen_ids]
+        is_last_page = len(rows) < query_size and len(page) <= page_size
+        page = page[-page_size:]
+        if not page:
+            return
+        fetched += len(page)
+        # 先记录游标再产出消息，避免调用方修改列表影响下一页的查询
+        if page[0].time != cursor:
+            seen_ids = set()
+        cursor = page[0].time
+        seen_ids.update(msg.message_id for msg in page if msg.time == cursor)
+        yield from reversed(to_records(page))
+        if is_last_page:
+            return
+
+
+def get_messages_paged(user_ids: List[str], start_time: Optional[float], end_time: Optional[float],
+                       stream_id: Optional[str], limit: int, chunk_size: int = 2000) -> List[MessageRecord]:
+    """
+    与 get_messages_by_user_in_stream 相同地读取最新的 limit 条消息，但每次只向数据库查询 chunk_size 条，
+    每页立即投影为轻量记录后即可释放，读取大量消息时峰值内存只包含一页数据库消息对象
+    :param user_ids: 用户ID列表，为空表示所有用户
+    :param start_time: 开始时间
+    :param end_time: 结束时间
+    :param stream_id: 聊天流ID，为空表示所有聊天流
+    :param limit: 最多读取的消息条数，0表示不限制
+    :param chunk_size: 每页查询的消息条数
+    :return: 按时间升序排列的消息记录
+    """
+    if 0 < limit <= chunk_size:
+        return get_messages_by_user_in_stream(user_ids, start_time, end_time, stream_id, limit)
+    records = list(iter_messages_by_user_in_stream(user_ids, start_time, end_time, stream_id, chunk_size, limit))
+    records.reverse()
+    return records
+
+
+def get_most_active_users(stream_id: str, start_time: Optional[float], end_time: Optional[float], top_k: int,
+                          limit: int = 5000, exclude_user_ids: Iterable[str] = ()) -> List[str]:
+    """
+    统计聊天流中最活跃的用户
+    :param stream_id: 聊天流ID
+    :param start_time: 开始时间
+    :param end_time: 结束时间
+    :param top_k: 返回的用户数
+    :param limit: 最多统计的消息条数，从最新的消息开始统计
+    :param exclude_user_ids: 不参与统计的用户ID，例如机器人自己
+    :return: 按发言数降序排列的用户ID列表
+    """
+    excluded = set(exclude_user_ids)
+    counter = Counter(
+        msg.user_id
+        for msg in iter_messages_by_user_in_stream([], start_time, end_time, stream_id, limit=limit)
+        if msg.user_id not in excluded
+    )
+    return [user_id for user_id, _ in counter.most_common(top_k)]
+
+
+class StreamHistory:
+    """
+    一次读取的聊天流历史消息，批量画像时为多个画像对象分别过滤出消息和上下文，不必为每个人重复检索
+    按发送者预先建立消息下标的索引，为每个画像对象过滤时只需遍历该用户自己的消息
+    """
+
+    def __init__(self, messages: List[MessageRecord]):
+        # 按时间升序排列的消息
+        self.messages = messages
+        self.times = array("d", (msg.time for msg in messages))
+        # 用户ID到该用户消息下标（升序）的映射
+        self.positions: Dict[str, List[int]] = {}
+        for index, msg in enumerate(messages):
+            self.positions.setdefault(msg.user_id, []).append(index)
+
+    def most_active_users(self, top_k: int, exclude_user_ids: Iterable[str] = ()) -> List[str]:
+        """按发言数降序排列的用户ID，发言数相同时最近发言的用户在前"""
+        excluded = set(exclude_user_ids)
+        ranked = sorted(
+            (user_id for user_id in self.positions if user_id not in excluded),
+            key=lambda user_id: (len(self.positions[user_id]), self.positions[user_id][-1]),
+            reverse=True
+        )
+        return ranked[:top_k]
+
+    def since(self, start_time: Optional[float]) -> List[MessageRecord]:
+        """晚于 start_time 的消息"""
+        if not start_time:
+            return self.messages
+        return self.messages[bisect_right(self.times, start_time):]
+
+    def filter_with_context(self, primary_user_id: str, start_time: Optional[float], context_length: int,
+                            context_length_after: int = 0, limit: int = 1000) -> List[MessageRecord]:
+        """
+        与对 since(start_time) 调用 filter_messages_with_context 的结果相同
+        :param primary_user_id: 目标用户ID
+        :param start_time: 只保留晚于该时间的消息，为空表示不限制
+        :param context_length: 目标用户消息之前的的上下文消息条数
+        :param context_length_after: 目标用户消息之后的上下文消息条数
+        :param limit: 最多保留的消息条数
+        :return: 按时间升序排列的过滤后的消息
+        """
+        if limit <= 0:
+            return []
+        first = bisect_right(self.times, start_time) if start_time else 0
+        positions = self.positions.get(primary_user_id, [])
+        anchors = (index - first for index in reversed(positions[bisect_left(positions, first):]))
+        result: List[MessageRecord] = []
+        for start, end in merge_context_windows(anchors, len(self.messages) - first, context_length,
+                                                context_length_after, limit):
+            result.extend(self.messages[first + start:first + end + 1])
+        return result
+
+
+def format_duration(seconds: float) -> str:
+    """把秒数格式化为便于阅读的时长，例如 “3小时5分钟”"""
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return "不到1分钟"
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    parts = []
+    if days:
+        parts.append(f"{days}天")
+    if hours:
+        parts.append(f"{hours}小时")
+    if minutes and not days:
+        parts.append(f"{minutes}分钟")
+    return "".join(parts)
+
+
+def _find_stream_messages(stream_id: str, time_range: Dict[str, float], limit: int = 0,
+                          limit_mode: str = "latest") -> List[DatabaseMessages]:
+    """按时间范围查询指定聊天流中的消息"""
+    return find_messages(
+        message_filter={"chat_id": stream_id, "time": time_range},
+        sort=[("time", 1)] if limit == 0 else None,
+        limit=limit,
+        limit_mode=limit_mode,
+        filter_command=True
+    )
 
 
 async def prepare_portrayal_messages(
-        messages: List[DatabaseMessages],
+        messages: List[MessageRecord],
         limit: int = 500,
         primary_user_id: Optional[str] = None,
         person_name_dict: Optional[Dict[str, str]] = None,
@@ -56,54 +442,126 @@ async def prepare_portrayal_messages(
     :param max_message_length: 单条消息最大字数限制，0表示不限制
     :return: 格式化后的消息字符串列表（按时间升序）、列表中属于 primary_user_id 的消息数（如果未提供 primary_user_id 则为 0）、列表中属于其他用户的消息数
     """
+    prepared = await prepare_portrayal_messages_stream(
+        reversed(messages), limit, primary_user_id, person_name_dict, max_message_length
+    )
+    return prepared.lines, prepared.primary_count, prepared.other_count
+
+
+class PreparedMessages:
+    """整理好的画像输入"""
+
+    def __init__(self, lines: List[str], primary_count: int, other_count: int, latest_time: Optional[float],
+                 token_count: int, earliest_time: Optional[float] = None, merged_count: int = 0,
+                 speaker_legend: str = ""):
+        # 格式化后的消息字符串列表（按时间升序）
+        self.lines = lines
+        # 属于目标用户的消息数
+        self.primary_count = primary_count
+        # 属于其他用户的消息数
+        self.other_count = other_count
+        # 读取到的最新消息的时间，没有读取到任何消息时为 None
+        self.latest_time = latest_time
+        # 所有消息行的估算token数
+        self.token_count = token_count
+        # 保留下来的最早一条消息的时间，没有保留任何消息时为 None
+        self.earliest_time = earliest_time
+        # 被合并到其他行中的重复消息数
+        self.merged_count = merged_count
+        # 紧凑格式下保留的消息中出现的发言人代号与人物名称的对应关系，完整格式下为空
+        self.speaker_legend = speaker_legend
+
+
+async def prepare_portrayal_messages_stream(
+        messages: Iterable[MessageRecord],
+        limit: int = 500,
+        primary_user_id: Optional[str] = None,
+        person_name_dict: Optional[Dict[str, str]] = None,
+        max_message_length: int = 0,
+        token_budget: int = 0,
+        compact_similarity: float = 0,
+        message_format: str = "full") -> PreparedMessages:
+    """
+    逐条消费按时间倒序排列的消息，清洗并格式化为用户画像的输入，
+    产生 limit 条或估算token数达到 token_budget 后立即停止消费
+
+    :param messages: 按时间倒序排列的消息，可以是生成器
+    :param limit: 最大返回消息条数
+    :param primary_user_id: 目标用户ID
+    :param person_name_dict: 用户ID到昵称的映射
+    :param max_message_length: 单条消息最大字数限制，0表示不限制
+    :param token_budget: 所有消息行的token预算，0表示不限制
+    :param compact_similarity: 大于0时把连续的重复消息合并为一行并标注重复次数，数值为判定近似重复的相似度阈值，
+        合并的消息不占用条数和token预算
+    :param message_format: 聊天记录的格式，full 或 compact，见 MESSAGE_FORMATS
+    :return: 整理好的画像输入
+    """
     if person_name_dict is None:
         person_name_dict = {}
-    lines = []
-    primary_user_count = 0
-    other_user_count = 0
-    pattern1 = re.compile("={10}\s*转发消息开始\s*={10}\s*([\s\S]*?)\s*={10}\s*转发消息结束\s*={10}", re.DOTALL)
-    pattern2 = re.compile(r"\[回复<.+]，说：", re.DOTALL)
-    pattern3 = re.compile(r"@<.+>")
-    pattern4 = re.compile(r"\[表情包.+]", re.DOTALL)
-    pattern5 = re.compile(r"\[picid.+]", re.DOTALL)
-    pattern6 = re.compile(r"\[command.+]", re.DOTALL)
-    patterns = [
-        ("转发消息开始", pattern1),
-        ("回复", pattern2),
-        ("@", pattern3),
-        ("[表情包", pattern4),
-        ("[picid", pattern5),
-        ("[command", pattern6),
-    ]
-    message: DatabaseMessages
-    for message in reversed(messages):
-        if len(lines) >= limit:
-            break
-        text = message.processed_plain_text.strip()
-        if not text or "[文件:" in text:
+    latest_time = None
+    if limit <= 0:
+        return PreparedMessages([], 0, 0, latest_time, 0)
+    # 先清洗消息并收集出现过的用户，再一次性解析人物名称，最后统一格式化
+    entries: List[Tuple[float, str, str]] = []
+    # 每条保留的消息合并了多少条重复消息（包括它自己）
+    repeats: List[int] = []
+    compactor = RepeatCompactor(compact_similarity, primary_user_id) if compact_similarity > 0 else None
+    speakers: Dict[str, str] = {}
+    estimated_tokens = 0
+    compact = message_format == "compact"
+    message: MessageRecord
+    for message in messages:
+        if latest_time is None:
+            latest_time = message.time
+        text = message_sanitizer.clean(message.text)
+        if not text:
             continue
-        for key, pat in patterns:
-            if key in text:
-                text = pat.sub("", text)
-        text = text.strip()
-        if not text: continue
         if 0 < max_message_length < len(text):
             text = text[:max_message_length] + "......[由于消息过长，后续消息已被截断]"
-        time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message.time))
-        person_name = person_name_dict.get(message.user_info.user_id)
-        if not person_name:
-            user_id = message.user_info.user_id
-            person_id = person_api.get_person_id('qq', user_id)
-            person_name = await person_api.get_person_value(person_id, "person_name", message.user_info.user_nickname)
-            person_name_dict[user_id] = person_name
-        text = f"[{time_str}] {person_name}: {text}"
-        lines.append(text)
-        if primary_user_id and message.user_info.user_id == primary_user_id:
-            primary_user_count += 1
-        else:
-            other_user_count += 1
+        user_id = message.user_id
+        if compactor is not None and compactor.is_repeat(user_id, text):
+            # 保留最新的一条，标注重复次数
+            if repeats[-1] == 1:
+                # 为 " (×N)" 预留token
+                estimated_tokens += 3
+            repeats[-1] += 1
+            continue
+        entries.append((message.time, user_id, text))
+        repeats.append(1)
+        if not person_name_dict.get(user_id):
+            speakers[user_id] = message.user_nickname
+        if len(entries) >= limit:
+            break
+        if token_budget > 0:
+            # 人物名称尚未解析，先用已知名称或QQ昵称估算，格式化后再精确裁剪
+            if compact:
+                estimated_tokens += estimate_tokens(f"{COMPACT_LINE_PLACEHOLDER}{text}") + 1
+            else:
+                name = person_name_dict.get(user_id) or message.user_nickname or ""
+                estimated_tokens += estimate_tokens(f"{LINE_TIME_PLACEHOLDER}{name}: {text}") + 1
+            if estimated_tokens > token_budget:
+                break
+
+    if speakers:
+        person_name_dict.update(await person_name_resolver.resolve_many(speakers))
+    if compact:
+        lines, kept, token_count, speaker_legend = encode_compact(
+            entries, repeats, person_name_dict, primary_user_id, token_budget
+        )
+        primary_count = sum(1 for _, user_id, _ in entries[:kept] if primary_user_id and user_id == primary_user_id)
+        earliest_time = entries[kept - 1][0] if kept else None
+        return PreparedMessages(lines, primary_count, kept - primary_count, latest_time, token_count,
+                                earliest_time, sum(repeats[:kept]) - kept, speaker_legend)
+    lines = [format_full_line(message_time, person_name_dict.get(user_id), format_repeat(text, repeat))
+             for (message_time, user_id, text), repeat in zip(entries, repeats)]
+    line_tokens = [estimate_tokens(line) for line in lines]
+    kept = pack_lines(lines, token_budget, line_tokens)
+    primary_count = sum(1 for _, user_id, _ in entries[:kept] if primary_user_id and user_id == primary_user_id)
+    lines = lines[:kept]
     lines.reverse()
-    return lines, primary_user_count, other_user_count
+    earliest_time = entries[kept - 1][0] if kept else None
+    return PreparedMessages(lines, primary_count, kept - primary_count, latest_time, sum(line_tokens[:kept]) + kept,
+                            earliest_time, sum(repeats[:kept]) - kept)
 
 
 def resolve_stream_id(raw_chat_id: str) -> Optional[str]:
@@ -119,46 +577,130 @@ def resolve_stream_id(raw_chat_id: str) -> Optional[str]:
     return chat_stream.stream_id if chat_stream else None
 
 
-def filter_messages_with_context(messages: List[DatabaseMessages], primary_user_id: str,
+def iter_messages_with_context(messages: Iterable[MessageRecord], primary_user_id: str,
+                               context_length: int, context_length_after: int = 0) -> Iterator[MessageRecord]:
+    """
+    以流的方式过滤消息，仅保留指定用户的消息及其前后上下文
+    输入和输出均按时间倒序排列，只需缓存 context_length_after 条消息
+    :param messages: 按时间倒序排列的消息，可以是生成器
+    :param primary_user_id: 目标用户ID
+    :param context_length: 目标用户消息之前的的上下文消息条数
+    :param context_length_after: 目标用户消息之后的上下文消息条数。默认为0
+    :return: 按时间倒序排列的过滤后的消息生成器
+    """
+    # 倒序遍历时，目标用户消息的下文会先于它出现，暂存最近的 context_length_after 条尚未输出的消息
+    pending = deque(maxlen=context_length_after) if context_length_after and context_length_after > 0 else None
+    remaining_before = 0
+    for msg in messages:
+        if msg.user_id == primary_user_id:
+            if pending:
+                yield from pending
+                pending.clear()
+            yield msg
+            remaining_before = context_length
+        elif remaining_before > 0:
+            remaining_before -= 1
+            yield msg
+        elif pending is not None:
+            pending.append(msg)
+
+
+def merge_context_windows(anchors: Iterable[int], total: int, context_length: int, context_length_after: int = 0,
+                          limit: int = 1000) -> List[Tuple[int, int]]:
+    """
+    把目标用户每条消息的上下文窗口 [下标 - context_length, 下标 + context_length_after] 合并为互不重叠的区间
+    从最新的消息开始一次遍历完成合并，覆盖的消息数达到 limit 后不再读取更早的目标用户消息，
+    最后只保留最新的 limit 条
+    :param anchors: 按下标倒序排列的目标用户消息下标，可以是生成器
+    :param total: 消息总数
+    :param context_length: 目标用户消息之前的的上下文消息条数
+    :param context_length_after: 目标用户消息之后的上下文消息条数
+    :param limit: 最多保留的消息条数
+    :return: 按下标升序排列的闭区间
+    """
+    context_length = max(context_length, 0)
+    context_length_after = max(context_length_after or 0, 0)
+    intervals: List[Tuple[int, int]] = []
+    covered = 0
+    start = end = -1
+    for index in anchors:
+        if covered >= limit:
+            break
+        low = max(0, index - context_length)
+        high = min(total - 1, index + context_length_after)
+        if start >= 0 and high >= start - 1:
+            # 与上一个（更新的）区间重叠或相邻，向前延伸
+            if low < start:
+                covered += start - low
+                start = low
+        else:
+            if start >= 0:
+                intervals.append((start, end))
+            start, end = low, high
+            covered += high - low + 1
+    if start >= 0:
+        intervals.append((start, end))
+    # 最后一个窗口可能使总数超过 limit，从最早的区间开始裁掉多出的部分
+    excess = covered - limit
+    while excess > 0 and intervals:
+        start, end = intervals[-1]
+        if end - start + 1 <= excess:
+            intervals.pop()
+            excess -= end - start + 1
+        else:
+            intervals[-1] = (start + excess, end)
+            excess = 0
+    intervals.reverse()
+    return intervals
+
+
+def context_indices(primary_mask: bytearray, context_length: int, context_length_after: int = 0,
+                    limit: int = 1000) -> array:
+    """
+    filter_messages_with_context 的按列存储版本，适用于已经按时间升序取出发送者列的大量消息
+    在标记数组中查找目标用户消息时使用 bytearray.rfind，不需要逐条访问消息对象
+    :param primary_mask: 每条消息是否为目标用户发送，目标用户的消息为 1，其余为 0
+    :param context_length: 目标用户消息之前的的上下文消息条数
+    :param context_length_after: 目标用户消息之后的上下文消息条数。默认为0
+    :param limit: 最多保留的消息条数，默认为1000
+    :return: 保留的消息下标，按升序排列
+    """
+    def anchors() -> Iterator[int]:
+        index = primary_mask.rfind(1)
+        while index >= 0:
+            yield index
+            index = primary_mask.rfind(1, 0, index)
+
+    indices = array("l")
+    for start, end in merge_context_windows(anchors(), len(primary_mask), context_length, context_length_after,
+                                            limit):
+        indices.extend(range(start, end + 1))
+    return indices
+
+
+def filter_messages_with_context(messages: List[MessageRecord], primary_user_id: str,
                                  context_length: int, context_length_after: int = 0, limit: int = 1000) -> List[
-    DatabaseMessages]:
+    MessageRecord]:
     """
     过滤消息列表，仅保留包含指定用户消息及其前后上下文的消息
-    :param messages: 原始消息列表
+    从最新的消息开始合并上下文窗口，达到 limit 条后停止，超出时优先保留最新的消息
+    :param messages: 原始消息列表，已按时间升序排列时不会重新排序
     :param primary_user_id: 目标用户ID
     :param context_length: 目标用户消息之前的的上下文消息条数
     :param context_length_after: 目标用户消息之后的上下文消息条数。默认为0
     :param limit: 最多保留的消息条数，默认为1000
-    :return: 过滤后的消息列表
+    :return: 过滤后的消息列表，按时间升序排列
     """
-    if not messages:
+    if not messages or limit <= 0:
         return []
-    if context_length <= 0 and (context_length_after is None or context_length_after <= 0):
-        # 如果不需要上下文，直接过滤用户消息并限制数量
-        filtered = [m for m in messages if m.user_info.user_id == primary_user_id]
-        return sorted(filtered, key=lambda x: x.time)[-limit:]
-
-    ordered = sorted(messages, key=lambda msg: msg.time)
-    include_indices = set()
-    # 倒序遍历，优先保留最新的消息
-    for idx in range(len(ordered) - 1, -1, -1):
-        if len(include_indices) >= limit:
-            break
-        msg = ordered[idx]
-        if msg.user_info.user_id == primary_user_id:
-            # 向前包含 context_length 条
-            start = max(0, idx - context_length)
-            # 向后包含 context_length_after 条
-            end = min(len(ordered) - 1, idx + context_length_after)
-            # 将范围内的索引添加到结果集中
-            for i in range(start, end + 1):
-                include_indices.add(i)
-
-    if not include_indices:
-        return []
-
-    result_indices = sorted(list(include_indices))
-    # 如果超过限制，优先保留最新的，取后 limit 条
-    if len(result_indices) > limit:
-        result_indices = result_indices[-limit:]
-    return [ordered[i] for i in result_indices]
+    times = [msg.time for msg in messages]
+    if all(map(le, times, islice(times, 1, None))):
+        ordered = messages
+    else:
+        ordered = sorted(messages, key=attrgetter("time"))
+    anchors = (index for index in range(len(ordered) - 1, -1, -1)
+               if ordered[index].user_id == primary_user_id)
+    result: List[MessageRecord] = []
+    for start, end in merge_context_windows(anchors, len(ordered), context_length, context_length_after, limit):
+        result.extend(ordered[start:end + 1])
+    return result